@@ -0,0 +1,54 @@
+import os
+import resource
+import time
+
+import pytest
+
+from benchmarks.generate import TZ
+
+# Parsers read AEST date stamps with %Z, which needs a matching local timezone
+os.environ['TZ'] = TZ
+time.tzset()
+
+def pytest_addoption(parser):
+    parser.addoption("--rows", default="1000", 
+                     help="Number of synthetic records per dump file, e.g. 1e6")
+    parser.addoption("--rounds", type=int, default=3, 
+                     help="Number of timed rounds per benchmark")
+    parser.addoption("--years", type=int, default=3, 
+                     help="Years of synthetic data in the read benchmark database")
+    parser.addoption("--users", type=int, default=25, 
+                     help="Users per project in the read benchmark database")
+
+@pytest.fixture(scope='session')
+def rows(request):
+    return int(float(request.config.getoption("--rows")))
+
+@pytest.fixture(scope='session')
+def rounds(request):
+    return request.config.getoption("--rounds")
+
+@pytest.fixture
+def throughput(request):
+    """
+    Return a function that records rows/s and peak RSS for a finished benchmark,
+    both in its extra_info and for the summary printed at the end of the run
+    """
+    def record(benchmark, nrecords):
+        rate = nrecords / benchmark.stats.stats.mean
+        # ru_maxrss is in kilobytes on Linux, and is a high water mark for the process
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        benchmark.extra_info.update(rows=nrecords, rows_per_second=rate, peak_rss_mb=rss)
+        request.config._throughput.append((request.node.name, nrecords, rate, rss))
+    return record
+
+def pytest_configure(config):
+    config._throughput = []
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not config._throughput:
+        return
+    terminalreporter.section('throughput')
+    terminalreporter.write_line('{:<45} {:>10} {:>12} {:>14}'.format('Name', 'rows', 'rows/s', 'peak RSS (MB)'))
+    for name, nrecords, rate, rss in config._throughput:
+        terminalreporter.write_line('{:<45} {:>10} {:>12.1f} {:>14.1f}'.format(name, nrecords, rate, rss))
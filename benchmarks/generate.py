@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Generate synthetic dump files in the formats read by the ncigrafana parsers.
+Output is written incrementally so very large files can be made without
+holding them in memory. Each generator returns the number of records written
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+from ncigrafana.DBcommon import date_range_from_quarter
+
+# Matches the timezone the tests use to parse AEST date stamps
+TZ = 'AEST-10AEDT-11,M10.5.0,M3.5.0'
+
+startdate = datetime.datetime(2022, 10, 3, 8, 30, 3)
+
+def projectname(i):
+    return '{}{}{}'.format(chr(ord('a') + (i // 260) % 26), chr(ord('a') + (i // 10) % 26), i % 10)
+
+def username(i):
+    return '{}{}{:04d}'.format(chr(ord('a') + (i // 26) % 26), chr(ord('a') + i % 26), i % 10000)
+
+def datestamp(date):
+    """
+    Date stamp line as written by the cron wrappers around lquota and nci_account
+    """
+    return date.strftime('%a %b %d %H:%M:%S AEST %Y')
+
+def write_file_report(directory, rows, project='w40', storagepoint='gdata', 
+                      nprojects=50, nusers=200, seed=1):
+    """
+    Write a nci-files-report --json dump with rows entries for a single scan.
+    Returns the path, which encodes the project and storage point as the
+    parser expects, and the number of records
+    """
+    rng = random.Random(seed)
+    scantime = startdate.replace(tzinfo=datetime.timezone.utc)
+    path = os.path.join(directory, '{}.{}.{}.json'.format(scantime.strftime('%Y-%m-%dT%H:%M:%S'), 
+                                                          project, storagepoint))
+    with open(path, 'w') as f:
+        f.write('[')
+        for i in range(rows):
+            blocks = rng.randint(8, 2**30)
+            count = rng.randint(1, 2**20)
+            entry = {"fs": storagepoint,
+                     "project": projectname(i % nprojects),
+                     "gid": 90000 + i // (nusers * nprojects),
+                     "uid": 90000 + (i // nprojects) % nusers,
+                     "blocks": {"single": blocks, "multiple": 0.0},
+                     "count": {"single": count, "multiple": 0.0},
+                     "size": {"single": blocks * 512, "multiple": 0.0},
+                     "scan_time": scantime.isoformat()}
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(entry))
+        f.write(']')
+    return path, rows
+
+def write_lquota(path, rows, nprojects=100, seed=1):
+    """
+    Write an lquota log with rows project/storage point entries, split into daily
+    blocks of nprojects projects on scratch and gdata
+    """
+    rng = random.Random(seed)
+    storagepoints = ['scratch', 'gdata']
+    perday = nprojects * len(storagepoints)
+    rule = '-' * 74
+    header = '           fs       Usage      Quota      Limit   iUsage   iQuota   iLimit'
+    with open(path, 'w') as f:
+        for i in range(rows):
+            if i % perday == 0:
+                if i > 0:
+                    f.write(rule + '\n')
+                f.write('%%%%%%%%%%%%%%%%%\n')
+                f.write(datestamp(startdate + datetime.timedelta(days=i // perday)) + '\n')
+                f.write('\n'.join([rule, header, rule]) + '\n')
+            project = projectname((i % perday) // len(storagepoints))
+            storagepoint = storagepoints[i % len(storagepoints)]
+            quota = rng.randint(10**9, 10**14)
+            iquota = rng.randint(10**5, 10**8)
+            f.write('{:>6} {:>7} {} {} {} {} {} {}\n'.format(project, storagepoint,
+                                                               rng.randint(0, quota), quota, 2 * quota,
+                                                               rng.randint(0, iquota), iquota, 2 * iquota))
+        f.write(rule + '\n')
+    return rows
+
+def write_nci_account(path, rows, nprojects=40, nusers=25, seed=1):
+    """
+    Write an nci_account log with rows user usage records. Each project
+    snapshot has nusers users, and all nprojects projects are dumped each day
+    """
+    rng = random.Random(seed)
+    nlines = max(rows // nusers, 1)
+    with open(path, 'w') as f:
+        for i in range(nlines):
+            if i % nprojects == 0:
+                f.write('%%%%%%%%%%%%%%%%%\n')
+                f.write(datestamp(startdate + datetime.timedelta(days=i // nprojects)) + '\n')
+            grant = float(rng.randint(10**5, 10**7))
+            users = {username(j): {"usage": rng.random() * grant / nusers, "acquired": 0.0} 
+                     for j in range(nusers)}
+            used = sum(u['usage'] for u in users.values())
+            record = {"status": 200, 
+                      "project": projectname(i % nprojects), 
+                      "usage": {"total_grant": grant, 
+                                "running_job_reserved": 0.0, 
+                                "used": used, 
+                                "stakeholders": {"Scheme": {"name": "Scheme", 
+                                                            "balance": grant - used, 
+                                                            "grant": grant}}, 
+                                "users": users}}
+            f.write(json.dumps(record) + '\n')
+    return nlines * nusers
+
+# Synthetic SU charge rates per core hour of the queues jobs are written to
+chargerates = {'normal': 2., 'express': 6., 'hugemem': 3., 'copyq': 2., 'gpuvolta': 3.}
+
+def add_chargerates(db):
+    """
+    Set chargerates on the JobsDataset db, needed for the daily rollup
+    """
+    for queue, rate in chargerates.items():
+        db.addchargerate(queue, rate)
+    return db
+
+def write_qstat_json(path, rows, nprojects=40, nusers=200, seed=1):
+    """
+    Write a qstat -f -F json dump with rows finished jobs
+    """
+    rng = random.Random(seed)
+    queues = list(chargerates)
+    pbsformat = '%a %b %d %H:%M:%S %Y'
+    with open(path, 'w') as f:
+        f.write('{"Jobs": {')
+        for i in range(rows):
+            ctime = startdate + datetime.timedelta(seconds=i * 10)
+            stime = ctime + datetime.timedelta(seconds=rng.randint(0, 86400))
+            walltime = rng.randint(1, 48 * 3600)
+            ncpus = rng.choice([1, 4, 16, 48, 96, 240, 1440])
+            walltime = '{:02d}:{:02d}:{:02d}'.format(walltime // 3600, (walltime // 60) % 60, walltime % 60)
+            job = {"Job_Name": "job{}".format(i),
+                   "Job_Owner": "{}@gadi-login-01.gadi.nci.org.au".format(username(i % nusers)),
+                   "job_state": "F",
+                   "queue": rng.choice(queues),
+                   "project": projectname(i % nprojects),
+                   "ctime": ctime.strftime(pbsformat),
+                   "qtime": ctime.strftime(pbsformat),
+                   "mtime": stime.strftime(pbsformat),
+                   "stime": stime.strftime(pbsformat),
+                   "Resource_List": {"jobprio": 50, "mem": "{}gb".format(ncpus * 4), 
+                                     "ncpus": ncpus, "walltime": "48:00:00"},
+                   "resources_used": {"cput": walltime, "mem": "{}mb".format(ncpus * 100), 
+                                      "ncpus": ncpus, "walltime": walltime},
+                   "executable": "<jsdl-hpcpa:Executable>/bin/bash</jsdl-hpcpa:Executable>",
+                   "argument_list": "<jsdl-hpcpa:Argument>run.sh</jsdl-hpcpa:Argument>",
+                   "Submit_arguments": "-q normal run.sh",
+                   "Exit_status": 0}
+            if i > 0:
+                f.write(', ')
+            f.write('"{}.gadi-pbs": {}'.format(10**7 + i, json.dumps(job)))
+        f.write('}}')
+    return rows
+
+def populate_usage_db(db, years=3, nprojects=4, nusers=25, seed=1):
+    """
+    Fill the ProjectDataset db with daily user SU usage and daily scratch and
+    gdata storage scans for every user in nprojects projects over years
+    years, with quarterly grants. Dimension tables are filled with the
+    ProjectDataset methods and fact tables in bulk. Returns the number of
+    fact rows written
+    """
+    rng = random.Random(seed)
+    system = 'gadi'
+    storagepoints = [('gadi', 'scratch'), ('global', 'gdata')]
+    scheme = 'Scheme'
+    start = datetime.date(startdate.year - years, 1, 1)
+    ndays = (datetime.date(startdate.year, 1, 1) - start).days
+
+    projects = {projectname(p): db.addproject(projectname(p)) for p in range(nprojects)}
+    users = {username(u): db.adduser(username(u), 'User {}'.format(u)) for u in range(nusers)}
+    storagepoint_ids = [db.addstoragepoint(s, p) for s, p in storagepoints]
+
+    for year in range(start.year, startdate.year):
+        for quarter in ['q1', 'q2', 'q3', 'q4']:
+            qstart, qend = date_range_from_quarter(year, quarter)
+            db.addquarter(year, quarter, qstart, qend)
+            for project in projects:
+                db.addusagegrant(project, system, scheme, year, quarter, qstart, 10.**7)
+                for s, p in storagepoints:
+                    db.addstoragegrant(project, s, p, scheme, year, quarter, qstart, 'capacity', 10.**14)
+                    db.addstoragegrant(project, s, p, scheme, year, quarter, qstart, 'inodes', 10.**7)
+
+    usage = []; storage = []
+    for day in range(ndays):
+        date = start + datetime.timedelta(days=day)
+        for project_id in projects.values():
+            for user_id in users.values():
+                usage.append(dict(project_id=project_id, user_id=user_id, date=date, 
+                                  usage_cpu=0., usage_wall=0., usage_su=rng.random() * 1000., 
+                                  efficiency=rng.random()))
+                for storagepoint_id in storagepoint_ids:
+                    size = float(rng.randint(0, 10**12))
+                    storage.append(dict(project_id=project_id, user_id=user_id, 
+                                        storagepoint_id=storagepoint_id, folder=str(project_id), 
+                                        scandate=date, inodes=size // 10**6, size=size))
+
+    db.db['UserUsage'].insert_many(usage)
+    db.db['UserStorage'].insert_many(storage)
+    db.ensure_indexes()
+
+    return len(usage) + len(storage)
+
+def populate_jobs_db(db, rows, nprojects=40, nusers=200, seed=1):
+    """
+    Fill the JobsDataset db with rows finished jobs, created every 10 minutes.
+    Returns the number of jobs written
+    """
+    rng = random.Random(seed)
+    queues = list(chargerates)
+
+    def ids(table, field, values, add):
+        for value in values:
+            add(value)
+        return {r[field]: r['id'] for r in db.db[table].all()}
+
+    projects = ids('Project', 'project', [projectname(p) for p in range(nprojects)], db.addproject)
+    users = ids('User', 'username', [username(u) for u in range(nusers)], 
+                lambda u: db.adduser(u, fullname=u))
+    queue_ids = ids('Queue', 'queue', queues, lambda q: db.addchargerate(q, chargerates[q]))
+    state = ids('JobState', 'status', ['F'], db.addstate)['F']
+    exe = ids('Executable', 'path', ['/bin/bash'], db.addexe)['/bin/bash']
+
+    jobs = []
+    ctime = startdate - datetime.timedelta(minutes=10 * rows)
+    for i in range(rows):
+        ctime += datetime.timedelta(minutes=10)
+        walltime = float(rng.randint(1, 48 * 3600))
+        ncpus = rng.choice([1, 4, 16, 48, 96, 240, 1440])
+        waittime = float(rng.randint(0, 86400))
+        jobs.append(dict(year=ctime.year, jobid=str(10**7 + i), 
+                         project=projects[projectname(i % nprojects)], 
+                         queue=queue_ids[rng.choice(queues)],
+                         user=users[username(i % nusers)], status=state, jobname='job{}'.format(i), 
+                         exe=exe, ctime=ctime, mtime=waittime, qtime=0., stime=waittime, 
+                         waitime=waittime, maxwalltime=172800., maxmem=ncpus * 4 * 2**30, 
+                         ncpus=ncpus, walltime=walltime, mem=ncpus * 100 * 2**20, 
+                         cputime=walltime * ncpus, cpuutil=rng.random(), exitstatus=0))
+
+    db.db['Jobs'].insert_many(jobs)
+    db.ensure_indexes()
+
+    return rows
+
+def main(args):
+
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+
+    rows = int(float(args.rows))
+
+    if args.kind == 'file-report':
+        path, _ = write_file_report(args.directory, rows, seed=args.seed)
+    else:
+        path = os.path.join(args.directory, {'lquota': 'lquota.log',
+                                             'nci-account': 'nci_account.log',
+                                             'qstat': 'qstat.json'}[args.kind])
+        {'lquota': write_lquota,
+         'nci-account': write_nci_account,
+         'qstat': write_qstat_json}[args.kind](path, rows, seed=args.seed)
+
+    print(path)
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic dump files for benchmarking")
+    parser.add_argument("kind", help="Type of dump file", 
+                        choices=['file-report', 'lquota', 'nci-account', 'qstat'])
+    parser.add_argument("-r","--rows", help="Number of records, e.g. 1e6", default='1000')
+    parser.add_argument("-d","--directory", help="Output directory", default=".")
+    parser.add_argument("-s","--seed", help="Random seed", type=int, default=1)
+
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,75 @@
+"""
+Record the SQL statements issued by the read API and check their query
+plans for full scans of the large fact tables. Scans of the small dimension
+tables (Users, Projects, Quarters, ...) are expected and allowed
+"""
+
+from __future__ import print_function
+
+import re
+
+from sqlalchemy import event
+
+fact_tables = {'UserUsage', 'UserStorage', 'ProjectUsage', 'SchemeUsage', 'ProjectStorage', 
+               'UsageGrants', 'StorageGrants', 'Jobs', 'JobStatsDaily'}
+
+class QueryRecorder(object):
+    """
+    Context manager which records every SELECT executed on engine as
+    (statement, parameters) in the DBAPI paramstyle
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+def explain(engine, statement, parameters):
+    """
+    Return the query plan of statement as a list of strings, using
+    EXPLAIN QUERY PLAN for SQLite and EXPLAIN for PostgreSQL
+    """
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + statement, parameters)
+        # SQLite returns (id, parent, notused, detail), PostgreSQL a single text column
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+def fullscans(plan, tables=fact_tables):
+    """
+    Return the tables in tables that plan scans from end to end, either
+    directly or through a complete index scan
+    """
+    scanned = []
+    for line in plan:
+        match = (re.match(r'\s*SCAN (?:TABLE )?(\w+)', line) or 
+                 re.search(r'Seq Scan on "?(\w+)"?', line))
+        if match and match.group(1) in tables:
+            scanned.append(match.group(1))
+    return scanned
+
+def checkplans(engine, function, *args, **kwargs):
+    """
+    Call function, then explain every SELECT it issued. Returns a list of
+    (statement, plan, fullscans)
+    """
+    with QueryRecorder(engine) as recorder:
+        function(*args, **kwargs)
+    plans = []
+    for statement, parameters in recorder.statements:
+        plan = explain(engine, statement, parameters)
+        plans.append((statement, plan, fullscans(plan)))
+    return plans
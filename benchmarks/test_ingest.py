@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+End to end ingestion benchmarks for each parser against SQLite, both in
+memory and on disk. Run with
+
+    python -m pytest benchmarks --rows 1e5
+
+The JSON parsers are run with each available decoder (see
+DBcommon.json_loads). Throughput (rows/s) and the peak resident set size of the process are
+recorded in the extra_info of each benchmark and summarised at the end of
+the run
+"""
+
+from __future__ import print_function
+
+import itertools
+import json
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from ncigrafana import DBcommon
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.parse_user_storage_data import parse_file_report
+from ncigrafana.parse_lquota import parse_lquota
+from ncigrafana.parse_account_usage_data import parse_account_dump_file
+from ncigrafana.make_jobs_DB import parse_qstat_json_dump
+from ncigrafana.parse_user_storage_data import file_report_records
+from ncigrafana.parse_lquota import lquota_records
+from ncigrafana.parse_account_usage_data import account_dump_records
+from ncigrafana.make_jobs_DB import qstat_records
+
+from ncigrafana.JobsDataset import JobsDataset
+
+from benchmarks.generate import write_file_report, write_lquota, write_nci_account, write_qstat_json, add_chargerates
+
+@pytest.fixture(params=['memory', 'file'])
+def dbpath(request, tmp_path):
+    """
+    Return a function that gives a path for a fresh database on each call
+    """
+    counter = itertools.count()
+    if request.param == 'memory':
+        return lambda: ':memory:'
+    return lambda: str(tmp_path / 'bench{}.db'.format(next(counter)))
+
+@pytest.fixture(params=['json', 'orjson'])
+def json_backend(request, monkeypatch):
+    """
+    Decode JSON in the parsers with the stdlib json or with orjson
+    """
+    if request.param == 'orjson':
+        if DBcommon.json_backend != 'orjson':
+            pytest.skip('orjson is not installed')
+    else:
+        for module in ('parse_user_storage_data', 'parse_account_usage_data', 'make_jobs_DB'):
+            monkeypatch.setattr('ncigrafana.{}.json_loads'.format(module), json.loads)
+    return request.param
+
+def run(benchmark, rounds, parse, newdb):
+    benchmark.pedantic(parse, setup=lambda: ((newdb(),), {}), rounds=rounds)
+
+def test_parse_file_report(benchmark, tmp_path, rows, rounds, dbpath, throughput, json_backend):
+    filename, nrecords = write_file_report(str(tmp_path), rows)
+    run(benchmark, rounds, 
+        lambda db: parse_file_report(filename, False, db=db),
+        lambda: ProjectDataset(dburl='sqlite:///' + dbpath()))
+    throughput(benchmark, nrecords)
+
+def test_parse_lquota(benchmark, tmp_path, rows, rounds, dbpath, throughput):
+    filename = str(tmp_path / 'lquota.log')
+    nrecords = write_lquota(filename, rows)
+    run(benchmark, rounds, 
+        lambda db: parse_lquota(filename, False, db=db),
+        lambda: ProjectDataset(dburl='sqlite:///' + dbpath()))
+    throughput(benchmark, nrecords)
+
+def test_parse_account_dump_file(benchmark, tmp_path, rows, rounds, dbpath, throughput, json_backend):
+    filename = str(tmp_path / 'nci_account.log')
+    nrecords = write_nci_account(filename, rows)
+    run(benchmark, rounds, 
+        lambda db: parse_account_dump_file(filename, False, db=db),
+        lambda: ProjectDataset(dburl='sqlite:///' + dbpath()))
+    throughput(benchmark, nrecords)
+
+def test_parse_qstat_json_dump(benchmark, tmp_path, rows, rounds, dbpath, throughput, json_backend):
+    filename = str(tmp_path / 'qstat.json')
+    nrecords = write_qstat_json(filename, rows)
+    run(benchmark, rounds, 
+        lambda db: parse_qstat_json_dump(filename, None, db=db),
+        lambda: add_chargerates(JobsDataset('sqlite:///' + dbpath())))
+    throughput(benchmark, nrecords)
+
+@pytest.mark.parametrize('source', ['file-report', 'lquota', 'nci-account', 'qstat'])
+def test_parse_records(benchmark, tmp_path, rows, rounds, throughput, source):
+    # Parsing alone, without loading the records into a database
+    if source == 'file-report':
+        filename, nrecords = write_file_report(str(tmp_path), rows)
+        parse = file_report_records
+    elif source == 'lquota':
+        filename = str(tmp_path / 'lquota.log')
+        nrecords = write_lquota(filename, rows)
+        parse = lquota_records
+    elif source == 'nci-account':
+        filename = str(tmp_path / 'nci_account.log')
+        nrecords = write_nci_account(filename, rows)
+        parse = account_dump_records
+    else:
+        filename = str(tmp_path / 'qstat.json')
+        nrecords = write_qstat_json(filename, rows)
+        parse = qstat_records
+    benchmark.pedantic(parse, args=(filename, False), rounds=rounds)
+    throughput(benchmark, nrecords)
+
+def test_json_loads(benchmark, tmp_path, rows, rounds, json_backend, throughput):
+    # Decoding alone, which the end to end benchmarks include along with the database
+    filename = str(tmp_path / 'qstat.json')
+    nrecords = write_qstat_json(filename, rows)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    loads = DBcommon.json_loads if json_backend == 'orjson' else json.loads
+    benchmark.pedantic(loads, args=(data,), rounds=rounds)
+    throughput(benchmark, nrecords)
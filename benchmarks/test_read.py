@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Read API latency benchmarks against a usage database holding several years
+of synthetic daily data, and a jobs database with --rows jobs. Run with
+
+    python -m pytest benchmarks/test_read.py --years 3 --users 50 --rows 1e6
+
+As well as timing each call, the query plan of every SELECT it issues is
+stored in the benchmark extra_info, and the benchmark fails if any of them
+scans a whole fact table
+"""
+
+from __future__ import print_function
+
+import datetime
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.JobsDataset import JobsDataset
+
+from benchmarks.generate import populate_usage_db, populate_jobs_db, projectname, startdate
+from benchmarks.queryplan import checkplans
+
+@pytest.fixture(scope='session')
+def usagedb(tmp_path_factory, request):
+    dbfile = tmp_path_factory.mktemp('read') / 'usage.db'
+    db = ProjectDataset(dburl='sqlite:///{}'.format(dbfile))
+    populate_usage_db(db, years=request.config.getoption('--years'), 
+                      nusers=request.config.getoption('--users'))
+    return db
+
+@pytest.fixture(scope='session')
+def jobsdb(tmp_path_factory, rows):
+    dbfile = tmp_path_factory.mktemp('read') / 'jobs.db'
+    db = JobsDataset('sqlite:///{}'.format(dbfile))
+    populate_jobs_db(db, rows)
+    return db
+
+# The most recent complete quarter in the synthetic data
+year, quarter = startdate.year - 1, 'q4'
+
+def run(benchmark, rounds, db, function, *args, **kwargs):
+    plans = checkplans(db.db.executable.engine, function, *args, **kwargs)
+    benchmark.extra_info['plans'] = [dict(statement=s, plan=p) for s, p, _ in plans]
+    benchmark.pedantic(function, args=args, kwargs=kwargs, rounds=rounds)
+    for statement, plan, scans in plans:
+        assert not scans, 'Full scan of {} in:\n{}\n{}'.format(scans, statement, '\n'.join(plan))
+
+@pytest.mark.parametrize('output', ['wide', 'sparse', 'long'])
+def test_getusage(benchmark, rounds, usagedb, output):
+    run(benchmark, rounds, usagedb, usagedb.getusage, year, quarter, output=output)
+
+def test_getstorage(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.getstorage, projectname(0), year, quarter, 'gadi', 'scratch')
+
+def test_query_usage(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.query_usage, projects=[projectname(0), projectname(1)],
+        start=datetime.date(year, 1, 1), end=datetime.date(year, 12, 31))
+
+def test_query_storage(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.query_usage, projects=[projectname(0), projectname(1)],
+        storagepoints=['scratch', 'gdata'], start=datetime.date(year, 1, 1), end=datetime.date(year, 12, 31))
+
+def test_getsuusers(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.getsuusers, year, quarter)
+
+def test_top_usage(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.top_usage, year, quarter, ['scratch', 'gdata'])
+
+def test_getstoragegrant(benchmark, rounds, usagedb):
+    run(benchmark, rounds, usagedb, usagedb.getstoragegrant, 
+        projectname(0), 'global', 'gdata', 'Scheme', year, quarter)
+
+def test_getjobs(benchmark, rounds, jobsdb):
+    run(benchmark, rounds, jobsdb, jobsdb.getjobs, 
+        startdate - datetime.timedelta(days=7), startdate)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Read only asyncio counterpart of ProjectDataset using SQLAlchemy asyncio,
+with aiosqlite for sqlite and asyncpg for postgresql databases. Queries
+share a bounded connection pool so concurrent callers overlap on I/O
+"""
+
+from __future__ import print_function
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from .UsageDataset import NotInDatabase, outputs, reshape
+from .UsageDataset import usage_query, storage_query, shortusers_query, suusers_query, top_usage_query
+
+async_drivers = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+def async_url(dburl):
+    """
+    Return dburl with the asyncio driver for its database, unless one is given
+    """
+    url = make_url(dburl)
+    if url.drivername in async_drivers:
+        url = url.set(drivername=async_drivers[url.drivername])
+    return url
+
+class AsyncProjectDataset(object):
+
+    def __init__(self, dburl, pool_size=5, timeout=30.):
+        """
+        Connect to dburl with at most pool_size connections. Queries wait up
+        to timeout seconds for a free connection
+        """
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        self.dburl = dburl
+        url = async_url(dburl)
+        kwargs = {}
+        # In memory sqlite databases use a single shared connection
+        if not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+            kwargs = dict(pool_size=pool_size, max_overflow=0, pool_timeout=timeout)
+        self.engine = create_async_engine(url, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def query(self, qstring, **params):
+        """
+        Return the rows of qstring, with named parameters, as a list of dicts
+        """
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text(qstring), params)
+            return [dict(row._mapping) for row in result]
+
+    async def getstartend(self, year, quarter):
+        rows = await self.query('SELECT start_date, end_date FROM "Quarters" WHERE year = :year AND quarter = :quarter',
+                                year=str(year), quarter=quarter)
+        if not rows:
+            raise NotInDatabase('No entries in database for {}.{}'.format(year,quarter))
+        return rows[0]['start_date'], rows[0]['end_date']
+
+    async def getusagegrant(self, project, system, scheme, year, quarter):
+        qstring = """SELECT allocation FROM "UsageGrants"
+        WHERE project_id = (SELECT id FROM "Projects" WHERE project = :project)
+        AND system_id = (SELECT id FROM "Systems" WHERE system = :system)
+        AND scheme_id = (SELECT id FROM "Schemes" WHERE scheme = :scheme)
+        AND quarter_id = (SELECT id FROM "Quarters" WHERE year = :year AND quarter = :quarter)
+        ORDER BY id DESC LIMIT 1"""
+        rows = await self.query(qstring, project=project, system=system, scheme=scheme,
+                                year=str(year), quarter=quarter)
+        if not rows:
+            return None
+        return float(rows[0]['allocation'])
+
+    async def getstoragegrant(self, project, systemname, storagepoint, scheme, year, quarter):
+        qstring = """SELECT capacity, inodes FROM "StorageGrants"
+        WHERE project_id = (SELECT id FROM "Projects" WHERE project = :project)
+        AND system_id = (SELECT id FROM "Systems" WHERE system = :system)
+        AND storagepoint_id = (SELECT "StoragePoints".id FROM "StoragePoints"
+            JOIN "Systems" ON "StoragePoints".system_id = "Systems".id
+            WHERE "Systems".system = :system AND storagepoint = :storagepoint)
+        AND scheme_id = (SELECT id FROM "Schemes" WHERE scheme = :scheme)
+        AND quarter_id = (SELECT id FROM "Quarters" WHERE year = :year AND quarter = :quarter)
+        ORDER BY id LIMIT 1"""
+        rows = await self.query(qstring, project=project, system=systemname, storagepoint=storagepoint,
+                                scheme=scheme, year=str(year), quarter=quarter)
+        if not rows:
+            return (None,None)
+        return float(rows[0]['capacity']),float(rows[0]['inodes'])
+
+    async def getusage(self, year, quarter, datafield='usage_su', namefield='user+name', output='wide'):
+        """
+        See ProjectDataset.getusage
+        """
+        import pandas as pd
+
+        startdate, enddate = await self.getstartend(year, quarter)
+        qstring, params = usage_query(startdate, enddate, datafield, namefield)
+
+        if output not in outputs:
+            raise ValueError('Incorrect value of output: {} Valid values are {}'.format(output, outputs))
+
+        df = pd.DataFrame(await self.query(qstring, **params), columns=['Name', 'Date', 'totsu'])
+        if df.empty:
+            print("No usage data available")
+            return None
+
+        return reshape(df, output)
+
+    async def getstorage(self, project, year, quarter, systemname, storagepoint='scratch', datafield='size', namefield='user+name', output='wide'):
+        """
+        See ProjectDataset.getstorage
+        """
+        import pandas as pd
+
+        startdate, enddate = await self.getstartend(year, quarter)
+        qstring, params = storage_query(startdate, enddate, project, systemname, storagepoint, datafield, namefield)
+
+        if output not in outputs:
+            raise ValueError('Incorrect value of output: {} Valid values are {}'.format(output, outputs))
+
+        df = pd.DataFrame(await self.query(qstring, **params), columns=['Name', 'Date', 'totsize'])
+        if df.empty:
+            print("No data available for {}".format(storagepoint))
+            return None
+
+        df = reshape(df, output)
+        if output != 'wide':
+            return df
+
+        # Reindex to beginning of quarter in case we're missing values from the beginning of the quarter
+        return df.reindex(pd.date_range(startdate,df.index[-1]), method='backfill')
+
+    async def getshortusers(self, year, quarter, project=None, limit=None, storagepoint='scratch'):
+        """
+        See ProjectDataset.getshortusers
+        """
+        startdate, enddate = await self.getstartend(year, quarter)
+        qstring, params = shortusers_query(startdate, enddate, project, limit, storagepoint)
+        return [record['user'] for record in await self.query(qstring, **params)]
+
+    async def getsuusers(self, year, quarter, project=None, limit=None):
+        """
+        See ProjectDataset.getsuusers
+        """
+        startdate, enddate = await self.getstartend(year, quarter)
+        qstring, params = suusers_query(startdate, enddate, project, limit)
+        return [record['user'] for record in await self.query(qstring, **params)]
+
+    async def top_usage(self, year, quarter, storagepoint, measure='size', count=10, scale=1, project=None):
+        """
+        See ProjectDataset.top_usage
+        """
+        import pandas as pd
+
+        startdate, enddate = await self.getstartend(year, quarter)
+        qstring, params = top_usage_query(startdate, enddate, storagepoint, measure, count, project)
+
+        df = pd.DataFrame(await self.query(qstring, **params), columns=['Name', measure])
+
+        return df.set_index('Name')[measure].divide(scale)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Bulk loading of Records into a PostgreSQL ProjectDataset or JobsDataset.
+Facts are streamed in batches with COPY FROM STDIN into a temporary staging
+table, their dimension ids are resolved with joins, and each batch is merged
+into the real table with one UPDATE and one INSERT, which gives the same
+result as the upsert of the dataset add method for every row
+"""
+
+from __future__ import print_function
+
+import datetime
+import io
+
+from .Records import kinds
+
+# Dimensions resolved from the natural keys in the staging table s, in join
+# order, as (id column, table, alias, join condition, add method, natural key
+# columns). The id column is None for tables only needed by later joins
+project = ('project_id', 'Projects', 'p', 'p.project = s.project', 'addproject', ('project',))
+user = ('user_id', 'Users', 'u', 'u."user" = s."user"', 'adduser', ('user',))
+system = ('system_id', 'Systems', 'sy', 'sy.system = s.system', 'addsystem', ('system',))
+storagepoint = ('storagepoint_id', 'StoragePoints', 'sp', 'sp.system_id = sy.id AND sp.storagepoint = s.storagepoint',
+                'addstoragepoint', ('system', 'storagepoint'))
+
+# Facts loaded with COPY, with the table, dimensions, (column, record column)
+# values and the upsert keys used by the dataset add method
+facts = {
+    'userusage': dict(table='UserUsage',
+                      dimensions=[project, user],
+                      values=[('date', 'date'), ('usage_cpu', 'usecpu'), ('usage_wall', 'usewall'),
+                              ('usage_su', 'usesu'), ('efficiency', 'efficiency')],
+                      keys=['project_id', 'user_id', 'date']),
+    'userstorage': dict(table='UserStorage',
+                        dimensions=[project, user, (None,) + system[1:], storagepoint],
+                        values=[('folder', 'folder'), ('scandate', 'scandate'), ('inodes', 'inodes'), ('size', 'size')],
+                        keys=['project_id', 'user_id', 'storagepoint_id', 'folder', 'scandate']),
+    'projectusage': dict(table='ProjectUsage',
+                         dimensions=[project, (None,) + system[1:],
+                                     ('systemqueue_id', 'SystemQueues', 'q', 'q.system_id = sy.id AND q.queue = s.queue',
+                                      'addsystemqueue', ('system', 'queue'))],
+                         values=[('date', 'date'), ('usage_cpu', 'cputime'), ('usage_wall', 'walltime'), ('usage_su', 'su')],
+                         keys=['project_id', 'systemqueue_id', 'date']),
+    'schemeusage': dict(table='SchemeUsage',
+                        dimensions=[project, system,
+                                    ('scheme_id', 'Schemes', 'sc', 'sc.scheme = s.scheme', 'addscheme', ('scheme',))],
+                        values=[('date', 'date'), ('usage_cpu', 'cputime'), ('usage_wall', 'walltime'), ('usage_su', 'su')],
+                        # As in addschemeusage, which has no systemqueue_id, so always inserts
+                        keys=['project_id', 'systemqueue_id', 'scheme_id', 'date']),
+    'projectstorage': dict(table='ProjectStorage',
+                           dimensions=[project, system, storagepoint],
+                           values=[('date', 'date'), ('size', 'size'), ('inodes', 'inodes')],
+                           keys=['project_id', 'system_id', 'storagepoint_id', 'date']),
+    'jobs': dict(table='Jobs',
+                 dimensions=[('project', 'Project', 'p', 'p.project = s.project', 'addproject', ('project',)),
+                             ('queue', 'Queue', 'q', 'q.queue = s.queuename', 'addqueue', ('queuename',)),
+                             ('user', 'User', 'u', 'u.username = s.username', 'adduser', ('username',)),
+                             ('status', 'JobState', 'st', 'st.status = s.status', 'addstate', ('status',)),
+                             ('exe', 'Executable', 'e', 'e.path = s.exe', 'addexe', ('exe',))],
+                 values=[('year', 'year'), ('jobid', 'jobid'), ('jobname', 'jobname'),
+                         ('ctime', 'ctime'), ('mtime', 'mtime'), ('qtime', 'qtime'), ('stime', 'stime'),
+                         ('waitime', 'waitime'), ('maxwalltime', 'maxwalltime'), ('maxmem', 'maxmem'),
+                         ('ncpus', 'ncpus'), ('walltime', 'walltime'), ('mem', 'mem'), ('cputime', 'cputime'),
+                         ('cpuutil', 'cpuutil'), ('exitstatus', 'exitstatus')],
+                 keys=['year', 'jobid']),
+}
+
+# Dimension records, which are only added once however often they occur
+dimensions = ('quarters', 'schemes', 'systemqueues', 'users')
+
+def quote(name):
+    return '"{}"'.format(name)
+
+def csvfield(value):
+    """
+    Format value for COPY in CSV format, where an unquoted empty field is NULL
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace('"', '""'))
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return repr(value) if isinstance(value, float) else str(value)
+
+def copy_from(connection, statement, buffer):
+    """
+    Run the COPY ... FROM STDIN statement on the psycopg2 or psycopg 3
+    connection, with the data in the StringIO buffer
+    """
+    cursor = connection.cursor()
+    if hasattr(cursor, 'copy_expert'):
+        # psycopg2
+        cursor.copy_expert(statement, buffer)
+    else:
+        # psycopg 3
+        with cursor.copy(statement) as copy:
+            copy.write(buffer.getvalue())
+
+class CopyLoader(object):
+
+    def __init__(self, db, batchsize=100000):
+        """
+        Loader for db, a ProjectDataset or JobsDataset, copying at most
+        batchsize facts at a time
+        """
+        self.db = db
+        self.batchsize = batchsize
+
+    def ispostgres(self):
+        return self.db.db.engine.dialect.name == 'postgresql'
+
+    def load(self, records):
+        """
+        Add records to the database in one transaction. Databases other than
+        PostgreSQL are loaded row by row
+        """
+        if not self.ispostgres():
+            records.load(self.db)
+            return
+
+        with self.db.db:
+            for kind, (method, _) in kinds.items():
+                rows = records.rows[kind]
+                if not rows:
+                    continue
+                add = getattr(self.db, method)
+                if kind in dimensions:
+                    rows = list(dict.fromkeys(rows))
+                if kind not in facts:
+                    for row in rows:
+                        add(*row)
+                    continue
+                # Adding the first row creates any missing tables and columns
+                # with the types dataset would use
+                add(*rows[0])
+                for start in range(1, len(rows), self.batchsize):
+                    self.copy(kind, rows[start:start + self.batchsize])
+                self.markdirty(kind, rows[1:])
+
+    def execute(self, statement):
+        return self.db.db.executable.exec_driver_sql(statement)
+
+    def columntypes(self, table):
+        """
+        Return a dict of the SQL type of each column of table
+        """
+        result = self.execute("""SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = '{}'::regclass AND attnum > 0 AND NOT attisdropped""".format(quote(table)))
+        return dict(result.fetchall())
+
+    def copy(self, kind, rows):
+        """
+        Merge rows of the fact kind into its table
+        """
+        spec = facts[kind]
+        table = quote(spec['table'])
+        types = self.columntypes(spec['table'])
+        _, columns = kinds[kind]
+        index = {column: i for i, column in enumerate(columns)}
+
+        # Natural keys are text, values have the type of the column they go in
+        staged = {}
+        for dimension in spec['dimensions']:
+            for column in dimension[5]:
+                staged[column] = 'text'
+        for column, source in spec['values']:
+            staged[source] = types[column]
+
+        self.execute("CREATE TEMPORARY TABLE ncigrafana_stage (seq bigint, {}) ON COMMIT DROP".format(
+                        ', '.join('{} {}'.format(quote(c), t) for c, t in staged.items())))
+        buffer = io.StringIO()
+        for seq, row in enumerate(rows):
+            buffer.write(','.join([str(seq)] + [csvfield(row[index[c]]) for c in staged]))
+            buffer.write('\n')
+        buffer.seek(0)
+        statement = 'COPY ncigrafana_stage (seq, {}) FROM STDIN WITH (FORMAT csv)'.format(
+                        ', '.join(quote(c) for c in staged))
+        copy_from(self.db.db.executable.connection.dbapi_connection, statement, buffer)
+
+        self.adddimensions(spec['dimensions'])
+
+        # Resolve dimension ids with one join, keeping the last row for each key
+        # unless the table lacks a key column, when dataset would insert them all
+        joins = ' '.join('JOIN {} {} ON {}'.format(quote(t), alias, on) for _, t, alias, on, _, _ in spec['dimensions'])
+        selected = (['{}.id AS {}'.format(alias, quote(c)) for c, _, alias, _, _, _ in spec['dimensions'] if c] +
+                    ['s.{} AS {}'.format(quote(source), quote(c)) for c, source in spec['values']])
+        keys = spec['keys']
+        upsert = all(key in types for key in keys)
+        if upsert:
+            select = 'SELECT DISTINCT ON ({keys}) {selected} FROM ncigrafana_stage s {joins} ORDER BY {keys}, s.seq DESC'
+        else:
+            select = 'SELECT {selected} FROM ncigrafana_stage s {joins} ORDER BY s.seq'
+        self.execute('CREATE TEMPORARY TABLE ncigrafana_resolved ON COMMIT DROP AS ' + select.format(
+                        keys=', '.join(quote(k) for k in keys), selected=', '.join(selected), joins=joins))
+
+        targets = [c for c, _, _, _, _, _ in spec['dimensions'] if c] + [c for c, _ in spec['values']]
+        if upsert:
+            match = ' AND '.join('t.{0} = r.{0}'.format(quote(k)) for k in keys)
+            self.execute('UPDATE {} t SET {} FROM ncigrafana_resolved r WHERE {}'.format(
+                            table, ', '.join('{0} = r.{0}'.format(quote(c)) for c in targets if c not in keys), match))
+            self.execute('INSERT INTO {0} ({1}) SELECT {1} FROM ncigrafana_resolved r WHERE NOT EXISTS '
+                         '(SELECT 1 FROM {0} t WHERE {2})'.format(table, ', '.join(quote(c) for c in targets), match))
+        else:
+            self.execute('INSERT INTO {0} ({1}) SELECT {1} FROM ncigrafana_resolved'.format(
+                            table, ', '.join(quote(c) for c in targets)))
+
+        self.execute('DROP TABLE ncigrafana_stage, ncigrafana_resolved')
+
+    def adddimensions(self, dimensions):
+        """
+        Add the dimensions of the staged rows which are not in the database
+        with the dataset add methods, in join order. Raises ValueError if
+        any still cannot be resolved, e.g. because a natural key is NULL
+        """
+        for i, (_, _, alias, _, method, natural) in enumerate(dimensions):
+            joins = ' '.join('LEFT JOIN {} {} ON {}'.format(quote(t), a, on) for _, t, a, on, _, _ in dimensions[:i + 1])
+            missing = self.execute('SELECT DISTINCT {} FROM ncigrafana_stage s {} WHERE {}.id IS NULL'.format(
+                                       ', '.join('s.' + quote(c) for c in natural), joins, alias))
+            for row in missing.fetchall():
+                getattr(self.db, method)(*row)
+
+        joins = ' '.join('LEFT JOIN {} {} ON {}'.format(quote(t), a, on) for _, t, a, on, _, _ in dimensions)
+        unresolved = self.execute('SELECT count(*) FROM ncigrafana_stage s {} WHERE {}'.format(
+                                      joins, ' OR '.join('{}.id IS NULL'.format(a) for _, _, a, _, _, _ in dimensions))).scalar()
+        if unresolved:
+            raise ValueError('Cannot resolve the dimensions of {} rows'.format(unresolved))
+
+    def markdirty(self, kind, rows):
+        """
+        Note the dates written, as the dataset add methods do
+        """
+        _, columns = kinds[kind]
+        index = {column: i for i, column in enumerate(columns)}
+        if kind == 'userusage':
+            for row in rows:
+                self.db._markdirty(('usage',), row[index['date']])
+        elif kind == 'userstorage':
+            for row in rows:
+                self.db._markdirty(('storage',) + tuple(row[index[c]] for c in ('project', 'system', 'storagepoint')),
+                                   row[index['scandate']])
+        elif kind == 'jobs':
+            self.db.dirtydates.update(self.db.date2date(row[index['ctime']]) for row in rows)
@@ -22,10 +22,17 @@ from __future__ import print_function
 
 import datetime
 import gzip
+import json
 import os
 import re
 import shutil
 import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 unit_base = { 'B' : 1024, 'SU' : 1000 }
 
@@ -38,6 +45,23 @@ def extract_num_unit(s):
         sys.exit()
     return float(size), unit
 
+if orjson is not None:
+    json_backend = 'orjson'
+
+    def json_loads(s):
+        """
+        Decode the JSON document s, a str or bytes, with orjson. Documents
+        orjson rejects, e.g. with NaN or very large integers, are decoded by
+        json, so the result is the same whichever is used
+        """
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s)
+else:
+    json_backend = 'json'
+    json_loads = json.loads
+
 def pretty_size(n,pow=0,b=1024,u='B',pre=['']+[p for p in'KMGTPEZY']):
     pow,n=min(int(log(max(n*b**pow,1),b)),len(pre)-1),n*b**pow
     return "%%.%if %%s%%s"%abs(pow%(-pow-1))%(n/b**float(pow),pre[pow],u)
@@ -121,4 +145,161 @@ def date_range_from_quarter(year, quarter):
     return((
             datetime.date(year,lookup[quarter]['smonth'],lookup[quarter]['sday']), 
             datetime.date(year,lookup[quarter]['emonth'],lookup[quarter]['eday'])
-            ))
\ No newline at end of file
+            ))
+
+# Pragmas set on every connection to a SQLite database, by profile name.
+# ingest favours write throughput, readonly lets readers run alongside a
+# writer (the database must already be in WAL mode, which ingest sets)
+sqlite_profiles = {
+    'ingest': [('busy_timeout', 60000), ('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+               ('cache_size', -262144), ('temp_store', 'MEMORY'), ('mmap_size', 1073741824)],
+    'readonly': [('busy_timeout', 10000), ('query_only', 'ON'), ('cache_size', -65536),
+                 ('temp_store', 'MEMORY'), ('mmap_size', 1073741824)],
+}
+
+def sqlite_pragmas(profile):
+    """
+    Return the PRAGMA statements for profile, the name of an entry in
+    sqlite_profiles or a list of (pragma, value) pairs
+    """
+    if isinstance(profile, str):
+        if profile not in sqlite_profiles:
+            raise ValueError('Unknown profile: {} Valid profiles are {}'.format(profile, tuple(sqlite_profiles)))
+        profile = sqlite_profiles[profile]
+    return ['PRAGMA {}={}'.format(pragma, value) for pragma, value in profile]
+
+# Engine pool settings used unless overridden with the pool argument of
+# connect_db. Connections are checked before use and replaced hourly, so
+# servers restarted or failed over under a long running process are survived
+pool_defaults = dict(pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=3600, pool_pre_ping=True)
+
+# dataset databases shared by the datasets of this process, keyed by
+# process id, url, profile and pool settings
+databases = {}
+databases_lock = threading.Lock()
+
+def connect_db(url, profile=None, pool=None):
+    """
+    Connect to the database url with dataset. For SQLite databases the
+    pragmas of profile (see sqlite_pragmas) are set on every pooled
+    connection; no profile keeps the dataset defaults. pool is a dict of
+    engine pool settings overriding pool_defaults. Connections with the same
+    arguments share one database and engine, except for in memory SQLite
+    databases which are private to each connection
+    """
+    from dataset import connect
+    from sqlalchemy.engine import make_url
+
+    parsed = make_url(url)
+    kwargs = {}
+    if parsed.get_backend_name() == 'sqlite':
+        if profile is not None:
+            kwargs = dict(sqlite_wal_mode=False, on_connect_statements=sqlite_pragmas(profile))
+        if parsed.database in (None, '', ':memory:'):
+            return connect(url, **kwargs)
+    settings = dict(pool_defaults, **(pool or {}))
+    kwargs['engine_kwargs'] = settings
+
+    if not isinstance(profile, (str, type(None))):
+        profile = tuple(map(tuple, profile))
+    key = (os.getpid(), url, profile, tuple(sorted(settings.items())))
+    with databases_lock:
+        if key not in databases:
+            databases[key] = connect(url, **kwargs)
+        return databases[key]
+
+def dispose_databases():
+    """
+    Close the connections of every shared database and forget them
+    """
+    with databases_lock:
+        for db in databases.values():
+            db.engine.dispose()
+        databases.clear()
+
+def ensure_indexes(db, indexes):
+    """
+    Create named indexes on any of the tables in the dataset database db
+    that exist. indexes is a dict of lists of column tuples keyed by table
+    name. Safe to call repeatedly
+    """
+    with db:
+        for table, columnlist in indexes.items():
+            if table not in db:
+                continue
+            for columns in columnlist:
+                db.query('CREATE INDEX IF NOT EXISTS "ix_{table}_{name}" ON "{table}" ({columns})'.format(
+                            table=table, 
+                            name='_'.join(columns), 
+                            columns=', '.join('"{}"'.format(c) for c in columns)))
+
+def in_clause(column, name, values, params):
+    """
+    Return an SQL "column IN (...)" condition with a bound parameter for
+    each of values, which are added to the dict params with names
+    starting with name. A single string is treated as a list of one
+    """
+    if isinstance(values, str):
+        values = [values]
+    names = ['{}{}'.format(name, i) for i in range(len(values))]
+    params.update(zip(names, values))
+    return '{} IN ({})'.format(column, ', '.join(':' + n for n in names))
+
+def add_ingest_run(db, source, filename, started, duration, parsed, written, 
+                   stages=None, statements=None, dbtime=None, peak_rss=None, 
+                   error=None, filetime=None, url=None):
+    """
+    Record a parser run in the IngestRuns table of the dataset database db. 
+    stages is a dict of durations by stage name. url is the service read
+    by runs without a file
+    """
+    data = dict(started=started,
+                source=source,
+                filename=filename,
+                url=url,
+                filetime=filetime,
+                duration=float(duration),
+                parsed=parsed,
+                written=written,
+                errors=parsed - written,
+                rows_per_second=written/duration if duration > 0 else None,
+                stages=json.dumps(stages or {}),
+                statements=statements,
+                dbtime=dbtime,
+                peak_rss=peak_rss,
+                error=error)
+    return db['IngestRuns'].insert(data)
+
+def get_ingest_runs(db, source=None, startdate=None, enddate=None):
+    """
+    Return IngestRuns from the dataset database db as a pandas dataframe
+    indexed by start time, with a column per stage duration
+    """
+    import pandas as pd
+
+    if 'IngestRuns' not in db:
+        print("No ingest runs recorded")
+        return None
+
+    # Quoted so PostgreSQL does not fold the name to lower case
+    qstring = 'SELECT * FROM "IngestRuns" WHERE 1=1'
+    params = {}
+    if source is not None:
+        qstring += " AND source = :source"
+        params['source'] = source
+    if startdate is not None:
+        qstring += " AND started >= :start"
+        params['start'] = startdate
+    if enddate is not None:
+        qstring += " AND started <= :end"
+        params['end'] = enddate
+    qstring += " ORDER BY started"
+
+    df = pd.DataFrame(list(db.query(qstring, **params)))
+    if df.empty:
+        return df
+
+    stages = pd.DataFrame([json.loads(s) for s in df.pop('stages')], index=df.index)
+    df = df.join(stages.add_prefix('stage_'))
+    df['started'] = pd.to_datetime(df['started'])
+    return df.set_index('started')
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Read API across many SQLite usage databases, such as the per project
+usage_{project}.db files of ProjectDataset. The databases are attached to
+one connection and queried with a single UNION ALL, in groups no bigger than
+the SQLite attach limit which are queried in parallel, and the results are
+combined into one frame with a project column
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from .DBcommon import in_clause
+from .UsageDataset import usage_query, top_usage_query
+
+def attach_limit():
+    """
+    Return the most databases SQLite allows to be attached to a connection
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        # getlimit is new in python 3.11, so assume the compiled in default
+        return 10
+    finally:
+        conn.close()
+
+# Queries are run on each database with {db} replaced by its schema name.
+# Dates are restricted to the quarter as recorded in that database
+quarter_range = """(SELECT start_date FROM {db}Quarters WHERE year = :year AND quarter = :quarter)
+        AND (SELECT end_date FROM {db}Quarters WHERE year = :year AND quarter = :quarter)"""
+
+storage_query = """SELECT Projects.project AS project, Systems.system AS system,
+    StoragePoints.storagepoint AS storagepoint, date AS Date, size, inodes
+    FROM {db}ProjectStorage
+    JOIN {db}Projects ON ProjectStorage.project_id = Projects.id
+    JOIN {db}Systems ON ProjectStorage.system_id = Systems.id
+    JOIN {db}StoragePoints ON ProjectStorage.storagepoint_id = StoragePoints.id
+    WHERE {storagepoint} AND date = (SELECT MAX(Latest.date) FROM {db}ProjectStorage AS Latest
+        WHERE Latest.project_id = ProjectStorage.project_id
+        AND Latest.storagepoint_id = ProjectStorage.storagepoint_id
+        AND Latest.date BETWEEN {quarter})"""
+
+class FederatedDataset(object):
+
+    def __init__(self, files, workers=4, attachlimit=None):
+        """
+        Query the SQLite databases in files, a glob pattern or a list of
+        paths. Groups of at most attachlimit databases, by default the SQLite
+        limit, are queried by up to workers threads at once
+        """
+        if isinstance(files, str):
+            files = sorted(glob.glob(files))
+        self.files = list(files)
+        self.workers = workers
+        if attachlimit is None:
+            attachlimit = attach_limit()
+        self.attachlimit = attachlimit
+
+    def _groupquery(self, files, qstring, tables, params):
+        """
+        Return the rows of qstring unioned over the databases in files which
+        have all of tables, as a pandas dataframe
+        """
+        import pandas as pd
+
+        conn = sqlite3.connect('file::memory:', uri=True)
+        try:
+            selects = []
+            for i, filename in enumerate(files):
+                schema = 'db{}'.format(i)
+                conn.execute('ATTACH DATABASE ? AS {}'.format(schema),
+                             ('file:{}?mode=ro'.format(quote(os.path.abspath(filename))),))
+                existing = set(row[0] for row in conn.execute(
+                    "SELECT name FROM {}.sqlite_master WHERE type = 'table'".format(schema)))
+                if tables.issubset(existing):
+                    selects.append('SELECT * FROM ({})'.format(qstring.format(db=schema + '.')))
+            if not selects:
+                return None
+            return pd.read_sql_query('\nUNION ALL\n'.join(selects), conn, params=params)
+        finally:
+            conn.close()
+
+    def _query(self, qstring, tables, params, columns):
+        """
+        Return the rows of qstring from every database as a pandas dataframe
+        with columns. qstring refers to tables as {db}Table
+        """
+        import pandas as pd
+
+        groups = [self.files[i:i+self.attachlimit] for i in range(0, len(self.files), self.attachlimit)]
+        if len(groups) > 1:
+            with ThreadPoolExecutor(min(self.workers, len(groups))) as pool:
+                frames = list(pool.map(lambda files: self._groupquery(files, qstring, set(tables), params), groups))
+        else:
+            frames = [self._groupquery(files, qstring, set(tables), params) for files in groups]
+        frames = [df for df in frames if df is not None]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+    def getusage(self, year, quarter, datafield='usage_su', namefield='user+name'):
+        """
+        Return usage by project and user for year and quarter as a (project,
+        Date, Name, totsu) frame, see ProjectDataset.getusage. None if there
+        is no usage
+        """
+        import pandas as pd
+
+        qstring, _ = usage_query(None, None, datafield, namefield, schema='{db}', byproject=True, dates=quarter_range)
+        df = self._query(qstring, ('UserUsage', 'Projects', 'Users', 'Quarters'),
+                         dict(year=str(year), quarter=quarter), ['project', 'Date', 'Name', 'totsu'])
+        if df.empty:
+            print("No usage data available")
+            return None
+
+        df['Date'] = pd.to_datetime(df['Date'], format="%Y-%m-%d")
+        return df.sort_values(['project', 'Date', 'Name']).reset_index(drop=True)
+
+    def top_usage(self, year, quarter, storagepoint, measure='size', count=10, scale=1):
+        """
+        Return the top count users of each project according to measure
+        (either 'size' or 'inodes') on storagepoint (one or a list) for year
+        and quarter, as a (project, Name, measure) frame, largest first. See
+        ProjectDataset.top_usage. None if there is no usage
+        """
+        qstring, params = top_usage_query(None, None, storagepoint, measure, count, schema='{db}',
+                                          byproject=True, dates=quarter_range)
+        params.update(year=str(year), quarter=quarter)
+        df = self._query(qstring, ('UserStorage', 'StoragePoints', 'Users', 'Projects', 'Quarters'),
+                         params, ['project', 'Name', measure])
+        if df.empty:
+            print("No data available for {}".format(storagepoint))
+            return None
+
+        df[measure] = df[measure].astype(float) / scale
+        return df.sort_values(measure, ascending=False, kind='stable').reset_index(drop=True)
+
+    def getstoragetotals(self, year, quarter, storagepoint=None):
+        """
+        Return the latest storage of each project on each storage point (by
+        default all of them) in year and quarter, as a (project, system,
+        storagepoint, Date, size, inodes) frame. None if there is no storage
+        """
+        import pandas as pd
+
+        params = dict(year=str(year), quarter=quarter)
+        where = '1=1'
+        if storagepoint is not None:
+            where = in_clause('StoragePoints.storagepoint', 'storagepoint', storagepoint, params)
+        qstring = storage_query.format(db='{db}', quarter=quarter_range, storagepoint=where)
+        df = self._query(qstring, ('ProjectStorage', 'Projects', 'Systems', 'StoragePoints', 'Quarters'),
+                         params, ['project', 'system', 'storagepoint', 'Date', 'size', 'inodes'])
+        if df.empty:
+            print("No data available for {}".format(storagepoint or 'any storage point'))
+            return None
+
+        df['Date'] = pd.to_datetime(df['Date'], format='ISO8601')
+        return df.sort_values(['project', 'system', 'storagepoint']).reset_index(drop=True)
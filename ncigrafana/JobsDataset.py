@@ -20,22 +20,79 @@ limitations under the License.
 
 from __future__ import print_function
 
-from dataset import connect
+from bisect import bisect_left, bisect_right
 import datetime
+import json
 from pwd import getpwnam
-import pandas as pd
 import sqlalchemy
 
+from .DBcommon import connect_db, ensure_indexes, add_ingest_run, get_ingest_runs, in_clause
+
 class NotInDatabase(Exception):
     pass
 
 class JobsDataset(object):
 
-    def __init__(self, dbfile=None):
+    # Indexes needed by the read API in addition to those created by upsert
+    indexes = {'Jobs': [('status', 'ctime'), ('ctime',)],
+               'JobStatsDaily': [('date',)]}
+
+    def __init__(self, dbfile=None, profile=None, readurl=None, readprofile=None, pool=None):
+        """
+        Connect to the database url dbfile. profile names the SQLite
+        connection settings in DBcommon.sqlite_profiles. The read API queries
+        readurl with readprofile if given, otherwise dbfile. pool overrides
+        DBcommon.pool_defaults
+        """
         if dbfile is None:
             dbfile = 'sqlite:///jobs.db'
         self.dbfile = dbfile
-        self.db = connect(dbfile)
+        self.db = connect_db(dbfile, profile, pool)
+        self.readurl = readurl
+        self.readdb = self.db
+        if readurl is not None:
+            self.readdb = connect_db(readurl, readprofile, pool)
+        # Days with jobs added since the JobStatsDaily rollup was last updated
+        self.dirtydates = set()
+
+    def instrument(self, threshold=None):
+        """
+        Start collecting per-method call, row, time and SQL statement counts.
+        Statements slower than threshold seconds are logged. Returns the
+        Profiler.QueryStats, also available as self.querystats
+        """
+        from .Profiler import QueryStats
+
+        self.uninstrument()
+        self.querystats = QueryStats(self, threshold).enable()
+        return self.querystats
+
+    def uninstrument(self):
+        """
+        Stop collecting query statistics
+        """
+        if getattr(self, 'querystats', None) is not None:
+            self.querystats.disable()
+            self.querystats = None
+
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the read API on existing tables
+        """
+        ensure_indexes(self.db, self.indexes)
+
+    def addingestrun(self, source, filename, started, duration, parsed, written, **kwargs):
+        """
+        Record a parser run in the IngestRuns table. See DBcommon.add_ingest_run
+        """
+        return add_ingest_run(self.db, source, filename, started, duration, parsed, written, **kwargs)
+
+    def getingestruns(self, source=None, startdate=None, enddate=None):
+        """
+        Return the IngestRuns table as a pandas dataframe indexed by start time,
+        optionally for one source and a range of start times
+        """
+        return get_ingest_runs(self.readdb, source, startdate, enddate)
 
     def getnumrecords(self):
         q = None
@@ -57,6 +114,20 @@ class JobsDataset(object):
         data = dict(queue=queuename)
         return self.db['Queue'].upsert(data, list(data.keys()))
 
+    def addchargerate(self, queuename, rate):
+        """
+        Set the SU charged per core hour on queue queuename, used by the
+        JobStatsDaily rollup. Days already in the rollup keep the rate they
+        were computed with until rebuildjobstats is run. Return True if the
+        rate changed
+        """
+        queue = self.db['Queue'].find_one(queue=queuename)
+        if queue is not None and queue.get('chargerate') == float(rate):
+            return False
+        data = dict(queue=queuename, chargerate=float(rate))
+        self.db['Queue'].upsert(data, ['queue'])
+        return True
+
     def addstate(self, status):
         data = dict(status=status)
         return self.db['JobState'].upsert(data, list(data.keys()))
@@ -116,6 +187,8 @@ class JobsDataset(object):
                     exitstatus=exitstatus
                     )
 
+        self.dirtydates.add(self.date2date(ctime))
+
         return self.db['Jobs'].upsert(data, ['year','jobid'])
 
     # Default bin definitions are those use by NCI
@@ -126,6 +199,7 @@ class JobsDataset(object):
         """
         Returns most useful fields as a pandas dataframe
         """
+        import pandas as pd
 
         qstring = """SELECT User.username, User.fullname, Project.project, Queue.queue, JobState.status, ctime, jobname, waitime, maxwalltime, 
         maxmem, ncpus, mem, cputime, cpuutil, exitstatus from Jobs
@@ -135,16 +209,21 @@ class JobsDataset(object):
         LEFT JOIN JobState ON Jobs.status = JobState.id
         """
 
+        conditions = []
+
         # Setting status None will return all jobs regardless of status
         if status is not None:
-            qstring += """WHERE JobState.status = \'{status}\'"""
+            conditions.append("""JobState.status = \'{status}\'""")
 
         # Unless start and end date specified return all records
         if startdate is not None and enddate is not None:
-            qstring += """WHERE ctime between \'{start}\' AND \'{end}\'"""
+            conditions.append("""ctime between \'{start}\' AND \'{end}\'""")
+
+        if conditions:
+            qstring += 'WHERE ' + ' AND '.join(conditions)
 
         try:
-            df = pd.read_sql_query(qstring.format(start=startdate,end=enddate,status=status), self.db.executable)
+            df = pd.read_sql_query(qstring.format(start=startdate,end=enddate,status=status), self.readdb.executable)
         except:
             print("No data available")
             return None
@@ -157,21 +236,225 @@ class JobsDataset(object):
             
         return df
 
+    # Fixed histogram bins used as mergeable quantile sketches in JobStatsDaily.
+    # Wait times (seconds) are log spaced from 1s to ~12 days, cpu utilisation
+    # is linear with a single overflow bin
+    waittimebins = [0.] + [10**(i/4.) for i in range(25)] + [float("inf")]
+    cpuutilbins = [i/20. for i in range(21)] + [float("inf")]
+
+    def updatejobstats(self, dates=None):
+        """
+        Recompute the JobStatsDaily rollup for each day in dates. Defaults to the
+        days touched by addjob since the last update. Finished jobs are counted
+        against the day they were created. SUs are charged at the rates set
+        with addchargerate, a ValueError is raised for jobs on other queues
+        """
+        if dates is None:
+            dates = self.dirtydates
+        dates = sorted(set(self.date2date(d) for d in dates))
+        if not dates:
+            return
+
+        # One query over the range of dates, jobs on days in between which
+        # are not being updated are skipped. Tables are quoted for PostgreSQL
+        chargerate = '"Queue".chargerate' if self.db['Queue'].has_column('chargerate') else 'NULL'
+        qstring = """SELECT substr(CAST(ctime AS TEXT), 1, 10) AS date, "Jobs".project AS project,
+        "Jobs".queue AS queue, "Queue".queue AS queuename, {chargerate} AS chargerate,
+        ncpus, walltime, waitime, cpuutil FROM "Jobs"
+        LEFT JOIN "Queue" ON "Jobs".queue = "Queue".id
+        LEFT JOIN "JobState" ON "Jobs".status = "JobState".id
+        WHERE "JobState".status = 'F' AND ctime >= :start AND ctime < :end
+        """.format(chargerate=chargerate)
+        start, end = dates[0], dates[-1] + datetime.timedelta(days=1)
+        wanted = set(str(date) for date in dates)
+
+        stats = {}
+        unrated = set()
+        table = self.db['JobStatsDaily']
+        with self.db:
+            for job in self.db.query(qstring, start=str(start), end=str(end)):
+                if job['date'] not in wanted:
+                    continue
+                ncpusbin = self.binlabel(job['ncpus'])
+                if ncpusbin is None:
+                    continue
+                key = (job['date'], job['project'], job['queue'], ncpusbin)
+                if key not in stats:
+                    stats[key] = dict(date=key[0], project=key[1], queue=key[2],
+                                      ncpusbin=ncpusbin, count=0, corehours=0., su=0.,
+                                      waittime=0.,
+                                      waittime_hist=[0]*(len(self.waittimebins)-1),
+                                      cpuutil_hist=[0]*(len(self.cpuutilbins)-1))
+                rec = stats[key]
+                # Jobs killed before they started have no walltime or wait
+                # time, count them without any core hours or wait
+                corehours = max(job['walltime'] or 0., 0.) * job['ncpus'] / 3600.
+                rec['count'] += 1
+                rec['corehours'] += corehours
+                if job['chargerate'] is None:
+                    unrated.add(job['queuename'])
+                else:
+                    rec['su'] += corehours * job['chargerate']
+                rec['waittime'] += job['waitime'] or 0.
+                self._histadd(rec['waittime_hist'], self.waittimebins, job['waitime'])
+                self._histadd(rec['cpuutil_hist'], self.cpuutilbins, job['cpuutil'])
+
+            if unrated:
+                raise ValueError('No charge rate for queues: {} Set them with addchargerate'.format(
+                                    ', '.join(sorted(str(q) for q in unrated))))
+
+            if table.exists:
+                table.delete(date={'in': sorted(wanted)})
+            for rec in stats.values():
+                rec['waittime_hist'] = json.dumps(rec['waittime_hist'])
+                rec['cpuutil_hist'] = json.dumps(rec['cpuutil_hist'])
+            table.insert_many(list(stats.values()))
+
+        self.dirtydates.difference_update(dates)
+
+    def rebuildjobstats(self):
+        """
+        Recompute the JobStatsDaily rollup for every day in the Jobs table
+        """
+        qstring = 'SELECT DISTINCT substr(CAST(ctime AS TEXT), 1, 10) AS date FROM "Jobs"'
+        self.updatejobstats([record['date'] for record in self.db.query(qstring)])
+
+    def jobstatscurrent(self, db=None):
+        """
+        Return True if the JobStatsDaily rollup in the read database, or db,
+        spans the same days as the finished jobs. A database with jobs added
+        before the rollup existed is not current until rebuildjobstats is run
+        """
+        if db is None:
+            db = self.readdb
+        if 'Jobs' not in db.tables:
+            return True
+        qstring = """SELECT MIN(ctime) AS first, MAX(ctime) AS last FROM "Jobs"
+        LEFT JOIN "JobState" ON "Jobs".status = "JobState".id
+        WHERE "JobState".status = 'F'"""
+        jobs = next(iter(db.query(qstring)))
+        if jobs['first'] is None:
+            return True
+        if 'JobStatsDaily' not in db.tables:
+            return False
+        stats = next(iter(db.query('SELECT MIN(date) AS first, MAX(date) AS last FROM "JobStatsDaily"')))
+        return (str(stats['first']), str(stats['last'])) == (str(jobs['first'])[:10], str(jobs['last'])[:10])
+
+    def getjobstats(self, startdate=None, enddate=None, projects=None, queues=None):
+        """
+        Return the JobStatsDaily rollup as a pandas dataframe, one row per
+        date, project, queue and ncpus bin. Histogram columns are decoded to lists
+        """
+        import pandas as pd
+
+        if 'JobStatsDaily' not in self.readdb.tables:
+            print("No job statistics available")
+            return None
+
+        qstring = """SELECT date, "Project".project, "Queue".queue, ncpusbin, count, corehours, su,
+        waittime, waittime_hist, cpuutil_hist FROM "JobStatsDaily"
+        LEFT JOIN "Project" ON "JobStatsDaily".project = "Project".id
+        LEFT JOIN "Queue" ON "JobStatsDaily".queue = "Queue".id
+        WHERE 1=1
+        """
+        params = {}
+        if startdate is not None:
+            qstring += " AND date >= :start"
+            params['start'] = str(startdate)
+        if enddate is not None:
+            qstring += " AND date <= :end"
+            params['end'] = str(enddate)
+        if projects is not None:
+            qstring += " AND " + in_clause('"Project".project', 'project', projects, params)
+        if queues is not None:
+            qstring += " AND " + in_clause('"Queue".queue', 'queue', queues, params)
+        qstring += " ORDER BY date"
+
+        df = pd.DataFrame(list(self.readdb.query(qstring, **params)),
+                          columns=['date', 'project', 'queue', 'ncpusbin', 'count', 'corehours', 'su',
+                                   'waittime', 'waittime_hist', 'cpuutil_hist'])
+        df['date'] = pd.to_datetime(df['date'], format="%Y-%m-%d")
+        df['ncpusbin'] = pd.Categorical(df['ncpusbin'], categories=self.ncilabels, ordered=True)
+        for column in ('waittime_hist', 'cpuutil_hist'):
+            df[column] = df[column].map(json.loads)
+        return df
+
+    def getjobquantiles(self, field='waittime', quantiles=(0.5, 0.9), groupby=('queue', 'ncpusbin'), **kwargs):
+        """
+        Estimate quantiles of field ('waittime' or 'cpuutil') from the merged
+        JobStatsDaily histograms, grouped by groupby. Remaining arguments are
+        passed to getjobstats. Returns a pandas dataframe with one column per quantile
+        """
+        import pandas as pd
+
+        if field not in ('waittime', 'cpuutil'):
+            raise ValueError('Incorrect value of field: {} Valid values are "waittime" or "cpuutil"'.format(field))
+        bins = getattr(self, field + 'bins')
+
+        df = self.getjobstats(**kwargs)
+        if df is None or df.empty:
+            return None
+
+        # Histograms are merged by summing counts bin by bin
+        hists = df.groupby(list(groupby), observed=True)[field + '_hist'].agg(
+                    lambda h: tuple(sum(counts) for counts in zip(*h)))
+
+        return pd.DataFrame({q: hists.map(lambda h: self._histquantile(h, bins, q)) for q in quantiles})
+
+    def binlabel(self, ncpus, ncpubins=ncibins, ncpulabels=ncilabels):
+        """
+        Return the label of the ncpus bin, using the same right closed
+        intervals as pd.cut in getjobs. None if outside all bins
+        """
+        if ncpus is None:
+            return None
+        i = bisect_left(ncpubins, ncpus) - 1
+        if i < 0 or i >= len(ncpulabels):
+            return None
+        return ncpulabels[i]
+
+    @staticmethod
+    def _histadd(hist, bins, value):
+        # Values below the first edge (e.g. -1 for unknown cpuutil) are not counted
+        if value is None or value < bins[0]:
+            return
+        hist[min(bisect_right(bins, value) - 1, len(hist) - 1)] += 1
+
+    @staticmethod
+    def _histquantile(hist, bins, q):
+        # Linear interpolation within the bin containing the quantile. The
+        # overflow bin has no upper bound so returns its lower edge
+        total = sum(hist)
+        if total == 0:
+            return float('nan')
+        target = q * total
+        cumulative = 0
+        for i, count in enumerate(hist):
+            if count > 0 and cumulative + count >= target:
+                lower, upper = bins[i], bins[i+1]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+        return bins[-2]
+
     def getuser(self, username=None):
-        return self.db['User'].find_one(username=username)
+        return self.readdb['User'].find_one(username=username)
 
     def getusers(self):
         qstring = "SELECT username FROM User"
-        q = self.db.query(qstring)
+        q = self.readdb.query(qstring)
         for user in q:
             yield user['username']
 
     def getqueue(self, system, queue):
-        return self.db['SystemQueue'].find_one(system=system, queue=queue)
+        return self.readdb['SystemQueue'].find_one(system=system, queue=queue)
 
     def date2date(self, datestring):
 
-        if type(datestring) == datetime.date:
+        if type(datestring) == datetime.datetime:
+            return datestring.date()
+        elif type(datestring) == datetime.date:
             return datestring
         else:
             return datetime.datetime.strptime(datestring, "%Y-%m-%d").date()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Per-stage timing for the command line programs. Stages are measured by
+temporarily wrapping the functions that implement them, and SQL statements
+are counted with SQLAlchemy engine events, so nothing is changed or added
+to the ingestion code paths unless profiling is switched on.
+
+IngestRun provides the always on, much coarser, measurements of each parser
+run which are stored in the database.
+
+QueryStats is the opt in per-method query accounting for ProjectDataset and
+JobsDataset, switched on with their instrument method
+"""
+
+from __future__ import print_function
+
+import contextlib
+import datetime
+import functools
+import importlib
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Functions to time, as (module, attribute, stage). Attributes can be
+# Class.method. Only modules which have already been imported are wrapped
+stages = [
+    ('ncigrafana.parse_user_storage_data', 'file_report_records', 'parse'),
+    ('ncigrafana.parse_account_usage_data', 'account_dump_records', 'parse'),
+    ('ncigrafana.parse_account_usage_data', 'ingest_account_reports', 'parse'),
+    ('ncigrafana.parse_lquota', 'lquota_records', 'parse'),
+    ('ncigrafana.make_jobs_DB', 'qstat_records', 'parse'),
+    ('ncigrafana.Records', 'Records.load', 'load'),
+    ('ncigrafana.nci_account', 'get_resource', 'fetch'),
+    ('ncigrafana.nci_account', 'AccountClient.fetch_all', 'fetch'),
+    ('ncigrafana.parse_user_storage_data', 'json_loads', 'json'),
+    ('ncigrafana.parse_account_usage_data', 'json_loads', 'json'),
+    ('ncigrafana.make_jobs_DB', 'json_loads', 'json'),
+    ('pwd', 'getpwuid', 'passwd'),
+    ('pwd', 'getpwnam', 'passwd'),
+    ('grp', 'getgrgid', 'passwd'),
+    ('ncigrafana.UsageDataset', 'getpwnam', 'passwd'),
+    ('ncigrafana.JobsDataset', 'getpwnam', 'passwd'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.adduser', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addproject', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addquarter', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addsystem', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addstoragepoint', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addscheme', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addsystemqueue', 'dimensions'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addusagegrant', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addstoragegrant', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addschemeusage', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addprojectusage', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.addprojectstorage', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.adduserusage', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.adduserstorage', 'upserts'),
+    ('ncigrafana.UsageDataset', 'ProjectDataset.ensure_indexes', 'indexes'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.adduser', 'dimensions'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.addproject', 'dimensions'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.addqueue', 'dimensions'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.addstate', 'dimensions'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.addexe', 'dimensions'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.addjob', 'upserts'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.updatejobstats', 'rollup'),
+    ('ncigrafana.JobsDataset', 'JobsDataset.ensure_indexes', 'indexes'),
+    ('ncigrafana.parse_user_storage_data', 'archive', 'archive'),
+    ('ncigrafana.parse_account_usage_data', 'archive', 'archive'),
+    ('ncigrafana.parse_lquota', 'archive', 'archive'),
+    ('ncigrafana.make_jobs_DB', 'archive', 'archive'),
+]
+
+class StageStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.
+        self.selftime = 0.
+        self.sql = 0
+        self.sqltime = 0.
+
+class Profiler(object):
+    """
+    Context manager that records wall time and call counts per stage, and
+    SQL statement counts and time, while it is active. Time spent in a
+    stage called from another stage is counted in the total of both, but
+    only in the self time of the innermost. If pstatsfile is given the
+    whole run is also profiled with cProfile and the stats saved there
+    """
+
+    def __init__(self, stages=stages, pstatsfile=None):
+        self.stages = stages
+        self.pstatsfile = pstatsfile
+        self.stats = {}
+        self.stack = []
+        self.patched = []
+        self.sqlcount = 0
+        self.sqltime = 0.
+        self.walltime = 0.
+        self.cprofile = None
+
+    def __enter__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        for modulename, attribute, stage in self.stages:
+            self._patch(modulename, attribute, stage)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+
+        if self.pstatsfile is not None:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.walltime = time.perf_counter() - self.start
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.pstatsfile)
+
+        event.remove(Engine, 'before_cursor_execute', self._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def _patch(self, modulename, attribute, stage):
+        if modulename not in sys.modules:
+            return
+        owner = importlib.import_module(modulename)
+        *path, name = attribute.split('.')
+        for part in path:
+            owner = getattr(owner, part, None)
+        if owner is None or not hasattr(owner, name):
+            return
+        original = getattr(owner, name)
+        # Use the class dict so staticmethods etc are restored exactly
+        if isinstance(owner, type):
+            original = owner.__dict__.get(name, original)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, self._timed(getattr(owner, name), stage))
+
+    def _timed(self, function, stage):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self._enter(stage)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit()
+        return wrapper
+
+    def _enter(self, stage):
+        now = time.perf_counter()
+        if self.stack:
+            parent = self.stack[-1]
+            self.stats[parent[0]].selftime += now - parent[2]
+        self.stats.setdefault(stage, StageStats()).calls += 1
+        # (stage, entry time, time self timing last resumed)
+        self.stack.append([stage, now, now])
+
+    def _exit(self):
+        now = time.perf_counter()
+        stage, entered, resumed = self.stack.pop()
+        self.stats[stage].total += now - entered
+        self.stats[stage].selftime += now - resumed
+        if self.stack:
+            self.stack[-1][2] = now
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiler_start'].pop()
+        self.sqlcount += 1
+        self.sqltime += elapsed
+        if self.stack:
+            stats = self.stats[self.stack[-1][0]]
+            stats.sql += 1
+            stats.sqltime += elapsed
+
+    def summary(self, file=None):
+        """
+        Print a table of the time spent in each stage, ordered by self time
+        """
+        if file is None:
+            file = sys.stdout
+        fmt = '{:<12} {:>8} {:>10} {:>10} {:>8} {:>10}'
+        print(fmt.format('stage', 'calls', 'total (s)', 'self (s)', 'SQL', 'SQL (s)'), file=file)
+        for stage, stats in sorted(self.stats.items(), key=lambda s: -s[1].selftime):
+            print(fmt.format(stage, stats.calls, '{:.3f}'.format(stats.total), '{:.3f}'.format(stats.selftime),
+                             stats.sql, '{:.3f}'.format(stats.sqltime)), file=file)
+        print('Wall time {:.3f}s, {} SQL statements taking {:.3f}s'.format(self.walltime, self.sqlcount,
+                                                                          self.sqltime), file=file)
+        if self.pstatsfile is not None:
+            print('cProfile statistics saved to {}'.format(self.pstatsfile), file=file)
+
+class IngestRun(object):
+    """
+    Context manager recording one parser run of filename from source into
+    the IngestRuns table of db, a ProjectDataset or JobsDataset. Runs read
+    from a service rather than a file give its url, and filename None. Set
+    parsed and written on the run, and time stages with run.stage(name). Any
+    exception is recorded and then propagated, otherwise error if set
+    """
+
+    def __init__(self, db, source, filename=None, url=None):
+        self.db = db
+        self.source = source
+        self.filename = filename
+        self.url = url
+        self.parsed = 0
+        self.written = 0
+        self.error = None
+        self.stages = {}
+        self.statements = 0
+        self.dbtime = 0.
+
+    def __enter__(self):
+        from sqlalchemy import event
+
+        self.engine = self.db.db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._before_execute)
+        event.listen(self.engine, 'after_cursor_execute', self._after_execute)
+        self.filetime = None
+        if self.filename is not None and os.path.exists(self.filename):
+            self.filetime = datetime.datetime.fromtimestamp(os.path.getmtime(self.filename))
+            self.filename = os.path.abspath(self.filename)
+        self.started = datetime.datetime.now()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        from sqlalchemy import event
+
+        duration = time.perf_counter() - self.start
+        event.remove(self.engine, 'before_cursor_execute', self._before_execute)
+        event.remove(self.engine, 'after_cursor_execute', self._after_execute)
+
+        try:
+            self.db.addingestrun(self.source, 
+                                 self.filename, 
+                                 self.started, 
+                                 duration, 
+                                 self.parsed, 
+                                 self.written,
+                                 stages=self.stages,
+                                 statements=self.statements,
+                                 dbtime=self.dbtime,
+                                 # ru_maxrss is in kilobytes on Linux
+                                 peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                                 error=self.error if exc_value is None else repr(exc_value),
+                                 filetime=self.filetime,
+                                 url=self.url)
+        except Exception as e:
+            print("Error recording ingest run for ", self.filename or self.url)
+            print(e)
+
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Add the time spent in the with block to the duration of stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('ingestrun_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        self.dbtime += time.perf_counter() - conn.info['ingestrun_start'].pop()
+
+class QueryStats(object):
+    """
+    Per-method query accounting for a dataset (a ProjectDataset or
+    JobsDataset). Each public method of the dataset instance is wrapped to
+    count calls, returned rows (for results with a length) and cumulative
+    time. SQL statements and their time are counted against the innermost
+    dataset method that issued them, so per row lookups show up as a high
+    statement count per call. Statements slower than threshold seconds are
+    logged with their parameters and kept in slowqueries
+    """
+
+    fields = ['calls', 'rows', 'time', 'statements', 'sqltime']
+
+    def __init__(self, dataset, threshold=None):
+        self.dataset = dataset
+        self.threshold = threshold
+        self.methods = {}
+        self.slowqueries = []
+        self.local = threading.local()
+        self.wrapped = []
+
+    def enable(self):
+        from sqlalchemy import event
+
+        cls = type(self.dataset)
+        for name, attribute in vars(cls).items():
+            if name.startswith('_') or name in ('instrument', 'uninstrument') or not callable(attribute):
+                continue
+            # Wrap the bound method on the instance, leaving the class untouched
+            setattr(self.dataset, name, self._timed(getattr(self.dataset, name), name))
+            self.wrapped.append(name)
+
+        # The read API may use a separate engine
+        self.engines = [self.dataset.db.engine]
+        readdb = getattr(self.dataset, 'readdb', self.dataset.db)
+        if readdb.engine is not self.dataset.db.engine:
+            self.engines.append(readdb.engine)
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+        return self
+
+    def disable(self):
+        from sqlalchemy import event
+
+        for name in self.wrapped:
+            delattr(self.dataset, name)
+        self.wrapped = []
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _counters(self, name):
+        if name not in self.methods:
+            self.methods[name] = dict.fromkeys(self.fields, 0)
+        return self.methods[name]
+
+    def _timed(self, method, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stack = self._stack()
+            stack.append(name)
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                stack.pop()
+                counters = self._counters(name)
+                counters['calls'] += 1
+                counters['time'] += time.perf_counter() - start
+            if result is not None:
+                counters['rows'] += len(result) if hasattr(result, '__len__') else 1
+            return result
+        return wrapper
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('querystats_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['querystats_start'].pop()
+        stack = self._stack()
+        # Statements issued outside of any dataset method, e.g. db.db.query
+        method = stack[-1] if stack else None
+        counters = self._counters(method)
+        counters['statements'] += 1
+        counters['sqltime'] += elapsed
+        if self.threshold is not None and elapsed >= self.threshold:
+            self.slowqueries.append(dict(method=method, statement=statement, 
+                                         parameters=parameters, time=elapsed))
+            logger.warning('Slow query (%.3fs) in %s: %s %s', elapsed, method, statement, parameters)
+
+    def asdict(self):
+        """
+        Return counters as a dict of dicts keyed by method name
+        """
+        return {name: dict(counters) for name, counters in self.methods.items()}
+
+    def asdataframe(self):
+        """
+        Return counters as a pandas dataframe indexed by method name, with
+        the most statements first
+        """
+        import pandas as pd
+
+        df = pd.DataFrame.from_dict(self.asdict(), orient='index', columns=self.fields)
+        df.index.name = 'method'
+        return df.sort_values('statements', ascending=False)
+
+    def reset(self):
+        self.methods = {}
+        self.slowqueries = []
+
+def add_profile_arguments(parser):
+    """
+    Add the profiling options to an argparse parser
+    """
+    parser.add_argument("--profile", help="Print time spent in each stage of processing", action='store_true')
+    parser.add_argument("--profile-output", help="Also save cProfile statistics to this file", default=None)
+
+def profiled(main, args):
+    """
+    Call main(args), with profiling if requested in args
+    """
+    if not args.profile and args.profile_output is None:
+        return main(args)
+    profiler = Profiler(pstatsfile=args.profile_output)
+    with profiler:
+        result = main(args)
+    profiler.summary()
+    return result
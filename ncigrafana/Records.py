@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Normalised records produced by the parsers, kept separate from loading
+them into a database. Records can be written to and read from a directory
+of Arrow IPC or Parquet files, one per kind of record, using pyarrow
+"""
+
+from __future__ import print_function
+
+import json
+import os
+
+formats = ('parquet', 'arrow')
+
+# Kinds of record in the order they are loaded, with the dataset method that
+# loads each one and its columns, which are the arguments of that method
+kinds = {
+    'quarters': ('addquarter', ('year', 'quarter', 'startdate', 'enddate')),
+    'schemes': ('addscheme', ('scheme',)),
+    'systemqueues': ('addsystemqueue', ('system', 'queue', 'weight')),
+    'users': ('adduser', ('user',)),
+    'usagegrants': ('addusagegrant', ('project', 'system', 'scheme', 'year', 'quarter', 'date', 'allocation')),
+    'storagegrants': ('addstoragegrant', ('project', 'system', 'storagepoint', 'scheme', 'year', 'quarter',
+                                          'date', 'storagetype', 'grant')),
+    'schemeusage': ('addschemeusage', ('project', 'system', 'scheme', 'date', 'cputime', 'walltime', 'su')),
+    'projectusage': ('addprojectusage', ('project', 'system', 'queue', 'date', 'cputime', 'walltime', 'su')),
+    'projectstorage': ('addprojectstorage', ('project', 'system', 'storagepoint', 'date', 'size', 'inodes')),
+    'userusage': ('adduserusage', ('project', 'user', 'date', 'usecpu', 'usewall', 'usesu', 'efficiency')),
+    'userstorage': ('adduserstorage', ('project', 'user', 'system', 'storagepoint', 'scandate', 'folder',
+                                       'size', 'inodes')),
+    'jobs': ('addjob', ('year', 'queuename', 'jobid', 'project', 'username',
+                        'status', 'jobname', 'jobprio', 'exe', 'arguments',
+                        'ctime', 'mtime', 'qtime', 'stime', 'waitime',
+                        'maxwalltime', 'maxmem', 'ncpus',
+                        'walltime', 'mem', 'cputime', 'cpuutil', 'exitstatus')),
+}
+
+class Records(object):
+
+    def __init__(self, source, filename):
+        """
+        Records parsed from filename by the parser for source, e.g. 'lquota'.
+        parsed and accepted count the entries read and those that gave records
+        """
+        self.source = source
+        self.filename = filename
+        self.parsed = 0
+        self.accepted = 0
+        self.rows = {kind: [] for kind in kinds}
+
+    def add(self, kind, *row):
+        """
+        Add a row of kind, with values in the order of its columns
+        """
+        self.rows[kind].append(row)
+
+    @property
+    def rejected(self):
+        """
+        Number of entries read that could not be parsed
+        """
+        return self.parsed - self.accepted
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+    def load(self, db, copy=False):
+        """
+        Add the records to db, a ProjectDataset or JobsDataset. With copy
+        PostgreSQL databases are loaded in bulk by a CopyLoader
+        """
+        if copy:
+            from .CopyLoader import CopyLoader
+            CopyLoader(db).load(self)
+            return
+
+        for kind, (method, _) in kinds.items():
+            if not self.rows[kind]:
+                continue
+            add = getattr(db, method)
+            for row in self.rows[kind]:
+                add(*row)
+
+    def table(self, kind):
+        """
+        Return the rows of kind as a pyarrow Table
+        """
+        import pyarrow as pa
+
+        _, columns = kinds[kind]
+        rows = self.rows[kind]
+        return pa.Table.from_pydict({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+
+    def write(self, directory, format='parquet'):
+        """
+        Write a file for each kind of record in directory, which is created
+        if needed, in Parquet or Arrow IPC format. Returns the directory
+        """
+        import pyarrow as pa
+
+        if format not in formats:
+            raise ValueError('Incorrect value of format: {} Valid values are {}'.format(format, formats))
+
+        os.makedirs(directory, exist_ok=True)
+        metadata = {b'ncigrafana': json.dumps(dict(source=self.source, filename=self.filename,
+                                                   parsed=self.parsed, accepted=self.accepted)).encode()}
+        # Always write one file, so the counts are kept even with no records
+        for kind in [kind for kind in kinds if self.rows[kind]] or ['quarters']:
+            table = self.table(kind)
+            table = table.replace_schema_metadata(metadata)
+            path = os.path.join(directory, '{}.{}'.format(kind, format))
+            if format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, path)
+            else:
+                with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        return directory
+
+    @classmethod
+    def read(cls, directory):
+        """
+        Return the Records written to directory by write
+        """
+        import pyarrow as pa
+
+        records = None
+        for filename in sorted(os.listdir(directory)):
+            kind, format = os.path.splitext(filename)
+            if kind not in kinds or format[1:] not in formats:
+                continue
+            path = os.path.join(directory, filename)
+            if format == '.parquet':
+                import pyarrow.parquet as pq
+                table = pq.read_table(path)
+            else:
+                with pa.memory_map(path) as source:
+                    table = pa.ipc.open_file(source).read_all()
+            if records is None:
+                info = json.loads(table.schema.metadata[b'ncigrafana'])
+                records = cls(info['source'], info['filename'])
+                records.parsed, records.accepted = info['parsed'], info['accepted']
+            _, columns = kinds[kind]
+            records.rows[kind] = list(zip(*(table.column(column).to_pylist() for column in columns)))
+
+        if records is None:
+            raise ValueError('No records found in {}'.format(directory))
+        return records
+
+def add_records_arguments(parser):
+    """
+    Add options for writing records instead of loading a database, or for
+    how they are loaded, to the argparse parser of a command line program
+    """
+    parser.add_argument("-o", "--output",
+                        help="write parsed records to a directory for each input in OUTPUT instead of a database",
+                        default=None)
+    parser.add_argument("-f", "--format", help="file format for --output", choices=formats, default='parquet')
+    parser.add_argument("--copy", help="load PostgreSQL databases in bulk with COPY", action='store_true')
+
+def records_directory(output, filename):
+    """
+    Return the directory in output for the records parsed from filename
+    """
+    return os.path.join(output, os.path.basename(filename) + '.records')
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+On disk cache of per-user usage. Each cube is a dates x users float64 array
+saved as a .npy file, with a JSON sidecar holding the dates and users, and
+is read back with a memory map so building a frame from it copies nothing.
+The sidecar also holds a stamp, which ProjectDataset compares with the
+database to tell whether the cube is up to date. ProjectDataset keeps one cube per measure for each quarter of getusage and
+each project, storage point and quarter of getstorage
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+class UsageCube(object):
+
+    def __init__(self, path):
+        """
+        Cube stored in path.npy and path.json. Loaded if it exists
+        """
+        self.path = path
+        self.dates = []
+        self.users = []
+        self.data = None
+        self.stamp = None
+        if os.path.exists(self.npyfile) and os.path.exists(self.jsonfile):
+            self.load()
+
+    @property
+    def npyfile(self):
+        return self.path + '.npy'
+
+    @property
+    def jsonfile(self):
+        return self.path + '.json'
+
+    @property
+    def lastdate(self):
+        """
+        Most recent date in the cube as an ISO date string, None if empty
+        """
+        return self.dates[-1] if self.dates else None
+
+    def load(self):
+        with open(self.jsonfile) as f:
+            meta = json.load(f)
+        data = np.load(self.npyfile, mmap_mode='r')
+        # The array is renamed into place before its sidecar, so if the file
+        # still has the inode the sidecar records the array mapped is the one
+        # it describes. Otherwise another writer replaced it after the
+        # sidecar was read, treat as empty so the cube is rebuilt
+        if (os.stat(self.npyfile).st_ino != meta.get('inode')
+                or data.shape != (len(meta['dates']), len(meta['users']))):
+            self.dates, self.users, self.data, self.stamp = [], [], None, None
+            return
+        self.dates = meta['dates']
+        self.users = [tuple(user) for user in meta['users']]
+        self.data = data
+        self.stamp = meta.get('stamp')
+
+    def update(self, rows, stamp=None, replace=False):
+        """
+        Merge rows of (date, user, fullname, value). Every date in rows
+        replaces the existing values for that date, other dates are kept
+        unless replace is True. stamp is saved with the cube
+        """
+        rows = [(str(date)[:10], user, fullname, value) for date, user, fullname, value in rows]
+        if replace:
+            self.dates, self.users, self.data = [], [], None
+        elif not rows:
+            if self.data is not None and stamp != self.stamp:
+                self.save(self.dates, self.users, np.asarray(self.data), stamp)
+            return
+
+        fullnames = dict(self.users)
+        fullnames.update((row[1], row[2]) for row in rows)
+        dates = sorted(set(self.dates).union(row[0] for row in rows))
+        # In the order of the columns of ProjectDataset.getusage
+        users = sorted(fullnames, key=lambda user: label(user, fullnames[user]))
+        dateindex = {date: i for i, date in enumerate(dates)}
+        userindex = {user: i for i, user in enumerate(users)}
+
+        data = np.zeros((len(dates), len(users)))
+        if self.data is not None:
+            data[np.ix_([dateindex[date] for date in self.dates],
+                        [userindex[user] for user, _ in self.users])] = self.data
+
+        if rows:
+            rowindex = np.array([dateindex[row[0]] for row in rows])
+            colindex = np.array([userindex[row[1]] for row in rows])
+            data[np.unique(rowindex)] = 0.
+            np.add.at(data, (rowindex, colindex), np.array([row[3] for row in rows], dtype=np.float64))
+
+        users = [(user, fullnames[user]) for user in users]
+        self.save(dates, users, data, stamp)
+
+    def save(self, dates, users, data, stamp=None):
+        """
+        Replace the cube files, each written to a temporary file and renamed
+        into place. The sidecar, written last, records the inode of the array
+        it describes
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        prefix = os.path.basename(self.path) + '.'
+        # Release the map of the old array before replacing it
+        self.data = None
+        fd, npytmp = tempfile.mkstemp(suffix='.npy', prefix=prefix, dir=directory or None)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+            inode = os.fstat(f.fileno()).st_ino
+        fd, jsontmp = tempfile.mkstemp(suffix='.json', prefix=prefix, dir=directory or None)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'dates': dates, 'users': users, 'stamp': stamp, 'inode': inode}, f)
+        os.replace(npytmp, self.npyfile)
+        os.replace(jsontmp, self.jsonfile)
+        self.load()
+
+    def frame(self, namefield='user+name'):
+        """
+        Return the cube as a pandas dataframe indexed by date with a column per
+        user, labelled and ordered as ProjectDataset.getusage does. The memory
+        map is used directly unless the columns need reordering
+        """
+        import pandas as pd
+
+        if namefield == 'user+name':
+            columns = [label(user, fullname) for user, fullname in self.users]
+        elif namefield == 'user':
+            columns = [user for user, fullname in self.users]
+        else:
+            raise ValueError('Incorrect value of namefield: {} Valid values are "user+name" or "user"'.format(namefield))
+
+        df = pd.DataFrame(self.data,
+                          index=pd.DatetimeIndex(pd.to_datetime(self.dates, format="%Y-%m-%d"), name='Date'),
+                          columns=pd.Index(columns, name='Name'),
+                          copy=False)
+        if columns != sorted(columns):
+            df = df[sorted(columns)]
+        return df
+
+def label(user, fullname):
+    """
+    Column label of user for the 'user+name' namefield
+    """
+    return '{} ({})'.format(fullname or '', user)
@@ -22,23 +22,288 @@ from __future__ import print_function
 
 import datetime
 import math
+import os
 from pwd import getpwnam
 
-from dataset import connect
-import pandas as pd
+from .DBcommon import connect_db, ensure_indexes, add_ingest_run, get_ingest_runs, in_clause, datetoyearquarter
 
 class NotInDatabase(Exception):
     pass
 
+outputs = ('wide', 'sparse', 'long')
+
+def reshape(df, output='wide'):
+    """
+    Reshape a (Name, Date, value) dataframe of observations to a dense
+    dates x names frame ('wide'), the same with zero-filled sparse columns
+    ('sparse'), or a (Date, Name, value) frame with categorical names ('long').
+    The date index of 'sparse' and 'long' only includes dates with observations
+    """
+    import numpy as np
+    import pandas as pd
+
+    if output not in outputs:
+        raise ValueError('Incorrect value of output: {} Valid values are {}'.format(output, outputs))
+
+    value = df.columns[2]
+    if output == 'wide':
+        # Pivot makes columns of all the individuals, rows are indexed by date
+        df = df.pivot_table(index='Date', columns='Name', fill_value=0)
+        # Get rid of the value labels in the multiindex
+        df.columns = df.columns.get_level_values(1)
+        # Convert date index from labels to datetime objects 
+        df.index = pd.to_datetime(df.index, format="%Y-%m-%d")
+        return df
+
+    df = df[['Date', 'Name', value]].assign(Date=pd.to_datetime(df['Date'], format="%Y-%m-%d"),
+                                            Name=df['Name'].astype('category'))
+    if output == 'long':
+        return df.sort_values(['Date', 'Name']).reset_index(drop=True)
+
+    # Build each column from its non-zero observations, one column at a time,
+    # so memory scales with those and the dates rather than names x dates
+    index = pd.DatetimeIndex(df['Date'].unique()).sort_values()
+    df = df[df[value] != 0].assign(row=lambda d: index.get_indexer(d['Date']))
+    columns = {}
+    for name, group in df.groupby('Name', observed=False):
+        column = np.zeros(len(index))
+        column[group['row'].values] = group[value].values.astype(float)
+        columns[name] = pd.arrays.SparseArray(column, fill_value=0.)
+    df = pd.DataFrame(columns, index=index)
+    df.columns.name = 'Name'
+    df.index.name = 'Date'
+    return df
+
+# SQL for the Name column of the read API by namefield. Tables, and columns
+# which are keywords, are quoted and names joined with || so the same SQL
+# runs on SQLite and PostgreSQL
+namefields = {'user+name': """COALESCE("Users".fullname, '') || ' (' || "Users"."user" || ')'""",
+              'user': '"Users"."user"'}
+
+def name_sql(namefield):
+    """
+    Return the SQL for the Name column of namefield, 'user+name' or 'user'
+    """
+    if namefield not in namefields:
+        raise ValueError('Incorrect value of namefield: {} Valid values are "user+name" or "user"'.format(namefield))
+    return namefields[namefield]
+
+def usage_query(startdate, enddate, datafield='usage_su', namefield='user+name',
+                schema='', byproject=False, dates=':start AND :end'):
+    """
+    Return SQL and parameters for ProjectDataset.getusage. Tables are
+    prefixed with schema, byproject adds a project column and dates is the
+    SQL for the range of dates
+    """
+    name = name_sql(namefield)
+    if datafield not in ProjectDataset.usagefields:
+        raise ValueError('Incorrect value of datafield: {} Valid values are "usage_su", "usage_wall" or "usage_cpu"'.format(datafield))
+
+    params = dict(start=startdate, end=enddate)
+    project, join, group = '', '', ''
+    if byproject:
+        project = '"Projects".project AS project, '
+        join = '\n    JOIN {}"Projects" ON "UserUsage".project_id = "Projects".id'.format(schema)
+        group = '"Projects".project, '
+    qstring = """SELECT {project}{name} AS "Name", "UserUsage".date AS "Date", SUM("UserUsage".{datafield}) AS totsu
+    FROM {schema}"UserUsage"{join}
+    LEFT JOIN {schema}"Users" ON "UserUsage".user_id = "Users".id
+    WHERE "UserUsage".date BETWEEN {dates}
+    GROUP BY {group}{name}, "UserUsage".date
+    ORDER BY "Date"
+    """.format(project=project, name=name, datafield=datafield, schema=schema, join=join, dates=dates, group=group)
+    return qstring, params
+
+# SQL restricting UserStorage to the :project, :system and :storagepoint
+# parameters, looked up by name so reads do not add them
+storage_sql = """"UserStorage".project_id = (SELECT id FROM "Projects" WHERE project = :project)
+    AND "UserStorage".storagepoint_id = (SELECT "StoragePoints".id FROM "StoragePoints"
+        JOIN "Systems" ON "StoragePoints".system_id = "Systems".id
+        WHERE "Systems".system = :system AND "StoragePoints".storagepoint = :storagepoint)"""
+
+def storage_query(startdate, enddate, project, systemname, storagepoint, datafield='size', namefield='user+name'):
+    """
+    Return SQL and parameters for ProjectDataset.getstorage
+    """
+    name = name_sql(namefield)
+    if datafield not in ProjectDataset.storagefields:
+        raise ValueError('Incorrect value of datafield: {} Valid values are "inodes" or "size"'.format(datafield))
+
+    # scandate is stored as a 'YYYY-MM-DD' string, see parse_user_storage_data,
+    # so the range is too
+    params = dict(start=str(startdate), end=str(enddate), project=project, system=systemname, storagepoint=storagepoint)
+    qstring = """SELECT {name} AS "Name", "UserStorage".scandate AS "Date", SUM("UserStorage".{datafield}) AS totsize
+    FROM "UserStorage"
+    LEFT JOIN "Users" ON "UserStorage".user_id = "Users".id
+    WHERE "UserStorage".scandate BETWEEN :start AND :end
+    AND {storage}
+    GROUP BY {name}, "UserStorage".scandate
+    ORDER BY "Date"
+    """.format(name=name, datafield=datafield, storage=storage_sql)
+    return qstring, params
+
+def shortusers_query(startdate, enddate, project=None, limit=None, storagepoint='scratch'):
+    """
+    Return SQL and parameters for ProjectDataset.getshortusers
+    """
+    params = dict(start=str(startdate), end=str(enddate), storagepoint=storagepoint)
+    qstring = """SELECT "Users"."user" AS "user" FROM "UserStorage"
+    JOIN "Users" ON "UserStorage".user_id = "Users".id
+    JOIN "StoragePoints" ON "UserStorage".storagepoint_id = "StoragePoints".id
+    JOIN "Projects" ON "UserStorage".project_id = "Projects".id
+    WHERE scandate between :start AND :end 
+    AND "StoragePoints".storagepoint = :storagepoint"""
+    if project is not None:
+        qstring += " AND " + in_clause('"Projects".project', 'project', project, params)
+    qstring += ' GROUP BY "Users"."user" ORDER BY SUM(size) desc'
+    if limit is not None:
+        qstring += " LIMIT :limit"
+        params['limit'] = int(limit)
+    return qstring, params
+
+def suusers_query(startdate, enddate, project=None, limit=None):
+    """
+    Return SQL and parameters for ProjectDataset.getsuusers
+    """
+    params = dict(start=startdate, end=enddate)
+    qstring = """SELECT "Users"."user" AS "user", MAX(usage_su) as maxsu FROM "UserUsage"
+    JOIN "Users" ON "UserUsage".user_id = "Users".id
+    JOIN "Projects" ON "UserUsage".project_id = "Projects".id
+    WHERE date between :start AND :end"""
+    if project is not None:
+        qstring += " AND " + in_clause('"Projects".project', 'project', project, params)
+    qstring += ' GROUP BY "Users"."user" ORDER BY maxsu desc'
+    if limit is not None:
+        qstring += " LIMIT :limit"
+        params['limit'] = int(limit)
+    return qstring, params
+
+def top_usage_query(startdate, enddate, storagepoint, measure='size', count=10, project=None,
+                    schema='', byproject=False, dates=':start AND :end'):
+    """
+    Return SQL and parameters for ProjectDataset.top_usage. Tables are
+    prefixed with schema, byproject gives the top count users of each
+    project with a project column and dates is the SQL for the range of
+    scan dates
+    """
+    if measure not in ['size', 'inodes']:
+        raise ValueError(f"Unexpected measure '{measure}'")
+
+    params = dict(start=str(startdate), end=str(enddate), count=int(count))
+
+    where = ["scandate between {}".format(dates),
+             in_clause('"StoragePoints".storagepoint', 'storagepoint', storagepoint, params)]
+    if project is not None:
+        where.append(in_clause('"Projects".project', 'project', project, params))
+
+    # Rank the scans for each user, project and storage point so only the
+    # most recent one is summed, then rank users in the database
+    qstring = """WITH Scans AS (
+        SELECT user_id, project_id, SUM({measure}) AS total, ROW_NUMBER() OVER (
+            PARTITION BY user_id, project_id, storagepoint_id ORDER BY scandate DESC) AS rownum
+        FROM {schema}"UserStorage"
+        JOIN {schema}"StoragePoints" ON "UserStorage".storagepoint_id = "StoragePoints".id
+        JOIN {schema}"Projects" ON "UserStorage".project_id = "Projects".id
+        WHERE {where}
+        GROUP BY user_id, project_id, storagepoint_id, scandate
+    )"""
+    if byproject:
+        # or within each project
+        qstring += """
+    SELECT project, "Name", {measure} FROM (
+        SELECT "Projects".project AS project, {name} AS "Name", SUM(total) AS {measure},
+            ROW_NUMBER() OVER (PARTITION BY "Projects".id ORDER BY SUM(total) DESC) AS userrank
+        FROM Scans
+        JOIN {schema}"Users" ON Scans.user_id = "Users".id
+        JOIN {schema}"Projects" ON Scans.project_id = "Projects".id
+        WHERE rownum = 1
+        GROUP BY "Projects".id, "Users".id
+    ) AS Ranked
+    WHERE userrank <= :count"""
+    else:
+        qstring += """
+    SELECT {name} AS "Name", SUM(total) AS {measure}
+    FROM Scans
+    JOIN {schema}"Users" ON Scans.user_id = "Users".id
+    WHERE rownum = 1
+    GROUP BY "Users".id
+    ORDER BY {measure} DESC
+    LIMIT :count"""
+    qstring = qstring.format(measure=measure, where=' AND '.join(where), schema=schema,
+                             name=namefields['user+name'])
+    return qstring, params
+
 class ProjectDataset(object):
 
-    def __init__(self, project=None, dburl=None):
+    # Indexes needed by the read API in addition to those created by upsert
+    indexes = {'UserUsage': [('date',)],
+               'UserStorage': [('project_id', 'storagepoint_id', 'scandate')],
+               'SchemeUsage': [('project_id', 'system_id', 'scheme_id', 'date')]}
+
+    def __init__(self, project=None, dburl=None, cachedir=None, profile=None,
+                 readurl=None, readprofile=None, pool=None):
+        """
+        Connect to dburl, by default the database of project. profile names
+        the SQLite connection settings in DBcommon.sqlite_profiles, e.g.
+        'ingest' or 'readonly'. The read API queries readurl, e.g. a hot
+        standby, with readprofile if given, otherwise dburl. pool overrides
+        DBcommon.pool_defaults
+        """
         if project is not None:
             self.project = project
             if dburl is None:
                 dburl = "usage_{}.db".format(project)
         self.dburl = dburl
-        self.db = connect(dburl)
+        self.db = connect_db(dburl, profile, pool)
+        self.readurl = readurl
+        self.readdb = self.db
+        if readurl is not None:
+            self.readdb = connect_db(readurl, readprofile, pool)
+        # Directory of UsageCube files used by getusage and getstorage
+        self.cachedir = cachedir
+        # Dates written since the last updatecubes, by cube key
+        self.dirtycubes = {}
+        # (url, table) of tables known to exist, see _hastable
+        self.knowntables = set()
+
+    def instrument(self, threshold=None):
+        """
+        Start collecting per-method call, row, time and SQL statement counts.
+        Statements slower than threshold seconds are logged. Returns the
+        Profiler.QueryStats, also available as self.querystats
+        """
+        from .Profiler import QueryStats
+
+        self.uninstrument()
+        self.querystats = QueryStats(self, threshold).enable()
+        return self.querystats
+
+    def uninstrument(self):
+        """
+        Stop collecting query statistics
+        """
+        if getattr(self, 'querystats', None) is not None:
+            self.querystats.disable()
+            self.querystats = None
+
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the read API on existing tables
+        """
+        ensure_indexes(self.db, self.indexes)
+
+    def addingestrun(self, source, filename, started, duration, parsed, written, **kwargs):
+        """
+        Record a parser run in the IngestRuns table. See DBcommon.add_ingest_run
+        """
+        return add_ingest_run(self.db, source, filename, started, duration, parsed, written, **kwargs)
+
+    def getingestruns(self, source=None, startdate=None, enddate=None):
+        """
+        Return the IngestRuns table as a pandas dataframe indexed by start time,
+        optionally for one source and a range of start times
+        """
+        return get_ingest_runs(self.readdb, source, startdate, enddate)
 
     def adduser(self, user, fullname=None):
         """
@@ -265,6 +530,13 @@ class ProjectDataset(object):
                     inodes=float(inodes))
         return self.db['ProjectStorage'].upsert(data, ['project_id', 'system_id', 'storagepoint_id', 'date'])
 
+    def _markdirty(self, key, date):
+        """
+        Note that date of the cube with key needs updating by updatecubes
+        """
+        if self.cachedir is not None:
+            self.dirtycubes.setdefault(key, set()).add(str(date)[:10])
+
     def adduserusage(self, project, user, date, usecpu, usewall, usesu, efficiency):
         """
         Add user su usage record by project
@@ -278,6 +550,7 @@ class ProjectDataset(object):
                     usage_wall=float(usewall), 
                     usage_su=float(usesu),
                     efficiency=float(efficiency))
+        self._markdirty(('usage',), date)
         return self.db['UserUsage'].upsert(data, ['project_id', 'user_id', 'date'])
 
     def adduserstorage(self, project, user, system, storagepoint, scandate, folder, size, inodes):
@@ -294,10 +567,12 @@ class ProjectDataset(object):
                     scandate=scandate, 
                     inodes=float(inodes), 
                     size=float(size))
+        self._markdirty(('storage', project, system, storagepoint), scandate)
         return self.db['UserStorage'].upsert(data, ['project_id', 'user_id', 'storagepoint_id', 'folder', 'scandate'])
 
     def getstartend(self, year, quarter, asdate=False):
-        q = self.db['Quarters'].find_one(year=year, quarter=quarter)
+        # Year is stored as a string, see addquarter
+        q = self.readdb['Quarters'].find_one(year=str(year), quarter=quarter)
         if q is None:
             raise NotInDatabase('No entries in database for {}.{}'.format(year,quarter))
         if asdate:
@@ -314,12 +589,28 @@ class ProjectDataset(object):
                     system_id=system_id, 
                     scheme_id=scheme_id, 
                     quarter_id=quarter_id)
-        q = list(self.db['UsageGrants'].find(**data))[-1]
+        q = list(self.readdb['UsageGrants'].find(**data))[-1]
         if q is None:
             return None
         return float(q['allocation'])
 
-    def getprojectusage(self, project, system, queue, year, quarter):
+    def _timeseries(self, qstring, scale=1., divisor=1., aslists=False):
+        """
+        Run qstring, which selects (date, value) rows, and return the dates
+        and values * scale / divisor as datetime64[D] and float64 arrays. If
+        aslists return lists of datetime.date and float instead
+        """
+        import numpy as np
+
+        rows = self.readdb.executable.exec_driver_sql(qstring).fetchall()
+        data = np.array(rows, dtype=object).reshape(-1, 2)
+        dates = data[:, 0].astype('datetime64[D]')
+        usage = data[:, 1].astype(np.float64) * scale / divisor
+        if aslists:
+            return dates.tolist(), usage.tolist()
+        return dates, usage
+
+    def getprojectusage(self, project, system, queue, year, quarter, aslists=False):
         project_id = self.addproject(project)
         systemqueue_id = self.addsystemqueue(system, queue)
         startdate, enddate = self.getstartend(year, quarter)
@@ -329,16 +620,9 @@ class ProjectDataset(object):
                      AND date between '{start}' AND '{end}' 
                      GROUP BY date ORDER BY date
                      """.format(project=project_id, system=systemqueue_id, start=startdate, end=enddate)
-        q = self.db.query(qstring)
-        if q is None:
-            return None
-        dates = []; usage = []
-        for record in q:
-            dates.append(self.date2date(record["date"]))
-            usage.append(record["totsu"]/1000.)
-        return dates, usage
+        return self._timeseries(qstring, divisor=1000., aslists=aslists)
 
-    def getschemeusage(self, project, system, scheme, year, quarter):
+    def getschemeusage(self, project, system, scheme, year, quarter, aslists=False):
         project_id = self.addproject(project)
         system_id = self.addsystem(system)
         scheme_id = self.addscheme(scheme)
@@ -350,16 +634,9 @@ class ProjectDataset(object):
                      AND date between '{start}' AND '{end}' 
                      GROUP BY date ORDER BY date
                      """.format(project=project_id, system=system_id, scheme=scheme_id, start=startdate, end=enddate)
-        q = self.db.query(qstring)
-        if q is None:
-            return None
-        dates = []; usage = []
-        for record in q:
-            dates.append(self.date2date(record["date"]))
-            usage.append(record["totsu"]/1000.)
-        return dates, usage
+        return self._timeseries(qstring, divisor=1000., aslists=aslists)
 
-    def getuserusage(self, project, year, quarter, user, scale=None):
+    def getuserusage(self, project, year, quarter, user, scale=None, aslists=False):
         project_id = self.addproject(project)
         startdate, enddate = self.getstartend(year, quarter)
         user_id = self.adduser(user)
@@ -370,15 +647,8 @@ class ProjectDataset(object):
                      date between '{start}' AND '{end}' AND 
                      user_id={user} GROUP BY date ORDER BY date
                      """.format(project=project_id, start=startdate, end=enddate, user=user_id)
-        q = self.db.query(qstring)
-        if q is None:
-            return None
-        dates = []; usage = []
         if scale is None: scale = 1.
-        for record in q:
-            dates.append(self.date2date(record["date"]))
-            usage.append(record["totsu"]*scale)
-        return dates, usage
+        return self._timeseries(qstring, scale, aslists=aslists)
 
     def getusershort(self, year, quarter, user):
         project_id = self.addproject(project)
@@ -389,7 +659,7 @@ class ProjectDataset(object):
                      scandate between '{start}' AND '{end}' AND 
                      user={user} GROUP BY scandate ORDER BY scandate
                      """.format(project=project_id, start=startdate, end=enddate, user=user_id)
-        q = self.db.query(qstring)
+        q = self.readdb.query(qstring)
         if q is None:
             return None
         dates = []; usage = []
@@ -398,94 +668,65 @@ class ProjectDataset(object):
             usage.append(record["totsize"])
         return dates, usage
 
-    def getusage(self, year, quarter, datafield='usage_su', namefield='user+name'):
+    def getusage(self, year, quarter, datafield='usage_su', namefield='user+name', output='wide'):
+        """
+        Return usage by user for year and quarter. output is 'wide' for a
+        dense dates x users frame, 'sparse' for the same with sparse columns
+        or 'long' for a (Date, Name, value) frame, see reshape
+        """
+        import pandas as pd
 
         startdate, enddate = self.getstartend(year, quarter)
+        qstring, params = usage_query(startdate, enddate, datafield, namefield)
 
-        if namefield == 'user+name':
-            name_sql = 'printf("%s (%s)", Users.fullname, Users.user)'
-        elif namefield == 'user':
-            name_sql = 'Users.user'
-        else:
-            raise ValueError('Incorrect value of namefield: {} Valid values are "user+name" or "user"'.format(namefield))
-
-        if datafield not in ('usage_su','usage_wall','usage_cpu'):
-            raise ValueError('Incorrect value of datafield: {} Valid values are "usage_su", "usage_wall" or "usage_cpu"'.format(namefield))
+        if output not in outputs:
+            raise ValueError('Incorrect value of output: {} Valid values are {}'.format(output, outputs))
 
-        qstring = """SELECT {namefield} as Name, date as Date, SUM({datafield}) AS totsu
-        FROM UserUsage
-        LEFT JOIN Users ON UserUsage.user_id = Users.id 
-        WHERE date between \'{start}\' AND \'{end}\' 
-        GROUP BY Name, Date 
-        ORDER BY Date"""
+        if self.cachedir is not None and output == 'wide':
+            df = self._cachedframe(('usage',), year, quarter, datafield, namefield)
+            if df is not None:
+                return df
 
-        # Pivot makes columns of all the individuals, rows are indexed by date
-        try:
-            df = pd.read_sql_query(qstring.format(namefield=name_sql,
-                                                  datafield=datafield,
-                                                  start=startdate,
-                                                  end=enddate),
-                                                  self.db.executable).pivot_table(index='Date',
-                                                                                  columns='Name',
-                                                                                  fill_value=0)
-        except:
+        # A database without usage has no table to query
+        df = None
+        if 'UserUsage' in self.readdb:
+            df = pd.DataFrame(list(self.readdb.query(qstring, **params)), columns=['Name', 'Date', 'totsu'])
+        if df is None or df.empty:
             print("No usage data available")
             return None
 
-        # Get rid of the totsize labels in the multiindex
-        df.columns = df.columns.get_level_values(1)
-        # Convert date index from labels to datetime objects 
-        df.index = pd.to_datetime(df.index, format="%Y-%m-%d")
-
-        return df
+        return reshape(df, output)
 
 
-    def getstorage(self, project, year, quarter, systemname, storagepoint='scratch', datafield='size', namefield='user+name'):
+    def getstorage(self, project, year, quarter, systemname, storagepoint='scratch', datafield='size', namefield='user+name', output='wide'):
+        """
+        Return storage by user for project on storagepoint in year and quarter.
+        output is 'wide' for a dense dates x users frame backfilled to the start
+        of the quarter, 'sparse' for sparse columns or 'long' for a (Date, Name,
+        value) frame. The last two only include scan dates, see reshape
+        """
+        import pandas as pd
 
-        project_id = self.addproject(project)
-        system_id = self.addsystem(systemname)
-        storagepoint_id = self.addstoragepoint(systemname, storagepoint)
         startdate, enddate = self.getstartend(year, quarter)
+        qstring, params = storage_query(startdate, enddate, project, systemname, storagepoint, datafield, namefield)
 
-        table = 'UserStorage'
+        if output not in outputs:
+            raise ValueError('Incorrect value of output: {} Valid values are {}'.format(output, outputs))
 
-        if namefield == 'user+name':
-            name_sql = 'printf("%s (%s)", Users.fullname, Users.user)'
-        elif namefield == 'user':
-            name_sql = 'Users.user'
-        else:
-            raise ValueError('Incorrect value of namefield: {} Valid values are "user+name" or "user"'.format(namefield))
+        df = None
+        if self.cachedir is not None and output == 'wide':
+            df = self._cachedframe(('storage', project, systemname, storagepoint), year, quarter, datafield, namefield)
 
-        if datafield not in ('size','inodes'):
-            raise ValueError('Incorrect value of datafield: {} Valid values are "inodes" or "size"'.format(namefield))
+        if df is None:
+            if 'UserStorage' in self.readdb:
+                df = pd.DataFrame(list(self.readdb.query(qstring, **params)), columns=['Name', 'Date', 'totsize'])
+            if df is None or df.empty:
+                print("No data available for {}".format(storagepoint))
+                return None
 
-        qstring = """SELECT {namefield} as Name, scandate as Date, SUM({datafield}) AS totsize 
-        FROM {table}
-        LEFT JOIN Users ON {table}.user_id = Users.id
-        WHERE scandate between \'{start}\' AND \'{end}\'
-        AND project_id = {project_id}
-        AND storagepoint_id = {storagepoint_id}
-        GROUP BY Name, Date
-        ORDER BY Date"""
-
-        # Pivot makes columns of all the individuals, rows are indexed by date
-        try:
-            df = pd.read_sql_query(qstring.format(namefield=name_sql,
-                                                  datafield=datafield,
-                                                  table=table,
-                                                  project_id=project_id,
-                                                  storagepoint_id=storagepoint_id,
-                                                  start=startdate,
-                                                  end=enddate), 
-                                   self.db.executable).pivot_table(index='Date', columns='Name', fill_value=0)
-        except:
-            print("No data available for {}".format(storagepoint))
-            return None
-            
-        # Get rid of the totsize labels in the multiindex
-        df.columns = df.columns.get_level_values(1)
-        # Convert date index from labels to datetime objects 
-        df.index = pd.to_datetime(df.index, format="%Y-%m-%d")
+            df = reshape(df, output)
+            if output != 'wide':
+                return df
 
         # Make a new index from the beginning of the quarter
         newidx = pd.date_range(startdate,df.index[-1])
@@ -495,66 +736,248 @@ class ProjectDataset(object):
 
         return df
 
-    def getshortusers(self, year, quarter):
-        startdate, enddate = self.getstartend(year, quarter)
-        qstring = "SELECT user FROM ShortUsage WHERE scandate between '{}' AND '{}' GROUP BY user ORDER BY SUM(size) desc".format(startdate,enddate)
-        q = self.db.query(qstring)
-        if q is None:
+    def _cube(self, key, year, quarter, datafield):
+        """
+        Return the UsageCube in cachedir for key, year, quarter and datafield
+        """
+        from .UsageCube import UsageCube
+
+        name = '_'.join([str(part) for part in key] + ['{}{}'.format(year, quarter), datafield])
+        return UsageCube(os.path.join(self.cachedir, name))
+
+    def _cubetable(self, key):
+        """
+        Return the table and date column holding the data for cube key
+        """
+        if key[0] == 'usage':
+            return 'UserUsage', 'date'
+        return 'UserStorage', 'scandate'
+
+    def _cuberows(self, key, datafield, start=None, end=None, dates=None, db=None):
+        """
+        Return the (date, user, fullname, value) rows for cube key from the
+        read database, or db, between start and end or on a list of dates
+        """
+        if db is None:
+            db = self.readdb
+        table, datefield = self._cubetable(key)
+        datefield = '"{}".{}'.format(table, datefield)
+        params = {}
+        qstring = """SELECT {date} AS date, "Users"."user" AS "user", "Users".fullname AS fullname,
+        SUM({datafield}) AS value FROM "{table}"
+        JOIN "Users" ON "{table}".user_id = "Users".id
+        WHERE 1=1""".format(date=datefield, datafield=datafield, table=table)
+        if key[0] == 'storage':
+            _, project, system, storagepoint = key
+            qstring += " AND " + storage_sql
+            params.update(project=project, system=system, storagepoint=storagepoint)
+        if start is not None:
+            qstring += " AND {} BETWEEN :start AND :end".format(datefield)
+            params.update(start=str(start), end=str(end))
+        if dates is not None:
+            qstring += " AND " + in_clause(datefield, 'date', dates, params)
+        qstring += ' GROUP BY {}, "Users"."user", "Users".fullname'.format(datefield)
+        return [(r['date'], r['user'], r['fullname'], r['value']) for r in db.query(qstring, **params)]
+
+    def _hastable(self, db, table):
+        """
+        Return whether table exists in db. Tables are not dropped, so once
+        found they are not looked up again
+        """
+        if (db.url, table) not in self.knowntables and table in db:
+            self.knowntables.add((db.url, table))
+        return (db.url, table) in self.knowntables
+
+    def _cubestamp(self, key, db=None):
+        """
+        Return the ingest high water mark of the table holding the data for
+        cube key in the read database, or db: the largest id of the table and
+        of IngestRuns. New rows change the first, and rows rewritten in place
+        the second as every parser records an IngestRun. None if there is no
+        table
+        """
+        if db is None:
+            db = self.readdb
+        table, _ = self._cubetable(key)
+        if not self._hastable(db, table):
             return None
-        users = []
-        for record in q:
-            users.append(self.db['Users'].find_one(id=record["user"])["user"])
-        return users
+        qstring = 'SELECT (SELECT MAX(id) FROM "{}") AS latest'.format(table)
+        if self._hastable(db, 'IngestRuns'):
+            qstring += ', (SELECT MAX(id) FROM "IngestRuns") AS run'
+        row = next(iter(db.query(qstring)))
+        return [row['latest'], row.get('run')]
 
-    def getsuusers(self, year, quarter):
-        startdate, enddate = self.getstartend(year, quarter)
-        qstring = "SELECT user_id, MAX(usage_su) as maxsu FROM UserUsage WHERE date between '{}' AND '{}' GROUP BY user_id ORDER BY maxsu desc".format(startdate,enddate)
-        q = self.db.query(qstring)
-        if q is None:
+    def _cachedframe(self, key, year, quarter, datafield, namefield):
+        """
+        Return the wide frame for cube key from cachedir, first reloading the
+        quarter if the database has been written since the cube was saved.
+        None if there is no data
+        """
+        stamp = self._cubestamp(key)
+        if stamp is None:
             return None
-        users = []
-        for record in q:
-            users.append(self.db['Users'].find_one(id=record["user_id"])["user"])
-        return users
+
+        cube = self._cube(key, year, quarter, datafield)
+        if cube.data is None or cube.stamp != stamp:
+            startdate, enddate = self.getstartend(year, quarter)
+            rows = self._cuberows(key, datafield, startdate, enddate)
+            if not rows:
+                return None
+            cube.update(rows, stamp, replace=True)
+        return cube.frame(namefield)
+
+    def updatecubes(self):
+        """
+        Update the existing cubes in cachedir with the usage and storage
+        written since the last call. Other cubes are created when first read
+        """
+        dirtycubes, self.dirtycubes = self.dirtycubes, {}
+        if self.cachedir is None:
+            return
+        for key, dates in dirtycubes.items():
+            quarters = {}
+            for date in dates:
+                quarters.setdefault(datetoyearquarter(self.date2date(date)), []).append(date)
+            fields = self.usagefields if key[0] == 'usage' else self.storagefields
+            for (year, quarter), dates in quarters.items():
+                for datafield in fields:
+                    cube = self._cube(key, year, quarter, datafield)
+                    if cube.data is not None:
+                        # Read back from the database just written, which a
+                        # standby may not have caught up with. The stamp is
+                        # taken first so a concurrent write makes it stale.
+                        # Cubes of other keys are reloaded when next read
+                        stamp = self._cubestamp(key, db=self.db)
+                        cube.update(self._cuberows(key, datafield, dates=sorted(dates), db=self.db), stamp)
+
+    usagefields = ('usage_su', 'usage_cpu', 'usage_wall')
+    storagefields = ('size', 'inodes')
+
+    def query_usage(self, projects=None, users=None, storagepoints=None, start=None, end=None, fields=None):
+        """
+        Return user usage as a long format pandas dataframe with one row per
+        date, project and user (and storage point for storage fields), from a
+        single query over any date range. Usage fields are taken from UserUsage
+        and storage fields ('size', 'inodes') from UserStorage, summed over
+        folders. projects, users and storagepoints are one or a list of names,
+        None means all. Use pivot_table on the result for the wide form
+        """
+        import pandas as pd
+
+        if fields is None:
+            fields = self.usagefields[:1] if storagepoints is None else self.storagefields[:1]
+        elif isinstance(fields, str):
+            fields = [fields]
+        fields = list(fields)
+
+        if all(field in self.usagefields for field in fields):
+            table, datefield, keys = 'UserUsage', 'date', ['project', 'user']
+            if storagepoints is not None:
+                raise ValueError('storagepoints can only be used with storage fields {}'.format(self.storagefields))
+        elif all(field in self.storagefields for field in fields):
+            table, datefield, keys = 'UserStorage', 'scandate', ['project', 'user', 'storagepoint']
+        else:
+            raise ValueError('Incorrect value of fields: {} Valid values are {} or {}'.format(fields, self.usagefields, self.storagefields))
+
+        # Tables, and user which is a keyword, are quoted as in usage_query
+        columns = {'project': '"Projects".project', 'user': '"Users"."user"',
+                   'storagepoint': '"StoragePoints".storagepoint'}
+        keysql = ', '.join(columns[key] for key in keys)
+        qstring = """SELECT "{table}".{datefield} AS date, {keysql}, "Users".fullname, {sums} FROM "{table}"
+        JOIN "Projects" ON "{table}".project_id = "Projects".id
+        JOIN "Users" ON "{table}".user_id = "Users".id
+        """
+        if table == 'UserStorage':
+            qstring += 'JOIN "StoragePoints" ON "UserStorage".storagepoint_id = "StoragePoints".id\n'
+        qstring += "WHERE 1=1"
+
+        params = {}
+        if start is not None:
+            qstring += ' AND "{table}".{datefield} >= :start'
+            params['start'] = str(start)
+        if end is not None:
+            qstring += ' AND "{table}".{datefield} <= :end'
+            params['end'] = str(end)
+        # Filter on ids so the planner can use the fact table indexes
+        if projects is not None:
+            qstring += ' AND "{table}".project_id IN (SELECT id FROM "Projects" WHERE '
+            qstring += in_clause('project', 'project', projects, params) + ")"
+        if users is not None:
+            qstring += ' AND "{table}".user_id IN (SELECT id FROM "Users" WHERE '
+            qstring += in_clause('"user"', 'user', users, params) + ")"
+        if storagepoints is not None:
+            qstring += ' AND "{table}".storagepoint_id IN (SELECT id FROM "StoragePoints" WHERE '
+            qstring += in_clause('storagepoint', 'storagepoint', storagepoints, params) + ")"
+        qstring += ' GROUP BY "{table}".{datefield}, {keysql}, "Users".fullname ORDER BY date'
+
+        qstring = qstring.format(table=table, datefield=datefield, keysql=keysql,
+                                 sums=', '.join('SUM({0}) AS {0}'.format(field) for field in fields))
+
+        columns = ['date'] + keys + ['fullname'] + fields
+        df = pd.DataFrame(list(self.readdb.query(qstring, **params)), columns=columns)
+        df['date'] = pd.to_datetime(df['date'], format="%Y-%m-%d")
+        return df
+
+    def getshortusers(self, year, quarter, project=None, limit=None, storagepoint='scratch'):
+        """
+        Return users with storage on storagepoint in year and quarter, largest
+        total first. Optionally only for project (one or a list of project codes)
+        and only the first limit users
+        """
+        startdate, enddate = self.getstartend(year, quarter)
+        qstring, params = shortusers_query(startdate, enddate, project, limit, storagepoint)
+        return [record['user'] for record in self.readdb.query(qstring, **params)]
+
+    def getsuusers(self, year, quarter, project=None, limit=None):
+        """
+        Return users with SU usage in year and quarter, largest first. Optionally
+        only for project (one or a list of project codes) and only the first
+        limit users
+        """
+        startdate, enddate = self.getstartend(year, quarter)
+        qstring, params = suusers_query(startdate, enddate, project, limit)
+        return [record['user'] for record in self.readdb.query(qstring, **params)]
 
     def getuser(self, user=None):
-        return self.db['Users'].find_one(user=user)
+        return self.readdb['Users'].find_one(user=user)
 
     def getusers(self):
         qstring = "SELECT user FROM Users"
-        q = self.db.query(qstring)
+        q = self.readdb.query(qstring)
         for user in q:
             yield user['user']
 
     def getqueue(self, system, queue):
-        system_id = self.addsystem(system)
-        return self.db['SystemQueues'].find_one(system_id=system_id, queue=queue)
+        q = self.readdb['Systems'].find_one(system=system)
+        if q is None:
+            return None
+        return self.readdb['SystemQueues'].find_one(system_id=q['id'], queue=queue)
 
     def getquarter(self):
         """
         Return (year, quarter) for the most recent entry in the DB table Quarters
         Make sure to cast year to integer as it is stored as a string in the postgres DB
         """
-        q = self.db['Quarters'].find_one(order_by=['-year','-quarter'])
+        q = self.readdb['Quarters'].find_one(order_by=['-year','-quarter'])
         return int(q['year']), q['quarter'] 
 
     def getsystems(self):
         """
         Return list of systems
         """
-        return [d['system'] for d in self.db['Systems'].find()]
+        return [d['system'] for d in self.readdb['Systems'].find()]
 
     def getschemes(self):
         """
         Return list of schemes
         """
-        return [d['scheme'] for d in self.db['Schemes'].find()]
+        return [d['scheme'] for d in self.readdb['Schemes'].find()]
 
     def getprojects(self):
         """
         Return list of projects
         """
-        return [d['project'] for d in self.db['Projects'].find()]
+        return [d['project'] for d in self.readdb['Projects'].find()]
 
     def date2date(self, datestring):
 
@@ -564,18 +987,18 @@ class ProjectDataset(object):
             return datetime.datetime.strptime(datestring, "%Y-%m-%d").date()
 
     def getstoragepoints(self, system):
-        system_id = self.addsystem(system)
-        qstring = "SELECT DISTINCT storagepoint FROM StoragePoints WHERE system_id is '{}'".format(system_id)
-        q = self.db.query(qstring)
+        q = self.readdb['Systems'].find_one(system=system)
         if q is None:
             return None
+        qstring = 'SELECT DISTINCT storagepoint FROM "StoragePoints" WHERE system_id = :system_id'
+        q = self.readdb.query(qstring, system_id=q['id'])
         storagepoints = []
         for record in q:
             storagepoints.append(record["storagepoint"])
         return storagepoints
 
     def getgdatastoragept(self, year, quarter):
-        q = self.db['SystemStorage'].find_one(system='global', year=year, quarter=quarter)
+        q = self.readdb['SystemStorage'].find_one(system='global', year=year, quarter=quarter)
         if q is None:
             return None
         return q["storagepoint"]
@@ -592,7 +1015,7 @@ class ProjectDataset(object):
                     storagepoint_id=storagepoint_id, 
                     scheme_id=scheme_id, 
                     quarter_id=quarter_id)
-        q = self.db['StorageGrants'].find_one(**data)
+        q = self.readdb['StorageGrants'].find_one(**data)
         if q is None:
             return (None,None)
         return float(q['capacity']),float(q['inodes'])
@@ -603,7 +1026,7 @@ class ProjectDataset(object):
             point = self.getgdatastoragept(year, quarter)
         else:
             point = storagepoint
-        q = self.db['SystemStorage'].find_one(system=systemname, storagepoint=point, year=year, quarter=quarter)
+        q = self.readdb['SystemStorage'].find_one(system=systemname, storagepoint=point, year=year, quarter=quarter)
         if q is None:
             return (None,None)
         return float(q['grant']),float(q['igrant'])
@@ -618,29 +1041,26 @@ class ProjectDataset(object):
         data = dict(project_id=project_id,
                     system_id=system_id,
                     storagepoint_id=storagepoint_id)
-        q = self.db['ProjectStorage'].find_one(**data)
+        q = self.readdb['ProjectStorage'].find_one(**data)
         if q is None:
             return (None,None)
         return float(q['size']),float(q['inodes'])
 
-    def top_usage(self, year, quarter, storagepoint, measure='size', count=10, scale=1):
+    def top_usage(self, year, quarter, storagepoint, measure='size', count=10, scale=1, project=None):
         """
         Return the top ``count`` users according to ``measure`` (either 'size'
-        or 'inodes') on ``storagepoint`` for ``year`` and ``quarter``
+        or 'inodes') on ``storagepoint`` for ``year`` and ``quarter``. Usage is
+        taken from the latest scan for each user in the quarter, summed over
+        storage points and projects when more than one is given. Optionally
+        only for ``project`` (one or a list of project codes)
 
-        Returns pandas dataframe (fullname (user), usage)
+        Returns pandas series of usage indexed by fullname (user)
         """
+        import pandas as pd
 
-        if storagepoint not in ['short', 'gdata']:
-            raise Exception(f"Unexpected storagepoint '{storagepoint}'")
+        startdate, enddate = self.getstartend(year, quarter)
+        qstring, params = top_usage_query(startdate, enddate, storagepoint, measure, count, project)
 
-        if measure not in ['size', 'inodes']:
-            raise Exception(f"Unexpected measure '{measure}'")
+        df = pd.DataFrame(list(self.readdb.query(qstring, **params)), columns=['Name', measure])
 
-        # Get the storage for this quarter, grab the last record, which corresponds
-        # to the most recent scan date, sort, take the largest count records and
-        # divide by scale
-        return self.getstorage(year, 
-                               quarter, 
-                               storagept=storagepoint, 
-                               datafield=measure).ix[-1].sort_values(ascending=False).head(count).divide(scale)
+        return df.set_index('Name')[measure].divide(scale)
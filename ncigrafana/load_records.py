@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Load records written by the parsers with --output into a database
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from .UsageDataset import ProjectDataset
+from .JobsDataset import JobsDataset
+from .make_jobs_DB import load_jobs
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .Records import Records
+
+def main(args):
+
+    db = None
+    jobsdb = None
+
+    for directory in args.inputs:
+        if args.verbose: print("Loading records: {}".format(directory))
+        records = Records.read(directory)
+        if records.source == 'qstat':
+            if jobsdb is None:
+                if not args.jobsdburl:
+                    print("Please specify --jobsdburl JOBSDBURL to load {}".format(directory))
+                    return 1
+                jobsdb = JobsDataset(args.jobsdburl, profile='ingest')
+            with IngestRun(jobsdb, records.source, directory) as run:
+                with run.stage('load'):
+                    load_jobs(records, jobsdb, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+        else:
+            if db is None:
+                if not args.dburl:
+                    print("Please specify --dburl DBURL to load {}".format(directory))
+                    return 1
+                db = ProjectDataset(dburl=args.dburl, cachedir=args.cachedir, profile='ingest')
+            with IngestRun(db, records.source, directory) as run:
+                with run.stage('load'):
+                    records.load(db, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+
+    if db is not None:
+        # Indexes for the read API are created once tables exist
+        db.ensure_indexes()
+        db.updatecubes()
+
+    return 0
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Load parsed records into the usage and jobs databases")
+    parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
+    parser.add_argument("-db","--dburl", help="Usage database url", default=None)
+    parser.add_argument("-j","--jobsdburl", help="Jobs database url", default=None)
+    parser.add_argument("-c","--cachedir", help="Update usage cubes in this directory", default=None)
+    parser.add_argument("--copy", help="load PostgreSQL databases in bulk with COPY", action='store_true')
+    parser.add_argument("inputs", help="records directories written with --output", nargs='+')
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return profiled(main, parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    sys.exit(main_parse_args(sys.argv[1:]))
+
+if __name__ == "__main__":
+
+    main_argv()
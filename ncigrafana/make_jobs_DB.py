@@ -22,7 +22,6 @@ from __future__ import print_function
 
 import argparse
 import datetime
-import json
 import os
 import pwd
 import re
@@ -31,8 +30,10 @@ from string import Template
 import sys
 
 # Local imports
-from JobsDataset import *
-from DBcommon import extract_num_unit, parse_size, mkdir, archive, datetoyearquarter
+from .JobsDataset import *
+from .DBcommon import extract_num_unit, parse_size, mkdir, archive, datetoyearquarter, json_loads
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .Records import Records, add_records_arguments, records_directory
 
 databases = {}
 dbfileprefix = '.'
@@ -93,17 +94,16 @@ def strip_ml(text):
         return None
     return re.sub('<[^<]+?>', '', text)
 
-def parse_qstat_json_dump(filename, dbfile, verbose=False):
-
-    db = JobsDataset("sqlite:///{}".format(dbfile))
-
-    numrecords = db.getnumrecords()
+def qstat_records(filename, verbose=False):
+    """
+    Parse a qstat json dump into Records
+    """
 
-    nentries = 0
+    records = Records('qstat', filename)
 
-    with open(filename) as f:
+    with open(filename, 'rb') as f:
 
-        data = json.load(f)
+        data = json_loads(f.read())
 
         if 'Jobs' in data:
             data = data['Jobs']
@@ -112,6 +112,8 @@ def parse_qstat_json_dump(filename, dbfile, verbose=False):
 
             if jobid == '_default': continue
 
+            records.parsed += 1
+
             try:
                 # Strip off '.r-man2' suffix if it exists
                 jobid = jobid.split('.')[0]
@@ -187,34 +189,98 @@ def parse_qstat_json_dump(filename, dbfile, verbose=False):
                         ctime, mtime, qtime, stime, waitime,
                         maxwalltime, maxmem, ncpus,
                         walltime, mem, cputime, cpuutil, exit_status)
-                db.addjob(year, info['queue'], jobid, info['project'], username,
-                        info['job_state'], info['Job_Name'], resources['jobprio'], exe, arglist + subarglist,
-                        ctime, mtime, qtime, stime, waitime,
-                        maxwalltime, maxmem, ncpus,
-                        walltime, mem, cputime, cpuutil, exit_status)
-                nentries += 1
+                records.add('jobs', year, info['queue'], jobid, info['project'], username,
+                            info['job_state'], info['Job_Name'], resources['jobprio'], exe, arglist + subarglist,
+                            ctime, mtime, qtime, stime, waitime,
+                            maxwalltime, maxmem, ncpus,
+                            walltime, mem, cputime, cpuutil, exit_status)
+                records.accepted += 1
             except:
                 print("Error parsing {}".format(jobid))
                 print(info)
                 raise
-                    
+
+    return records
+
+def load_jobs(records, db, copy=False):
+    """
+    Add job Records to the JobsDataset db and refresh the daily rollup.
+    See Records.load for copy
+    """
+
+    numrecords = db.getnumrecords()
+    current = db.jobstatscurrent(db.db)
+
+    records.load(db, copy=copy)
+
+    # Refresh the daily rollup for the days touched by this dump, or build it
+    # for every day if the database has jobs from before the rollup existed
+    if current:
+        db.updatejobstats()
+    else:
+        db.rebuildjobstats()
+    db.ensure_indexes()
+
     newrecords = db.getnumrecords() - numrecords
 
-    print("Found {} entries. Added {} new records, {} records updated or unchanged".format(nentries, newrecords, nentries - newrecords)) 
+    print("Found {} entries. Added {} new records, {} records updated or unchanged".format(records.accepted, newrecords, records.accepted - newrecords)) 
+
+def parse_qstat_json_dump(filename, dbfile, verbose=False, db=None):
+    """
+    Parse a qstat json dump into the jobs database dbfile, or the
+    JobsDataset db if given. Returns the number of jobs read and added
+    """
+
+    if db is None:
+        db = JobsDataset("sqlite:///{}".format(dbfile), profile='ingest')
+
+    records = qstat_records(filename, verbose)
+    load_jobs(records, db)
+
+    return records.parsed, records.accepted
 
 def main(args):
 
     verbose = args.verbose
 
+    if args.output:
+        for f in args.inputs:
+            print("Reading dumpfile: {}".format(f))
+            # Only parse, leaving loading the records for later
+            qstat_records(f, verbose).write(records_directory(args.output, f), args.format)
+            archive(f)
+        return
+
+    db = JobsDataset("sqlite:///{}".format(args.database), profile='ingest')
+
+    # Days already in the rollup are recomputed with any changed rates
+    if any([db.addchargerate(queue, rate) for queue, rate in args.chargerate or []]):
+        db.rebuildjobstats()
+
     for f in args.inputs:
         print("Reading dumpfile: {}".format(f))
-        try:
-            parse_qstat_json_dump(f, args.database, verbose)
-        except:
-            raise
-        else:
-            archive(f)
-            pass
+        with IngestRun(db, 'qstat', f) as run:
+            try:
+                with run.stage('parse'):
+                    records = qstat_records(f, verbose)
+                with run.stage('load'):
+                    load_jobs(records, db, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+            except:
+                raise
+            else:
+                with run.stage('archive'):
+                    archive(f)
+
+def chargerate(string):
+    """
+    Parse a QUEUE=RATE command line argument
+    """
+    queue, _, rate = string.partition('=')
+    try:
+        return queue, float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected QUEUE=RATE, not {}'.format(string))
 
 def parse_args(args):
     """
@@ -224,9 +290,14 @@ def parse_args(args):
     parser.add_argument('-d','--directory', help='Specify directory to find dump files', default='.')
     parser.add_argument('-v','--verbose', help='Verbose output', action='store_true')
     parser.add_argument('-db','--database', help='Verbose output', default='jobs.db')
+    parser.add_argument('--chargerate', help='SU charged per core hour on QUEUE, e.g. normal=2. Jobs on queues '
+                        'without a rate stop the daily rollup', metavar='QUEUE=RATE', type=chargerate, action='append')
     parser.add_argument('inputs', help='dumpfiles', nargs='+')
 
-    return parser.parse_args()
+    add_records_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -234,7 +305,7 @@ def main_parse_args(args):
     """
     # Must return so that check command return value is passed back to calling routine
     # otherwise py.test will fail
-    return main(parse_args(args))
+    return profiled(main, parse_args(args))
 
 def main_argv():
     """
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copy a SQLite usage or jobs database into PostgreSQL.
+
+Dimension tables (projects, users, systems, ...) are merged into the target
+on their natural keys, so several databases can be migrated into one, and
+every other table is copied with its references remapped to the target ids.
+Tables are streamed from SQLite in chunks of rowids and copied in parallel,
+each chunk with COPY in one transaction which also records the progress of
+the table in MigrationProgress, so an interrupted migration carries on from
+the last chunk. The ids the copy was given in the target are recorded with
+its progress, and finally the rows and a checksum of those ids are compared
+with the source. Nothing else should write to the tables being
+copied during a migration
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .CopyLoader import copy_from, csvfield, quote
+from .DBcommon import connect_db, ensure_indexes
+from .Profiler import add_profile_arguments, profiled
+
+# Natural key columns of the dimension tables of usage and jobs databases,
+# which are merged in this order so that dimensions they refer to come first
+dimensions = {
+    'Systems': ('system',),
+    'Projects': ('project',),
+    'Users': ('user',),
+    'Schemes': ('scheme',),
+    'Quarters': ('year', 'quarter'),
+    'StoragePoints': ('system_id', 'storagepoint'),
+    'SystemQueues': ('system_id', 'queue'),
+    'Project': ('project',),
+    'Queue': ('queue',),
+    'User': ('username',),
+    'JobState': ('status',),
+    'Executable': ('path',),
+}
+
+# Dimension referred to by each foreign key column. Tables of the jobs
+# database name their references after the dimension
+references = {'project_id': 'Projects', 'user_id': 'Users', 'system_id': 'Systems',
+              'storagepoint_id': 'StoragePoints', 'systemqueue_id': 'SystemQueues',
+              'scheme_id': 'Schemes', 'quarter_id': 'Quarters'}
+jobreferences = {'project': 'Project', 'queue': 'Queue', 'user': 'User', 'status': 'JobState', 'exe': 'Executable'}
+jobtables = ('Jobs', 'JobStatsDaily')
+
+progresstable = 'MigrationProgress'
+
+def reference(table, column):
+    """
+    Return the dimension referred to by column of table, or None
+    """
+    if table in jobtables:
+        return jobreferences.get(column)
+    return references.get(column)
+
+def canonical(value):
+    """
+    Return value as a string which is the same whichever database it was read from
+    """
+    if value is None:
+        return '\\N'
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def rowhash(values):
+    """
+    Return a 64 bit hash of a row of values. Table checksums are the sum of
+    these modulo 2**64, so do not depend on row order
+    """
+    digest = hashlib.blake2b('\x1f'.join(canonical(v) for v in values).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def target_type(column):
+    """
+    Return the type for a copy of the SQLite column in another database.
+    Integers are made 64 bit, as SQLite integers are
+    """
+    import sqlalchemy
+
+    try:
+        generic = column.type.as_generic()
+    except NotImplementedError:
+        return sqlalchemy.UnicodeText()
+    if isinstance(generic, sqlalchemy.Integer):
+        return sqlalchemy.BigInteger()
+    return generic
+
+class Migration(object):
+
+    def __init__(self, source, target, chunksize=50000, workers=4, verbose=False):
+        """
+        Migration of the SQLite database url source into the PostgreSQL
+        database url target, chunksize rows at a time in up to workers tables
+        at once
+        """
+        import sqlalchemy
+
+        self.source = source
+        self.target = target
+        self.chunksize = chunksize
+        self.workers = workers
+        self.verbose = verbose
+
+        self.sourceengine = sqlalchemy.create_engine(source)
+        self.sourcemeta = sqlalchemy.MetaData()
+        self.sourcemeta.reflect(self.sourceengine)
+        self.db = connect_db(target, pool=dict(pool_size=workers))
+        # Source id to target id of the rows of each dimension
+        self.ids = {}
+
+    def tables(self):
+        """
+        Return the dimension tables of the source, in merge order, and the
+        other tables
+        """
+        names = [name for name in self.sourcemeta.tables if name != progresstable]
+        return ([name for name in dimensions if name in names],
+                sorted(name for name in names if name not in dimensions))
+
+    def prepare(self, tables):
+        """
+        Create the progress table, and any tables and columns of the source
+        missing from the target
+        """
+        with self.db:
+            self.db.query("""CREATE TABLE IF NOT EXISTS {} (
+                source text, tablename text, baseid bigint, lastid bigint, lastrowid bigint, rows bigint,
+                checksum numeric, finished timestamp, PRIMARY KEY (source, tablename))""".format(quote(progresstable)))
+            self.db.query('ALTER TABLE {} ADD COLUMN IF NOT EXISTS lastid bigint'.format(quote(progresstable)))
+            for name in tables:
+                table = self.db.create_table(name)
+                for column in self.sourcemeta.tables[name].columns:
+                    if column.name != 'id' and not table.has_column(column.name):
+                        table.create_column(column.name, target_type(column))
+
+    def remap(self, table, row):
+        """
+        Replace the references in the dict row of table with target ids
+        """
+        for column, value in row.items():
+            dimension = reference(table, column)
+            if dimension is None or value is None or dimension not in self.ids:
+                continue
+            if value not in self.ids[dimension]:
+                raise ValueError('{}.{} refers to {} id {} which does not exist'.format(table, column, dimension, value))
+            row[column] = self.ids[dimension][value]
+        return row
+
+    def merge(self, name):
+        """
+        Add the rows of dimension name missing from the target, matching on
+        its natural key, and record the target id of every source row
+        """
+        keys = dimensions[name]
+        table = self.db[name]
+        existing = {tuple(canonical(row[k]) for k in keys): row['id'] for row in table.all()}
+        ids = {}
+        added = 0
+        with self.sourceengine.connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(self.sourcemeta.tables[name].select())]
+        for row in rows:
+            id = row.pop('id')
+            self.remap(name, row)
+            key = tuple(canonical(row[k]) for k in keys)
+            if key not in existing:
+                existing[key] = table.insert(row)
+                added += 1
+            ids[id] = existing[key]
+        self.ids[name] = ids
+        if self.verbose: print('Merged {}: {} rows, {} added'.format(name, len(rows), added))
+        return len(rows), added
+
+    def progress(self, conn, name):
+        """
+        Return the progress row of table name, starting one if there is none
+        """
+        from sqlalchemy import text
+
+        params = dict(source=self.source, tablename=name)
+        select = text('SELECT baseid, lastid, lastrowid, rows, checksum, finished FROM {} '
+                      'WHERE source = :source AND tablename = :tablename'.format(quote(progresstable)))
+        row = conn.execute(select, params).first()
+        if row is None:
+            baseid = conn.exec_driver_sql('SELECT MAX(id) FROM {}'.format(quote(name))).scalar()
+            conn.execute(text('INSERT INTO {} (source, tablename, baseid, lastid, lastrowid, rows, checksum) '
+                              'VALUES (:source, :tablename, :baseid, :baseid, 0, 0, 0)'.format(quote(progresstable))),
+                         dict(params, baseid=baseid or 0))
+            row = conn.execute(select, params).first()
+        return dict(row._mapping)
+
+    def copy(self, name):
+        """
+        Copy table name to the target a chunk at a time, from the last chunk
+        copied. Returns the number of rows copied
+        """
+        from sqlalchemy import literal_column, text
+
+        source = self.sourcemeta.tables[name]
+        columns = [c.name for c in source.columns if c.name != 'id']
+        rowid = literal_column('rowid')
+        statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(quote(name), ', '.join(quote(c) for c in columns))
+        update = text('UPDATE {} SET lastid = :lastid, lastrowid = :lastrowid, rows = :rows, checksum = :checksum, finished = :finished '
+                      'WHERE source = :source AND tablename = :tablename'.format(quote(progresstable)))
+
+        with self.db.engine.begin() as conn:
+            progress = self.progress(conn, name)
+        if progress['finished'] is not None:
+            if self.verbose: print('Already copied {}'.format(name))
+            return 0
+
+        copied = 0
+        lastid, lastrowid, rows, checksum = progress['lastid'], progress['lastrowid'], progress['rows'], int(progress['checksum'])
+        start = time.perf_counter()
+        with self.sourceengine.connect() as sourceconn:
+            while True:
+                select = (source.select().add_columns(rowid.label('_rowid'))
+                          .where(rowid > lastrowid).order_by(rowid).limit(self.chunksize))
+                chunk = [dict(row._mapping) for row in sourceconn.execute(select)]
+                buffer = io.StringIO()
+                for row in chunk:
+                    lastrowid = row.pop('_rowid')
+                    self.remap(name, row)
+                    values = [row[c] for c in columns]
+                    checksum = (checksum + rowhash(values)) % 2**64
+                    buffer.write(','.join(csvfield(v) for v in values))
+                    buffer.write('\n')
+                buffer.seek(0)
+                rows += len(chunk)
+                finished = None if len(chunk) == self.chunksize else datetime.datetime.now()
+                # The chunk and its progress are committed together
+                with self.db.engine.begin() as conn:
+                    if chunk:
+                        copy_from(conn.connection.dbapi_connection, statement, buffer)
+                        lastid = conn.exec_driver_sql('SELECT MAX(id) FROM {}'.format(quote(name))).scalar()
+                    conn.execute(update, dict(source=self.source, tablename=name, lastid=lastid, lastrowid=lastrowid,
+                                              rows=rows, checksum=checksum, finished=finished))
+                copied += len(chunk)
+                if self.verbose:
+                    print('Copied {}: {} rows, {:.0f} rows/s'.format(name, rows, copied / (time.perf_counter() - start)))
+                if finished is not None:
+                    return copied
+
+    def validate(self, name):
+        """
+        Return the rows and checksum of table name in the source, as copied,
+        and of the ids it was copied to in the target, as (source rows, copied
+        rows, target rows, copied checksum, target checksum)
+        """
+        from sqlalchemy import func, select, text, MetaData, Table
+
+        source = self.sourcemeta.tables[name]
+        columns = [c.name for c in source.columns if c.name != 'id']
+        with self.sourceengine.connect() as conn:
+            sourcerows = conn.execute(select(func.count()).select_from(source)).scalar()
+
+        target = Table(name, MetaData(), autoload_with=self.db.engine)
+        checksum = 0
+        targetrows = 0
+        with self.db.engine.connect() as conn:
+            progress = self.progress(conn, name)
+            lastid = progress['baseid']
+            while True:
+                query = (select(*[target.c[c] for c in ['id'] + columns])
+                         .where(target.c.id > lastid).order_by(target.c.id).limit(self.chunksize))
+                if progress['lastid'] is not None:
+                    query = query.where(target.c.id <= progress['lastid'])
+                chunk = conn.execute(query).fetchall()
+                for row in chunk:
+                    checksum = (checksum + rowhash(row[1:])) % 2**64
+                targetrows += len(chunk)
+                if len(chunk) < self.chunksize:
+                    break
+                lastid = chunk[-1][0]
+        return sourcerows, progress['rows'], targetrows, int(progress['checksum']), checksum
+
+    def run(self, validate=True):
+        """
+        Migrate every table, returning True if all of them were validated
+        """
+        dimensiontables, tables = self.tables()
+        self.prepare(dimensiontables + tables)
+
+        with self.db:
+            for name in dimensiontables:
+                self.merge(name)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(self.copy, tables))
+
+        ok = True
+        if validate:
+            for name in tables:
+                sourcerows, copied, targetrows, copiedsum, targetsum = self.validate(name)
+                valid = sourcerows == copied == targetrows and copiedsum == targetsum
+                if not valid:
+                    print('Validation failed for {}: {} source rows, {} copied, {} in target, checksum {} copied, {} in target'.format(
+                          name, sourcerows, copied, targetrows, copiedsum, targetsum))
+                elif self.verbose:
+                    print('Validated {}: {} rows'.format(name, targetrows))
+                ok = ok and valid
+
+        # Indexes for the read API of both kinds of database
+        from .UsageDataset import ProjectDataset
+        from .JobsDataset import JobsDataset
+        ensure_indexes(self.db, dict(ProjectDataset.indexes, **JobsDataset.indexes))
+
+        return ok
+
+def main(args):
+
+    source = args.source
+    if '://' not in source:
+        source = 'sqlite:///{}'.format(os.path.abspath(source))
+    if not source.startswith('sqlite'):
+        print("Source must be a SQLite database: {}".format(args.source))
+        return 1
+    if not args.target.startswith('postgresql'):
+        print("Target must be a PostgreSQL database: {}".format(args.target))
+        return 1
+
+    migration = Migration(source, args.target, chunksize=args.chunksize, workers=args.workers, verbose=args.verbose)
+    if not migration.run(validate=not args.novalidate):
+        return 1
+    return 0
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Copy a SQLite usage or jobs database into PostgreSQL")
+    parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
+    parser.add_argument("-c","--chunksize", help="Rows copied in each transaction", type=int, default=50000)
+    parser.add_argument("-w","--workers", help="Tables copied at once", type=int, default=4)
+    parser.add_argument("--novalidate", help="Do not compare row counts and checksums", action='store_true')
+    parser.add_argument("source", help="SQLite database file or url")
+    parser.add_argument("target", help="PostgreSQL database url")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return profiled(main, parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    sys.exit(main_parse_args(sys.argv[1:]))
+
+if __name__ == "__main__":
+
+    main_argv()
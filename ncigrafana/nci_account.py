@@ -21,52 +21,261 @@ Adapted from nci_account
 """
 
 import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import http.client
 import json
 import os
-import pymunge
-import requests
 import sys
-import urllib
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .UsageDataset import ProjectDataset
+from .parse_account_usage_data import ingest_account_reports
 
 SERVER='http://gadi-pbs-01.gadi.nci.org.au:8811/v0/nciaccount/'
 
-def get_resource(project):
+# Reports are reused for MAXAGE seconds, then revalidated with the server
+CACHEDIR=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ncigrafana', 'nci_account')
+MAXAGE=300.
+
+class FetchError(Exception):
+    pass
+
+def munge_token():
     """
-    Wrap important bit in a function that can be accessed directly
+    Return a new MUNGE credential. A credential cannot be replayed, so one
+    is needed for each request
     """
+    # Only available on NCI systems, so import when actually needed
+    import pymunge
+
+    return pymunge.encode().decode('utf-8')
+
+class AccountClient(object):
+
+    # Responses worth trying again, anything else is returned or raised at once
+    retrystatus = (429, 500, 502, 503, 504)
+
+    def __init__(self, server=SERVER, timeout=30., retries=3, backoff=1., workers=8, token=None,
+                 cachedir=None, max_age=MAXAGE):
+        """
+        Client for the nci_account service at server. Each worker thread keeps
+        its own keep-alive connection. Requests time out after timeout seconds
+        and are retried up to retries times, waiting backoff * 2**attempt seconds
+        between attempts. token returns the Authorization credential, by
+        default a MUNGE token. If cachedir is given reports are saved there and
+        reused for max_age seconds, after which they are revalidated with the
+        server using ETag or Last-Modified if it sent them. Each server has its
+        own directory of reports in cachedir
+        """
+        url = urllib.parse.urlsplit(server)
+        self.scheme, self.netloc, self.path = url.scheme, url.netloc, url.path
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.token = token or munge_token
+        self.cachedir = cachedir
+        self.max_age = max_age
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Return this thread's connection, opening one if needed
+        """
+        if getattr(self.local, 'connection', None) is None:
+            if self.scheme == 'https':
+                self.local.connection = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                self.local.connection = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def close(self):
+        """
+        Close this thread's connection
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def cachefile(self, project):
+        """
+        Return the path of the cached response for project, in a directory
+        named by a hash of the server url
+        """
+        server = hashlib.sha256('{}://{}{}'.format(self.scheme, self.netloc, self.path).encode()).hexdigest()[:16]
+        return os.path.join(self.cachedir, server, '{}.json'.format(project))
+
+    def readcache(self, project):
+        """
+        Return the cached response for project as a dict with the time it was
+        fetched, ETag, Last-Modified and body, or None if there is no usable
+        entry
+        """
+        if self.cachedir is None:
+            return None
+        try:
+            with open(self.cachefile(project)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or 'fetched' not in cached or 'body' not in cached:
+            return None
+        return cached
+
+    def writecache(self, project, cached):
+        """
+        Save the cached response for project, replacing any existing one at once
+        """
+        if self.cachedir is None:
+            return
+        cachefile = self.cachefile(project)
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        # mkstemp creates the file readable only by the user
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmpfile, cachefile)
 
-    url = SERVER + 'project/%s' % project
-    token = pymunge.encode().decode('utf-8')
+    def request(self, project, headers=None):
+        """
+        Make a single request for project, with any extra headers, and return
+        (status, response headers, body)
+        """
+        headers = dict(headers or {})
+        headers.update({"Authorization": "MUNGE %s" % (self.token()),
+                        "Content-Type": "application/json"})
+        connection = self.connection()
+        try:
+            connection.request('GET', self.path + 'project/%s' % project, headers=headers)
+            response = connection.getresponse()
+            # Read the whole body so the connection can be reused
+            body = response.read().decode()
+        except Exception:
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response.status, response.headers, body
 
-    request = urllib.request.Request(url)
-    request.add_header("Authorization", "MUNGE %s" % (token))
-    request.add_header("Content-Type", "application/json")
+    def fetch(self, project):
+        """
+        Return the account report for project as a JSON string. Raises
+        FetchError if it cannot be fetched
+        """
+        cached = self.readcache(project)
+        conditional = {}
+        if cached is not None:
+            if time.time() - cached['fetched'] < self.max_age:
+                return cached['body']
+            if cached.get('etag'):
+                conditional['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                conditional['If-Modified-Since'] = cached['last_modified']
 
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            try:
+                status, headers, body = self.request(project, conditional)
+            except (OSError, http.client.HTTPException) as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+                continue
+            if status == 304 and cached is not None:
+                # Not modified, so the cached report is fresh again
+                cached['fetched'] = time.time()
+                self.writecache(project, cached)
+                return cached['body']
+            if status == 200:
+                self.writecache(project, dict(fetched=time.time(),
+                                              etag=headers.get('ETag'),
+                                              last_modified=headers.get('Last-Modified'),
+                                              body=body))
+                return body
+            error = 'HTTP {}'.format(status)
+            if status not in self.retrystatus:
+                break
+        raise FetchError('Could not fetch accounting report for {}: {}'.format(project, error))
+
+    def fetch_all(self, projects):
+        """
+        Fetch projects concurrently. Returns a list of (project, report) in
+        the same order, where report is the JSON string or the FetchError
+        """
+        def fetch(project):
+            try:
+                return project, self.fetch(project)
+            except FetchError as e:
+                return project, e
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fetch, projects))
+
+def get_resource(project, max_age=MAXAGE):
+    """
+    Wrap important bit in a function that can be accessed directly. Reports
+    fetched in the last max_age seconds are reused from CACHEDIR
+    """
     try:
-        rc = urllib.request.urlopen(request)
-    except urllib.error.HTTPError as e:
+        return AccountClient(retries=0, cachedir=CACHEDIR, max_age=max_age).fetch(project)
+    except FetchError as e:
+        print(e)
         print("Could not fetch accounting report. Please try again later.\n")
         sys.exit(1)
-    finally:
-        res = rc.read().decode()
-        rc.close()
-
-    return res
 
 def main(args):
 
-    # Get project
-    if args.project:
-        project = args.project
+    # Get projects
+    if args.projects:
+        projects = args.projects
+    elif args.project:
+        projects = [args.project]
     else:
         if 'PROJECT' in os.environ:
-            project = os.environ['PROJECT']
+            projects = [os.environ['PROJECT']]
         else:
             print("Please specify --project PROJECT with the project you'd like to view")
             sys.exit(1)
 
-    print(get_resource(project))
+    if args.ingest and not args.dburl:
+        print("Please specify --dburl DBURL to ingest the reports")
+        return 1
 
+    client = AccountClient(args.server, timeout=args.timeout, retries=args.retries, workers=args.workers,
+                           cachedir=None if args.no_cache else args.cachedir, max_age=args.max_age)
+
+    rc = 0
+    reports = []
+    for project, report in client.fetch_all(projects):
+        if isinstance(report, FetchError):
+            print(report, file=sys.stderr)
+            rc = 1
+        else:
+            reports.append(report)
+
+    if not args.ingest:
+        for report in reports:
+            # One report per line, as expected by parse_account_usage_data
+            print(report.strip())
+        return rc
+
+    # Add the reports straight to the database rather than via the log
+    db = ProjectDataset(dburl=args.dburl, profile='ingest')
+    with IngestRun(db, 'nci-account', args.log, url=args.server) as run:
+        with run.stage('parse'):
+            run.parsed, run.written = ingest_account_reports(reports, datetime.datetime.now().astimezone(),
+                                                             args.verbose, db, log=args.log)
+    db.ensure_indexes()
+
+    if run.written < len(projects):
+        rc = 1
+    return rc
 
 def parse_args(args):
     """
@@ -74,8 +283,22 @@ def parse_args(args):
     """
     parser = argparse.ArgumentParser('Return nci account data as json')
     parser.add_argument("-P", "--project", help="project to view")
+    parser.add_argument("--projects", help="projects to view, fetched concurrently", nargs='+')
+    parser.add_argument("-s", "--server", help="nci_account service url", default=SERVER)
+    parser.add_argument("-w", "--workers", help="number of concurrent requests", type=int, default=8)
+    parser.add_argument("-t", "--timeout", help="seconds to wait for each request", type=float, default=30.)
+    parser.add_argument("-r", "--retries", help="times to retry a failed request", type=int, default=3)
+    parser.add_argument("--cachedir", help="directory to cache reports in", default=CACHEDIR)
+    parser.add_argument("--max-age", help="seconds to reuse a cached report before revalidating it", type=float, default=MAXAGE)
+    parser.add_argument("--no-cache", help="do not read or write cached reports", action='store_true')
+    parser.add_argument("-i", "--ingest", help="add reports to the database instead of printing them", action='store_true')
+    parser.add_argument("-db","--dburl", help="Database file url for --ingest", default=None)
+    parser.add_argument("-l", "--log", help="also append reports to this nci_account log with --ingest", default=None)
+    parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
+
+    add_profile_arguments(parser)
 
-    return parser.parse_args()
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -83,13 +306,13 @@ def main_parse_args(args):
     """
     # Must return so that check command return value is passed back to calling routine
     # otherwise py.test will fail
-    return main(parse_args(args))
+    return profiled(main, parse_args(args))
 
 def main_argv():
     """
     Call main and pass command line arguments. This is required for setup.py entry_points
     """
-    main_parse_args(sys.argv[1:])
+    sys.exit(main_parse_args(sys.argv[1:]))
 
 if __name__ == "__main__":
 
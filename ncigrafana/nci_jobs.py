@@ -26,25 +26,26 @@ import os
 import datetime
 import argparse
 # import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.dates import MONDAY, DayLocator, WeekdayLocator, MonthLocator, DateFormatter, drange
-from matplotlib.dates import AutoDateFormatter, AutoDateLocator, num2date
-import matplotlib.patches as mpatches
-from matplotlib.colors import ListedColormap
-import numpy as np
-from numpy import arange
 import random
 from itertools import cycle, islice
 
 from collections import OrderedDict
-import pandas as pd
 from getpass import getuser
 
 # from make_usage_db import *
 from ncigrafana.JobsDataset import *
 from ncigrafana.DBcommon import *
 
-plt.style.use('ggplot')
+# matplotlib, numpy and pandas are imported when first needed by the
+# plotting routines so the module itself imports quickly
+
+def pyplot():
+    """
+    Import and style matplotlib on first use
+    """
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    return plt
 
 
 # From http://tools.medialab.sciences-po.fr/iwanthue/
@@ -55,12 +56,12 @@ brewer_qualitative = [
     '#a6cee3','#1f78b4','#b2df8a','#33a02c','#fb9a99','#e31a1c','#fdbf6f','#ff7f00','#cab2d6','#6a3d9a','#ffff99','#b15928',
     ] * 5 
 
-cm = ListedColormap(brewer_qualitative, "myhues")
-
 def getidealdates(start, end, deltadays=1):
+    from matplotlib.dates import drange
     return drange(start, end, datetime.timedelta(days=deltadays))
 
 def get_ideal_SU_usage(db, year, quarter, total_grant):
+    from numpy import arange
     startdate, enddate = db.getstartend(year, quarter, asdate=True)
     dates = getidealdates(startdate, enddate, 1)
     usage = arange(len(dates))*(total_grant/len(dates))
@@ -82,6 +83,7 @@ def sort_table_by_last_row(df):
     df.sort_values(df.last_valid_index(), axis=1, inplace=True, ascending=False)
 
 def plot_usage(db,project,system,year,quarter,byuser,total,users,pdf=False):
+    import pandas as pd
 
     dp = db.getusage(year, quarter)
 
@@ -121,6 +123,8 @@ def plot_usage(db,project,system,year,quarter,byuser,total,users,pdf=False):
     plot_dataframe(dp, type='line', ylabel=ylabel, title=title, ideal=ideal, outfile=outfile, legend=byuser)
 
 def plot_dataframe(df, type='line', xlabel=None, ylabel=None, title=None, cutoff=None, ideal=None, outfile=None, legend=True, sort=True, delta=False):
+    from matplotlib.colors import ListedColormap
+    plt = pyplot()
 
     if any(d == 0 for d in df.shape):
         print("No data to plot")
@@ -191,6 +195,9 @@ def main():
     args = parser.parse_args()
     plot_by_user = False
 
+    import pandas as pd
+    plt = pyplot()
+
     if args.period is not None:
         year, quarter = args.period.split(".")
     else:
@@ -201,16 +208,12 @@ def main():
 
     dbfile = 'sqlite:///'+os.path.join(args.database)
     try:
-        db = JobsDataset(dbfile)
+        db = JobsDataset(dbfile, profile='readonly')
     except:
         print("ERROR! You are not a member of this group: ",project)
     else:
 
-        df = db.getjobs()
-
-        if df.empty:
-            raise ValueError("No data returned for this query")
-
+        project = None
         if args.project:
             project = []
             for p in args.project:
@@ -222,6 +225,27 @@ def main():
                     project.append(p)
             project = set(project)
             print(project)
+
+        # Mean wait times can be read from the daily rollup rather than raw jobs,
+        # as long as no per-user selection is required and the rollup covers
+        # every job, which it may not in databases made before it existed
+        rollupvars = ('project', 'queue', 'ncpusbin')
+        if (args.plotvar == 'waittime' and args.users is None
+                and args.groupvar in rollupvars and args.splitvar in rollupvars
+                and db.jobstatscurrent()):
+            df = db.getjobstats(projects=None if project is None else sorted(project))
+            if df is not None and not df.empty:
+                df = df.groupby([args.groupvar, args.splitvar], observed=True)[['waittime', 'count']].sum()
+                (df.waittime / df['count']).unstack(args.splitvar).plot(kind='bar')
+                if not args.noshow: plt.show()
+                return
+
+        df = db.getjobs()
+
+        if df.empty:
+            raise ValueError("No data returned for this query")
+
+        if project is not None:
             df = df.loc[df.project.isin(project),]
 
         users = None
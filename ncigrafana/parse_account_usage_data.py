@@ -23,7 +23,6 @@ from __future__ import print_function
 import argparse
 import gzip
 import datetime
-import json
 from math import log
 import os
 import pwd
@@ -31,90 +30,146 @@ import re
 import shutil
 import sys
 
-from .UsageDataset import *
+from .UsageDataset import ProjectDataset
 from .DBcommon import extract_num_unit, parse_size, mkdir, archive, parse_inodenum
-from .DBcommon import datetoyearquarter, date_range_from_quarter
+from .DBcommon import datetoyearquarter, date_range_from_quarter, json_loads
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .Records import Records, add_records_arguments, records_directory
 
 databases = {}
 dbfileprefix = '.'
 
-def parse_account_dump_file(filename, verbose, db=None, dburl=None):
+def add_account_quarter(date, verbose, records):
+    """
+    Add the quarter containing date, the date nci_account reports were fetched
+    """
+    year, quarter = datetoyearquarter(date)
+    startdate, enddate = date_range_from_quarter(year,quarter)
+    if verbose: print('Adding quarter: ', year, quarter, startdate, enddate) 
+    records.add('quarters', year, quarter, startdate, enddate)
 
-    with open(filename) as f:
+def parse_account_report(line, date, verbose, records):
+    """
+    Add the records from one nci_account JSON report, fetched on date, to
+    records. Returns True if it was added
+    """
+    try:
+        resources = json_loads(line)
+    except Exception as e:
+        print(e)
+        return False
+
+    if resources['status'] == 200:
+        project = resources['project']
+    else:
+        print('Error {code}: {msg}'.format(code=resources['status'], msg=resources['message']))
+        return False
+
+    year, quarter = datetoyearquarter(date)
+
+    system = 'gadi'
+    # Make a bogus queue name called combine while we have no breakdown of usage by queue
+    queue = 'combined'
+    weight = 2
+    records.add('systemqueues', system, queue, weight)
+
+    usecpu = -999.
+    usewall = -999.
+    efficiency = '-999'
+
+    for scheme in resources['usage']['stakeholders']:
 
-        insystem = False; instorage = False; inuser = False; inusage=False
-        project = None
-    
-        parsing = False
+        if verbose: print('Add scheme ', project, scheme)
+        records.add('schemes', scheme)
 
-        year = ''; quarter = ''
-        system = ''; date = ''
+        grantsu = resources['usage']['stakeholders'][scheme]['grant']
+        if verbose: print('Add scheme grants ', project, system, scheme, year, quarter, date, grantsu)
+        records.add('usagegrants', project, system, scheme, year, quarter, date, grantsu)
+
+        su = resources['usage']['stakeholders'][scheme]['balance']
+        if verbose: print('Add scheme usage ', project, system, scheme, date, su)
+        records.add('schemeusage', project, system, scheme, date, usecpu, usewall, su)
+
+    usesu = resources['usage']['used']
+
+    if verbose: print('Add project usage ',date,system,queue,usecpu,usewall,usesu)
+    records.add('projectusage', project, system, queue, date, usecpu, usewall, usesu)
+
+    for user in resources['usage']['users']:
+        usesu = resources['usage']['users'][user]['usage']
+
+        if verbose: print('Add usage ',date,user,usecpu,usewall,usesu,efficiency)
+        records.add('userusage', project, user, date, usecpu, usewall, usesu, efficiency)
+
+    # if verbose: print('Add project storage grant',project, system, storagepoint, scheme, 
+    #                    year, quarter, date, storagetype, parsed_value)
+    # db.addstoragegrant(project, system, storagepoint, scheme, year, quarter, 
+    #                    date, storagetype, parsed_value)
+
+    return True
+
+def account_dump_records(filename, verbose):
+    """
+    Parse an nci_account log into Records
+    """
+
+    records = Records('nci-account', filename)
+
+    with open(filename) as f:
+
+        date = ''
 
         for line in f:
             line = line.rstrip(os.linesep)
-            resources = None
             if verbose: print(line)
             if line.startswith("%%%%%%%%%%%%%%%%"):
                 # Grab date string
                 date = datetime.datetime.strptime(f.readline().rstrip(os.linesep), "%a %b %d %H:%M:%S %Z %Y").date()
-                year, quarter = datetoyearquarter(date)
-                startdate, enddate = date_range_from_quarter(year,quarter)
-                if verbose: print('Adding quarter: ', year, quarter, startdate, enddate) 
-                db.addquarter(year, quarter, startdate, enddate)
-                parsing = True
+                add_account_quarter(date, verbose, records)
             else:
-                try:
-                    resources = json.loads(line)
-                except Exception as e:
-                    parsing = False
-                    print(e)
-                    continue
-
-                if resources['status'] == 200:
-                    project = resources['project']
-                else:
-                    parsing = False
-                    print('Error {code}: {msg}'.format(code=resources['status'], msg=resources['message']))
-                    continue
-
-                system = 'gadi'
-                # Make a bogus queue name called combine while we have no breakdown of usage by queue
-                queue = 'combined'
-                weight = 2
-                db.addsystemqueue(system, queue, weight)
-
-                usecpu = -999.
-                usewall = -999.
-                efficiency = '-999'
-
-                for scheme in resources['usage']['stakeholders']:
-
-                    if verbose: print('Add scheme ', project, scheme)
-                    db.addscheme(scheme)
-
-                    grantsu = resources['usage']['stakeholders'][scheme]['grant']
-                    if verbose: print('Add scheme grants ', project, system, scheme, year, quarter, date, grantsu)
-                    db.addusagegrant(project, system, scheme, year, quarter, date, grantsu)
-
-                    su = resources['usage']['stakeholders'][scheme]['balance']
-                    if verbose: print('Add scheme usage ', project, system, scheme, date, su)
-                    db.addschemeusage(project, system, scheme, date, usecpu, usewall, su)
-
-                usesu = resources['usage']['used']
-
-                if verbose: print('Add project usage ',date,system,queue,usecpu,usewall,usesu)
-                db.addprojectusage(project, system, queue, date, usecpu, usewall, usesu)
-
-                for user in resources['usage']['users']:
-                    usesu = resources['usage']['users'][user]['usage']
-
-                    if verbose: print('Add usage ',date,user,usecpu,usewall,usesu,efficiency)
-                    db.adduserusage(project, user, date, usecpu, usewall, usesu, efficiency)
-
-                # if verbose: print('Add project storage grant',project, system, storagepoint, scheme, 
-                #                    year, quarter, date, storagetype, parsed_value)
-                # db.addstoragegrant(project, system, storagepoint, scheme, year, quarter, 
-                #                    date, storagetype, parsed_value)
+                records.parsed += 1
+                if parse_account_report(line, date, verbose, records):
+                    records.accepted += 1
+
+    return records
+
+def parse_account_dump_file(filename, verbose, db=None, dburl=None):
+    """
+    Parse an nci_account log into db. Returns the number of project records
+    read and the number successfully added
+    """
+    records = account_dump_records(filename, verbose)
+    records.load(db)
+    return records.parsed, records.accepted
+
+def ingest_account_reports(reports, fetched, verbose, db, log=None):
+    """
+    Add nci_account JSON reports, fetched at datetime fetched, straight to
+    db in one transaction. If log is given the reports are also appended to
+    it in the format read by parse_account_dump_file. Returns the number of
+    reports read and the number successfully added
+    """
+
+    if log is not None:
+        with open(log, 'a') as f:
+            f.write("%%%%%%%%%%%%%%%%%\n")
+            f.write(fetched.strftime("%a %b %d %H:%M:%S %Z %Y") + "\n")
+            for report in reports:
+                f.write(report.strip() + "\n")
+
+    records = Records('nci-account', log)
+
+    date = fetched.date()
+    add_account_quarter(date, verbose, records)
+    for report in reports:
+        records.parsed += 1
+        if parse_account_report(report.strip(), date, verbose, records):
+            records.accepted += 1
+
+    with db.db:
+        records.load(db)
+
+    return records.parsed, records.accepted
                                    
 def main(args):
 
@@ -122,17 +177,34 @@ def main(args):
 
     db = None
     if args.dburl:
-        db = ProjectDataset(dburl=args.dburl)
+        db = ProjectDataset(dburl=args.dburl, cachedir=args.cachedir, profile='ingest')
 
     for f in args.inputs:
         if verbose: print(f)
-        try:
-            parse_account_dump_file(f, verbose, db=db)
-        except:
-            raise
-        else:
+        if args.output:
+            # Only parse, leaving loading the records for later
+            account_dump_records(f, verbose).write(records_directory(args.output, f), args.format)
             if not args.noarchive:
                 archive(f)
+            continue
+        with IngestRun(db, 'nci-account', f) as run:
+            try:
+                with run.stage('parse'):
+                    records = account_dump_records(f, verbose)
+                with run.stage('load'):
+                    records.load(db, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+            except:
+                raise
+            else:
+                if not args.noarchive:
+                    with run.stage('archive'):
+                        archive(f)
+
+    if db is not None:
+        # Indexes for the read API are created once tables exist
+        db.ensure_indexes()
+        db.updatecubes()
 
 def parse_args(args):
     """
@@ -143,9 +215,13 @@ def parse_args(args):
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
     parser.add_argument("-db","--dburl", help="Database file url", default=None)
     parser.add_argument("-n","--noarchive", help="Database file url", action='store_true')
+    parser.add_argument("-c","--cachedir", help="Update usage cubes in this directory", default=None)
     parser.add_argument("inputs", help="dumpfiles", nargs='+')
 
-    return parser.parse_args()
+    add_records_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -153,7 +229,7 @@ def main_parse_args(args):
     """
     # Must return so that check command return value is passed back to calling routine
     # otherwise py.test will fail
-    return main(parse_args(args))
+    return profiled(main, parse_args(args))
 
 def main_argv():
     """
@@ -27,15 +27,22 @@ import os
 import sys
 import re
 import shutil
-from .UsageDataset import *
+from .UsageDataset import ProjectDataset
 from .DBcommon import extract_num_unit, parse_size, mkdir, archive
 from .DBcommon import datetoyearquarter, date_range_from_quarter
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .Records import Records, add_records_arguments, records_directory
 
 databases = {}
 dbfileprefix = '.'
 nfields = 7
 
-def parse_lquota(filename, verbose, db=None, dburl=None):
+def lquota_records(filename, verbose):
+    """
+    Parse an lquota log into Records
+    """
+
+    records = Records('lquota', filename)
 
     project = None
 
@@ -58,7 +65,7 @@ def parse_lquota(filename, verbose, db=None, dburl=None):
                                                   "%a %b %d %H:%M:%S %Z %Y")
                 year, quarter = datetoyearquarter(date)
                 startdate, enddate = date_range_from_quarter(year,quarter)
-                db.addquarter(year, quarter, startdate, enddate)
+                records.add('quarters', year, quarter, startdate, enddate)
                 continue
 
             if line.lstrip().startswith("fs") and line.rstrip().endswith("iLimit"): 
@@ -74,11 +81,16 @@ def parse_lquota(filename, verbose, db=None, dburl=None):
                     parsing_usage = False
                     continue
 
-                project,storagepoint,size,size_quota,_,inodes,inodes_quota,_ = line.strip(os.linesep).split(maxsplit=nfields)
-                size=float(size)
-                size_quota=float(size_quota)
-                inodes=int(inodes)
-                inodes_quota=int(inodes_quota)
+                records.parsed += 1
+                try:
+                    project,storagepoint,size,size_quota,_,inodes,inodes_quota,_ = line.strip(os.linesep).split(maxsplit=nfields)
+                    size=float(size)
+                    size_quota=float(size_quota)
+                    inodes=int(inodes)
+                    inodes_quota=int(inodes_quota)
+                except ValueError:
+                    print("Failed to parse lquota line: {}".format(line.strip(os.linesep)))
+                    continue
                 #array = line.strip(os.linesep).split(maxsplit=nfields)
                 #project = array[0]
                 #storagepoint = array[1]
@@ -98,22 +110,35 @@ def parse_lquota(filename, verbose, db=None, dburl=None):
                 system = 'gadi'
                 scheme = 'Combined'
 
-                db.addscheme(scheme)
+                records.add('schemes', scheme)
 
                 if verbose: print('Add project storage ', project, system, storagepoint, date, size, inodes)
-                db.addprojectstorage(project, system, storagepoint, date, size, inodes)
+                records.add('projectstorage', project, system, storagepoint, date, size, inodes)
 
                 storagetype = 'capacity'
                 if verbose: print('Add project storage grant', project, system, storagepoint, scheme, 
                                    year, quarter, date, storagetype, size_quota)
-                db.addstoragegrant(project, system, storagepoint, scheme, year, quarter, 
-                                           str(date.date()), storagetype, size_quota)
+                records.add('storagegrants', project, system, storagepoint, scheme, year, quarter, 
+                            str(date.date()), storagetype, size_quota)
 
                 storagetype = 'inodes'
                 if verbose: print('Add project storage grant', project, system, storagepoint, scheme, 
                                    year, quarter, date, storagetype, inodes_quota)
-                db.addstoragegrant(project, system, storagepoint, scheme, year, quarter, 
-                                           str(date.date()), storagetype, inodes_quota)
+                records.add('storagegrants', project, system, storagepoint, scheme, year, quarter, 
+                            str(date.date()), storagetype, inodes_quota)
+
+                records.accepted += 1
+
+    return records
+
+def parse_lquota(filename, verbose, db=None, dburl=None):
+    """
+    Parse an lquota log into db. Returns the number of storage records read
+    and added
+    """
+    records = lquota_records(filename, verbose)
+    records.load(db)
+    return records.parsed, records.accepted
 
 """
 --------------------------------------------------------------------------
@@ -132,16 +157,40 @@ def main(args):
 
     db = None
     if args.dburl:
-        db = ProjectDataset(dburl=args.dburl)
+        db = ProjectDataset(dburl=args.dburl, profile='ingest')
 
     for f in args.inputs:
-        try:
-            parse_lquota(f, verbose, db=db)
-        except:
-            raise
-        else:
-            if not args.noarchive:
+        if args.output:
+            # Only parse, leaving loading the records for later
+            records = lquota_records(f, verbose)
+            records.write(records_directory(args.output, f), args.format)
+            if records.rejected:
+                print("Not archiving {}: {} entries could not be parsed".format(f, records.rejected))
+            elif not args.noarchive:
                 archive(f)
+            continue
+        with IngestRun(db, 'lquota', f) as run:
+            try:
+                with run.stage('parse'):
+                    records = lquota_records(f, verbose)
+                with run.stage('load'):
+                    records.load(db, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+            except:
+                raise
+            else:
+                # Keep a file with entries that could not be parsed, so
+                # they are not lost once fixed
+                if records.rejected:
+                    run.error = "{} entries could not be parsed, not archived".format(records.rejected)
+                    print("Not archiving {}: {} entries could not be parsed".format(f, records.rejected))
+                elif not args.noarchive:
+                    with run.stage('archive'):
+                        archive(f)
+
+    if db is not None:
+        # Indexes for the read API are created once tables exist
+        db.ensure_indexes()
 
 def parse_args(args):
     """
@@ -153,7 +202,10 @@ def parse_args(args):
     parser.add_argument("-n","--noarchive", help="Database file url", action='store_true')
     parser.add_argument("inputs", help="dumpfiles", nargs='+')
 
-    return parser.parse_args()
+    add_records_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -161,7 +213,7 @@ def main_parse_args(args):
     """
     # Must return so that check command return value is passed back to calling routine
     # otherwise py.test will fail
-    return main(parse_args(args))
+    return profiled(main, parse_args(args))
 
 def main_argv():
     """
@@ -21,20 +21,26 @@ limitations under the License.
 from __future__ import print_function
 
 import argparse
-import json
 import os
 import sys
 import pwd
 import grp
 import datetime
 
-from .UsageDataset import *
-from .DBcommon import date_range_from_quarter, datetoyearquarter, archive
+from .UsageDataset import ProjectDataset
+from .DBcommon import date_range_from_quarter, datetoyearquarter, archive, json_loads
+from .Profiler import add_profile_arguments, profiled, IngestRun
+from .Records import Records, add_records_arguments, records_directory
 
 databases = {}
 dbfileprefix = '.'
 
-def parse_file_report(filename, verbose, db=None, dburl=None):
+def file_report_records(filename, verbose):
+    """
+    Parse a nci-files-report json dump into Records
+    """
+
+    records = Records('file-report', filename)
 
     # Filename contains project and storage point information
     (_, _, storagepoint, _) = os.path.basename(filename).split('.')
@@ -47,22 +53,33 @@ def parse_file_report(filename, verbose, db=None, dburl=None):
     elif storagepoint == 'scratch':
         system = 'gadi'
 
-    with open(filename) as f:
-        all_data=json.loads(f.read())
+    with open(filename, 'rb') as f:
+        all_data=json_loads(f.read())
         
     ### Grab timestamp - pretend there are no cross-quarter entries
     datestamp = datetime.datetime.fromisoformat(all_data[0]["scan_time"])
     year, quarter = datetoyearquarter(datestamp)
     startdate, enddate = date_range_from_quarter(year,quarter)
-    db.addquarter(year,quarter,startdate,enddate)
+    records.add('quarters', year, quarter, startdate, enddate)
     
     for entry in all_data:
+        records.parsed += 1
+        try:
+            ### Derived from nci-files-report client (formatters/table.py)
+            size = 512 * int(entry['blocks']['single'] + entry['blocks']['multiple'])
+            inodes = int(entry['count']['single'] + entry['count']['multiple'])
+            scandate = entry['scan_time'][:10]
+            uid, gid, entryproject = entry['uid'], entry['gid'], entry['project']
+        except (KeyError, TypeError, ValueError) as e:
+            print("Failed to parse file report entry: {} {!r}".format(entry, e))
+            continue
+
         ### Handle uids that don't exist
         try:
-            user = pwd.getpwuid(entry['uid']).pw_name
+            user = pwd.getpwuid(uid).pw_name
         except KeyError:
-            user = str(entry['uid'])
-        db.adduser(user)
+            user = str(uid)
+        records.add('users', user)
 
         if storagepoint == 'scratch':
         # Swap folder and proj in the case of scratch as it is now accounted for by 
@@ -70,41 +87,74 @@ def parse_file_report(filename, verbose, db=None, dburl=None):
         # overwrite previous ones unless values of folder and proj are swapped
             ### Handle gids that don't exist
             try:
-                folder=grp.getgrgid(entry['gid']).gr_name
+                folder=grp.getgrgid(gid).gr_name
             except KeyError:
-                folder=str(entry['gid'])
-            project=entry['project']
+                folder=str(gid)
+            project=entryproject
         else:
-            folder=entry['project']
+            folder=entryproject
             ### Handle gids that don't exist
             try:
-                project=grp.getgrgid(entry['gid']).gr_name
+                project=grp.getgrgid(gid).gr_name
             except KeyError:
-                project=str(entry['gid'])
-
-        ### Derived from nci-files-report client (formatters/table.py)
-        size = 512 * int(entry['blocks']['single'] + entry['blocks']['multiple'])
-        inodes = int(entry['count']['single'] + entry['count']['multiple'])
+                project=str(gid)
 
         if verbose:
             ### Date comes out in iso format, first 10 characters will be YYYY-MM-DD
-            print(f"Adding {project}, {user}, {system}, {storagepoint}, {entry['scan_time'][:10]}, {folder}, {size}, {inodes}")
-        db.adduserstorage(project,user,system,storagepoint,entry['scan_time'][:10],folder,size,inodes)
+            print(f"Adding {project}, {user}, {system}, {storagepoint}, {scandate}, {folder}, {size}, {inodes}")
+        records.add('userstorage', project, user, system, storagepoint, scandate, folder, size, inodes)
+        records.accepted += 1
+
+    return records
+
+def parse_file_report(filename, verbose, db=None, dburl=None):
+    """
+    Parse a nci-files-report json dump into db. Returns the number of
+    entries read and added
+    """
+    records = file_report_records(filename, verbose)
+    records.load(db)
+    return records.parsed, records.accepted
 
 def main(args):
 
     db = None
     if args.dburl:
-        db = ProjectDataset(dburl=args.dburl)
+        db = ProjectDataset(dburl=args.dburl, cachedir=args.cachedir, profile='ingest')
 
     for f in args.inputs:
-        try:
-            parse_file_report(f,args.verbose,db=db)
-        except:
-            raise
-        else:
-            if not args.noarchive:
+        if args.output:
+            # Only parse, leaving loading the records for later
+            records = file_report_records(f, args.verbose)
+            records.write(records_directory(args.output, f), args.format)
+            if records.rejected:
+                print("Not archiving {}: {} entries could not be parsed".format(f, records.rejected))
+            elif not args.noarchive:
                 archive(f)
+            continue
+        with IngestRun(db, 'file-report', f) as run:
+            try:
+                with run.stage('parse'):
+                    records = file_report_records(f, args.verbose)
+                with run.stage('load'):
+                    records.load(db, copy=args.copy)
+                run.parsed, run.written = records.parsed, records.accepted
+            except:
+                raise
+            else:
+                # Keep a file with entries that could not be parsed, so
+                # they are not lost once fixed
+                if records.rejected:
+                    run.error = "{} entries could not be parsed, not archived".format(records.rejected)
+                    print("Not archiving {}: {} entries could not be parsed".format(f, records.rejected))
+                elif not args.noarchive:
+                    with run.stage('archive'):
+                        archive(f)
+
+    if db is not None:
+        # Indexes for the read API are created once tables exist
+        db.ensure_indexes()
+        db.updatecubes()
 
 def parse_args(args):
     """
@@ -115,9 +165,13 @@ def parse_args(args):
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
     parser.add_argument("-db","--dburl", help="Database file url", default=None)
     parser.add_argument("-n","--noarchive", help="Database file url", action='store_true')
+    parser.add_argument("-c","--cachedir", help="Update usage cubes in this directory", default=None)
     parser.add_argument("inputs", help="dumpfiles", nargs='+')
 
-    return parser.parse_args()
+    add_records_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -125,7 +179,7 @@ def main_parse_args(args):
     """
     # Must return so that check command return value is passed back to calling routine
     # otherwise py.test will fail
-    return main(parse_args(args))
+    return profiled(main, parse_args(args))
 
 def main_argv():
     """
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ARC Centre of Excellence for Climate Extremes
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Grafana simple JSON datasource, also usable with the Infinity plugin, serving
+the usage and jobs databases. Implements /search, /query and /annotations.
+Query targets are slash separated:
+
+    usage/<field>/<project>                   a series per user, field is usage_su, usage_cpu or usage_wall
+    storage/<field>/<project>/<storagepoint>  a series per user, field is size or inodes
+    jobs/<field>[/<project>]                  a series per queue from the JobStatsDaily rollup,
+                                              field is count, corehours or su
+
+Annotations are the IngestRuns of each database, optionally only those with
+the source given as the annotation query.
+
+Results are kept in a cache shared by all requests for --ttl seconds, and
+identical queries arriving while one is being computed wait for its result
+rather than querying the database again
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import json
+import sys
+import threading
+import time
+import traceback
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .UsageDataset import ProjectDataset
+from .JobsDataset import JobsDataset
+from .Profiler import add_profile_arguments, profiled
+
+jobfields = ('count', 'corehours', 'su')
+
+class ResultCache(object):
+
+    def __init__(self, ttl=60., maxsize=256):
+        """
+        Thread safe cache of up to maxsize results, each kept for ttl seconds
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.results = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, compute):
+        """
+        Return the cached result for key, otherwise call compute() to make it.
+        Callers asking for a key that is already being computed wait for that
+        result. Exceptions are passed to all waiting callers and not cached
+        """
+        with self.lock:
+            if key in self.results:
+                expires, value = self.results[key]
+                if expires > time.monotonic():
+                    self.results.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.results[key]
+            owner = key not in self.pending
+            if owner:
+                self.pending[key] = (threading.Event(), {})
+                self.misses += 1
+            else:
+                self.coalesced += 1
+            done, result = self.pending[key]
+
+        if not owner:
+            done.wait()
+            if 'error' in result:
+                raise result['error']
+            return result['value']
+
+        try:
+            result['value'] = compute()
+        except Exception as e:
+            result['error'] = e
+            raise
+        else:
+            with self.lock:
+                self.results[key] = (time.monotonic() + self.ttl, result['value'])
+                while len(self.results) > self.maxsize:
+                    self.results.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            done.set()
+        return result['value']
+
+    def stats(self):
+        return dict(size=len(self.results), hits=self.hits, misses=self.misses, coalesced=self.coalesced)
+
+def parse_time(timestring):
+    """
+    Return the date of a Grafana ISO 8601 time such as 2019-07-01T00:00:00.000Z
+    """
+    return datetime.datetime.strptime(timestring[:10], "%Y-%m-%d").date()
+
+def timeseries(df, column, value, label=str):
+    """
+    Return a Grafana time series for each value of column in the long
+    format dataframe df, which has a date column
+    """
+    import pandas as pd
+
+    series = []
+    for name, group in df.groupby(column, sort=True):
+        times = (group['date'] - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)
+        series.append({'target': label(name),
+                       'datapoints': [[float(v), int(t)] for v, t in zip(group[value], times)]})
+    return series
+
+class Datasource(object):
+
+    def __init__(self, usagedb=None, jobsdb=None, ttl=60., maxsize=256):
+        """
+        Serve usagedb, a ProjectDataset, and jobsdb, a JobsDataset, either
+        of which may be None
+        """
+        self.usagedb = usagedb
+        self.jobsdb = jobsdb
+        self.cache = ResultCache(ttl, maxsize)
+
+    def targets(self):
+        """
+        Return all valid query targets
+        """
+        targets = []
+        if self.usagedb is not None:
+            projects = sorted(self.usagedb.getprojects())
+            storagepoints = sorted(set(r['storagepoint'] for r in self.usagedb.readdb['StoragePoints'].find()))
+            for project in projects:
+                for field in self.usagedb.usagefields:
+                    targets.append('usage/{}/{}'.format(field, project))
+                for field in self.usagedb.storagefields:
+                    for storagepoint in storagepoints:
+                        targets.append('storage/{}/{}/{}'.format(field, project, storagepoint))
+        if self.jobsdb is not None:
+            projects = sorted(r['project'] for r in self.jobsdb.readdb['Project'].find())
+            for field in jobfields:
+                targets.append('jobs/{}'.format(field))
+                for project in projects:
+                    targets.append('jobs/{}/{}'.format(field, project))
+        return targets
+
+    def search(self, body):
+        target = body.get('target') or ''
+        return [t for t in self.cache.get(('search',), self.targets) if t.startswith(target)]
+
+    def series(self, target, start, end):
+        """
+        Return the Grafana time series for target between dates start and end
+        """
+        kind, _, rest = target.partition('/')
+        parts = rest.split('/')
+        if kind in ('usage', 'storage') and self.usagedb is not None:
+            if kind == 'usage' and len(parts) == 2:
+                field, project = parts
+                storagepoints = None
+            elif kind == 'storage' and len(parts) == 3:
+                field, project, storagepoint = parts
+                storagepoints = [storagepoint]
+            else:
+                raise ValueError('Incorrect target: {}'.format(target))
+            df = self.usagedb.query_usage(projects=project, storagepoints=storagepoints,
+                                          start=start, end=end, fields=field)
+            df['name'] = ['{} ({})'.format(fullname or '', user) for fullname, user in zip(df.fullname, df.user)]
+            return timeseries(df, 'name', field)
+        elif kind == 'jobs' and self.jobsdb is not None and len(parts) in (1, 2):
+            field = parts[0]
+            if field not in jobfields:
+                raise ValueError('Incorrect jobs field: {} Valid values are {}'.format(field, jobfields))
+            projects = parts[1:] or None
+            df = self.jobsdb.getjobstats(start, end, projects=projects)
+            if df is None:
+                return []
+            df = df.groupby(['date', 'queue'], as_index=False)[field].sum()
+            return timeseries(df, 'queue', field)
+        raise ValueError('Unknown target: {}'.format(target))
+
+    def query(self, body):
+        start, end = parse_time(body['range']['from']), parse_time(body['range']['to'])
+        results = []
+        for target in body.get('targets', []):
+            if target.get('hide') or not target.get('target'):
+                continue
+            # Data are daily, so the key is by date to share results between panels
+            key = ('query', target['target'], start, end)
+            results.extend(self.cache.get(key, lambda: self.series(target['target'], start, end)))
+        return results
+
+    def ingestruns(self, source, start, end):
+        annotations = []
+        for db in (self.usagedb, self.jobsdb):
+            if db is None:
+                continue
+            df = db.getingestruns(source=source or None, startdate=start, enddate=end)
+            if df is None or df.empty:
+                continue
+            for started, run in df.iterrows():
+                text = '{}: {} rows written, {} errors'.format(run['filename'], run['written'], run['errors'])
+                if isinstance(run['error'], str):
+                    text += ' ' + run['error']
+                annotations.append({'time': int(started.timestamp() * 1000),
+                                    'title': '{} ingest'.format(run['source']),
+                                    'text': text,
+                                    'tags': [run['source']]})
+        return annotations
+
+    def annotations(self, body):
+        start, end = parse_time(body['range']['from']), parse_time(body['range']['to'])
+        annotation = body.get('annotation', {})
+        source = annotation.get('query')
+        end = end + datetime.timedelta(days=1)
+        runs = self.cache.get(('annotations', source, start, end), lambda: self.ingestruns(source, start, end))
+        return [dict(run, annotation=annotation) for run in runs]
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, code, data):
+        content = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        # Grafana tests the datasource connection with GET /
+        if self.path.rstrip('/') == '':
+            self.reply(200, dict(status='ok', cache=self.server.datasource.cache.stats()))
+        else:
+            self.reply(404, dict(error='Not found: {}'.format(self.path)))
+
+    def do_POST(self):
+        datasource = self.server.datasource
+        routes = {'/search': datasource.search,
+                  '/query': datasource.query,
+                  '/annotations': datasource.annotations}
+        route = routes.get(self.path.rstrip('/'))
+        if route is None:
+            self.reply(404, dict(error='Not found: {}'.format(self.path)))
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            result = route(body)
+        except (ValueError, KeyError) as e:
+            self.reply(400, dict(error=str(e)))
+        except Exception as e:
+            # Report anything else, e.g. a database error, to the client
+            # rather than dropping the connection
+            print("Error handling {}".format(self.path), file=sys.stderr)
+            traceback.print_exc()
+            self.reply(500, dict(error='{}: {}'.format(type(e).__name__, e)))
+        else:
+            self.reply(200, result)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def make_server(datasource, host='localhost', port=8080, verbose=False):
+    """
+    Return a threaded HTTP server for datasource. Port 0 picks a free port
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.datasource = datasource
+    server.verbose = verbose
+    return server
+
+def main(args):
+
+    # Request threads each hold a pooled connection while querying
+    pool = dict(pool_size=args.pool_size)
+
+    usagedb = None
+    if args.dburl:
+        usagedb = ProjectDataset(dburl=args.dburl, profile='readonly', pool=pool)
+
+    jobsdb = None
+    if args.jobsdburl:
+        jobsdb = JobsDataset(args.jobsdburl, profile='readonly', pool=pool)
+
+    if usagedb is None and jobsdb is None:
+        print('Specify at least one of --dburl and --jobsdburl')
+        return 1
+
+    server = make_server(Datasource(usagedb, jobsdb, ttl=args.ttl), args.host, args.port, args.verbose)
+    print('Serving on http://{}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Serve usage and job statistics as a Grafana JSON datasource")
+    parser.add_argument("-db","--dburl", help="Usage database url", default=None)
+    parser.add_argument("-j","--jobsdburl", help="Jobs database url", default=None)
+    parser.add_argument("--host", help="Address to listen on", default='localhost')
+    parser.add_argument("-p","--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("-t","--ttl", help="Seconds to cache query results", type=float, default=60.)
+    parser.add_argument("--pool-size", help="Database connections kept open", type=int, default=10)
+    parser.add_argument("-v","--verbose", help="Log requests", action='store_true')
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return profiled(main, parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import gc
+import itertools
+import os
+import pytest
+import shutil
+import subprocess
+
+from ncigrafana.DBcommon import dispose_databases
+from ncigrafana.migrate_db import reference, progresstable
+
+@pytest.fixture(scope='session')
+def pgserver(tmp_path_factory):
+    """
+    URL of a PostgreSQL server, from NCIGRAFANA_TEST_PGURL or started with
+    initdb and pg_ctl on the PATH for these tests
+    """
+    if 'NCIGRAFANA_TEST_PGURL' in os.environ:
+        yield os.environ['NCIGRAFANA_TEST_PGURL']
+        return
+    if shutil.which('initdb') is None or shutil.which('pg_ctl') is None:
+        pytest.skip('PostgreSQL is not available')
+    if os.geteuid() == 0:
+        pytest.skip('PostgreSQL cannot be started as root')
+    directory = tmp_path_factory.mktemp('pg')
+    datadir = str(directory / 'data')
+    subprocess.run(['initdb', '-D', datadir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8'], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run(['pg_ctl', '-D', datadir, '-w', '-l', str(directory / 'log'),
+                    '-o', "-k {} -c listen_addresses=''".format(directory), 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+    yield 'postgresql://postgres@/postgres?host={}'.format(directory)
+    subprocess.run(['pg_ctl', '-D', datadir, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+
+counter = itertools.count()
+
+@pytest.fixture
+def pgurl(pgserver):
+    """
+    Return a function giving the URL of a new empty database on each call
+    """
+    import sqlalchemy
+
+    engine = sqlalchemy.create_engine(pgserver, isolation_level='AUTOCOMMIT')
+    created = []
+    def newdb():
+        name = 'ncigrafana_test_{}_{}'.format(os.getpid(), next(counter))
+        with engine.connect() as conn:
+            conn.exec_driver_sql('CREATE DATABASE {}'.format(name))
+        created.append(name)
+        return sqlalchemy.engine.make_url(pgserver).set(database=name).render_as_string(hide_password=False)
+    yield newdb
+    # Close the connections of datasets from the test before dropping
+    dispose_databases()
+    gc.collect()
+    with engine.connect() as conn:
+        for name in created:
+            conn.exec_driver_sql('DROP DATABASE IF EXISTS {} WITH (FORCE)'.format(name))
+    engine.dispose()
+
+def natural_contents(db):
+    """
+    Return the rows of every table except IngestRuns and MigrationProgress,
+    without ids and with foreign keys replaced by the rows they refer to, so
+    databases loaded in a different order can be compared
+    """
+    tables = {table: {row['id']: row for row in db[table].all()}
+              for table in db.tables if table not in ('IngestRuns', progresstable)}
+
+    def natural(table, row):
+        values = []
+        for column, value in sorted(row.items()):
+            if column == 'id':
+                continue
+            dimension = reference(table, column)
+            if dimension is not None and value is not None:
+                value = natural(dimension, tables[dimension][value])
+            values.append((column, value))
+        return tuple(values)
+
+    return {table: sorted(natural(table, row) for row in rows.values()) for table, rows in tables.items()}
+
+@pytest.fixture
+def contents():
+    """
+    The natural_contents function, for comparing databases
+    """
+    return natural_contents
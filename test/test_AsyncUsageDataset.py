@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import asyncio
+import datetime
+import re
+
+import pandas as pd
+
+pytest.importorskip('aiosqlite')
+
+from ncigrafana.UsageDataset import ProjectDataset, NotInDatabase
+from ncigrafana.UsageDataset import usage_query, storage_query, shortusers_query, suusers_query, top_usage_query
+from ncigrafana.AsyncUsageDataset import AsyncProjectDataset, async_url
+
+year = 2019; quarter = 'q3'
+startdate = datetime.date(2019, 7, 1)
+
+def fill(db):
+    db.addquarter(year, quarter, startdate, datetime.date(2019, 9, 30))
+    db.adduser('aaa000', 'Alice')
+    db.adduser('bbb000', 'Bob')
+    for day in range(5):
+        date = startdate + datetime.timedelta(days=day + 2)
+        db.adduserusage('xx00', 'aaa000', date, 0., 0., 10. * day, 0.)
+        db.adduserusage('yy00', 'bbb000', date, 0., 0., 100., 0.)
+        # Scan dates are strings, as parse_user_storage_data stores them
+        db.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', str(date), 'a', 1000. * day, day)
+        db.adduserstorage('xx00', 'bbb000', 'gadi', 'scratch', str(date), 'a', 1500., 1)
+    db.addusagegrant('xx00', 'gadi', 'nci', year, quarter, startdate, 1000.)
+    db.addusagegrant('xx00', 'gadi', 'nci', year, quarter, startdate + datetime.timedelta(days=1), 2000.)
+    db.addstoragegrant('xx00', 'gadi', 'scratch', 'nci', year, quarter, startdate, 'capacity', 1e12)
+    db.addstoragegrant('xx00', 'gadi', 'scratch', 'nci', year, quarter, startdate, 'inodes', 1e6)
+
+@pytest.fixture(scope='module')
+def dburl(tmp_path_factory):
+    dburl = 'sqlite:///{}'.format(tmp_path_factory.mktemp('async') / 'usage.db')
+    fill(ProjectDataset(dburl=dburl))
+    return dburl
+
+def run(dburl, method, *args, **kwargs):
+    """
+    Call method of an AsyncProjectDataset on dburl and of a ProjectDataset
+    with the same arguments and return both results
+    """
+    async def call():
+        async with AsyncProjectDataset(dburl) as db:
+            return await getattr(db, method)(*args, **kwargs)
+    return asyncio.run(call()), getattr(ProjectDataset(dburl=dburl), method)(*args, **kwargs)
+
+def test_async_url():
+    assert async_url('sqlite:///usage.db').drivername == 'sqlite+aiosqlite'
+    assert async_url('postgresql://host/usage').drivername == 'postgresql+asyncpg'
+    assert async_url('postgresql+psycopg://host/usage').drivername == 'postgresql+psycopg'
+
+@pytest.mark.parametrize('output', ['wide', 'sparse', 'long'])
+def test_getusage(dburl, output):
+    result, expected = run(dburl, 'getusage', year, quarter, output=output)
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_getstorage(dburl):
+    result, expected = run(dburl, 'getstorage', 'xx00', year, quarter, 'gadi', 'scratch', datafield='inodes')
+    pd.testing.assert_frame_equal(result, expected)
+    assert result.index[0] == pd.Timestamp(startdate)
+
+def test_grants(dburl):
+    assert run(dburl, 'getusagegrant', 'xx00', 'gadi', 'nci', year, quarter) == (2000., 2000.)
+    assert run(dburl, 'getstoragegrant', 'xx00', 'gadi', 'scratch', 'nci', year, quarter) == ((1e12, 1e6),) * 2
+
+    async def missing():
+        async with AsyncProjectDataset(dburl) as db:
+            return await db.getusagegrant('zz00', 'gadi', 'nci', year, quarter)
+    assert asyncio.run(missing()) is None
+
+def test_topusers(dburl):
+    result, expected = run(dburl, 'getsuusers', year, quarter, limit=1)
+    assert result == expected == ['bbb000']
+    result, expected = run(dburl, 'getshortusers', year, quarter, project='xx00')
+    assert result == expected
+    result, expected = run(dburl, 'top_usage', year, quarter, 'scratch', count=1)
+    pd.testing.assert_series_equal(result, expected)
+
+def test_concurrent(dburl):
+    async def call():
+        async with AsyncProjectDataset(dburl, pool_size=2) as db:
+            return await asyncio.gather(*[db.getusage(year, quarter) for _ in range(10)],
+                                        db.getsuusers(year, quarter))
+    results = asyncio.run(call())
+    assert all(df.equals(results[0]) for df in results[:10])
+    assert results[-1] == ['bbb000', 'aaa000']
+
+def test_notindatabase(dburl):
+    with pytest.raises(NotInDatabase):
+        run(dburl, 'getusage', 1984, 'q1')
+
+queries = [(usage_query, ()), (usage_query, ('usage_cpu', 'user')),
+           (storage_query, ('xx00', 'gadi', 'scratch')), (storage_query, ('xx00', 'gadi', 'scratch', 'inodes', 'user')),
+           (shortusers_query, (['xx00', 'yy00'], 5)), (suusers_query, ('xx00',)),
+           (top_usage_query, ('scratch', 'inodes', 3, 'xx00')), (top_usage_query, ('scratch', 'size', 3, None, '', True)),
+           (usage_query, ('usage_su', 'user+name', '', True))]
+
+@pytest.mark.parametrize('query, args', queries)
+def test_postgresql_sql(query, args):
+    # The shared SQL is plain enough to render for PostgreSQL, where
+    # unquoted table names are folded to lower case
+    from sqlalchemy import text
+    from sqlalchemy.dialects import postgresql
+
+    qstring, params = query(startdate, datetime.date(2019, 9, 30), *args)
+    sql = str(text(qstring).compile(dialect=postgresql.dialect()))
+    assert 'printf' not in sql
+    assert all(table.startswith('"') or table in ('Scans', '(') for table in re.findall(r'(?:FROM|JOIN)\s+(\S+)', sql))
+    assert set(re.findall(r'%\((\w+)\)s', sql)) == set(params)
+
+def test_postgresql(pgurl, dburl):
+    db = ProjectDataset(dburl=pgurl())
+    fill(db)
+    expected = ProjectDataset(dburl=dburl)
+    for method, args in [('getusage', (year, quarter)), ('getusage', (year, quarter, 'usage_su', 'user', 'long')),
+                         ('getstorage', ('xx00', year, quarter, 'gadi', 'scratch')),
+                         ('getsuusers', (year, quarter)), ('getshortusers', (year, quarter, 'xx00')),
+                         ('top_usage', (year, quarter, 'scratch')), ('query_usage', ()),
+                         ('query_usage', ('xx00', 'aaa000', 'scratch', startdate, None, ('size', 'inodes')))]:
+        result = getattr(db, method)(*args)
+        if isinstance(result, list):
+            assert result == getattr(expected, method)(*args)
+        elif isinstance(result, pd.Series):
+            pd.testing.assert_series_equal(result, getattr(expected, method)(*args))
+        else:
+            # PostgreSQL returns dates rather than strings, so the unit of
+            # the datetimes can differ
+            pd.testing.assert_frame_equal(result, getattr(expected, method)(*args), check_freq=False,
+                                          check_index_type=False, check_dtype=False)
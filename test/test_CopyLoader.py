@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import pytest
+import time
+
+pytest.importorskip('psycopg2')
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.JobsDataset import JobsDataset
+from ncigrafana.CopyLoader import CopyLoader, csvfield
+from ncigrafana.parse_lquota import lquota_records
+from ncigrafana.parse_account_usage_data import account_dump_records
+from ncigrafana.parse_user_storage_data import file_report_records
+from ncigrafana.make_jobs_DB import qstat_records
+
+from benchmarks.generate import write_qstat_json
+
+# Set acceptable time zone strings so we can parse the
+# AEST timezone in the test file
+os.environ['TZ'] = 'AEST-10AEDT-11,M10.5.0,M3.5.0'
+time.tzset()
+
+def usagerecords():
+    return [lquota_records('test/lquota.log', False),
+            account_dump_records('test/nci_account.log', False),
+            file_report_records('test/2022-11-02T11:36:45.w40.scratch.json', False),
+            file_report_records('test/2022-11-02T11:36:45.w40.gdata.json', False)]
+
+def test_csvfield():
+    assert csvfield(None) == ''
+    assert csvfield('') == '""'
+    assert csvfield('say "hi", then go') == '"say ""hi"", then go"'
+    assert csvfield(1.5) == '1.5'
+    assert csvfield(3) == '3'
+
+def test_copy_usage(pgurl, contents, tmp_path):
+    expected = ProjectDataset(dburl=pgurl(), cachedir=str(tmp_path / 'expected'))
+    db = ProjectDataset(dburl=pgurl(), cachedir=str(tmp_path / 'cubes'))
+    # Load twice to check existing rows are updated rather than duplicated
+    for records in usagerecords() * 2:
+        records.load(expected)
+        # Small batches so each kind is merged in several
+        CopyLoader(db, batchsize=7).load(records)
+
+    assert contents(db.db) == contents(expected.db)
+    assert db.dirtycubes == expected.dirtycubes
+    assert len(db.db['UserStorage']) > 7
+
+def test_copy_jobs(pgurl, contents, tmp_path):
+    write_qstat_json(str(tmp_path / 'qstat.json'), 200)
+    records = qstat_records(str(tmp_path / 'qstat.json'))
+
+    expected = JobsDataset(pgurl())
+    db = JobsDataset(pgurl())
+    records.load(expected)
+    records.load(db, copy=True)
+    records.load(db, copy=True)
+
+    assert contents(db.db) == contents(expected.db)
+    assert len(db.db['Jobs']) == 200
+    assert db.dirtydates == expected.dirtydates
+
+def test_unresolved(pgurl):
+    records = usagerecords()[2]
+    # The first row is added by the dataset method
+    records.rows['userstorage'][1] = (None,) + records.rows['userstorage'][1][1:]
+    db = ProjectDataset(dburl=pgurl())
+    with pytest.raises(ValueError, match='Cannot resolve'):
+        CopyLoader(db).load(records)
+    # Nothing is loaded
+    assert 'UserStorage' not in db.db.tables
+
+def test_sqlite(contents):
+    # Other databases are loaded row by row
+    expected = ProjectDataset(dburl='sqlite:///:memory:')
+    db = ProjectDataset(dburl='sqlite:///:memory:')
+    for records in usagerecords():
+        records.load(expected)
+        records.load(db, copy=True)
+    assert contents(db.db) == contents(expected.db)
@@ -55,3 +55,55 @@ def test_date_range_from_quarter():
 
     assert(date_range_from_quarter(7,'q4') ==
            (datetime.date(7,10,1), datetime.date(7,12,31)))
+
+def test_json_loads():
+
+    assert(json_backend in ('json', 'orjson'))
+
+    document = '{"project": "w35", "usage": [1, 2.5, null], "ok": true}'
+    assert(json_loads(document) == {'project': 'w35', 'usage': [1, 2.5, None], 'ok': True})
+    assert(json_loads(document.encode()) == json_loads(document))
+
+    # Accepted by json, but not by orjson
+    assert(json_loads('[NaN, 123456789012345678901234567890]')[1] == 123456789012345678901234567890)
+
+    with pytest.raises(ValueError):
+        json_loads('{"project": ')
+
+def test_connect_db(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'test.db')
+
+    writer = connect_db(url, 'ingest')
+    writer['Test'].insert(dict(value=1))
+    assert writer.query('PRAGMA journal_mode').next()['journal_mode'] == 'wal'
+    assert writer.query('PRAGMA synchronous').next()['synchronous'] == 1
+
+    reader = connect_db(url, 'readonly')
+    assert reader.query('PRAGMA busy_timeout').next()['timeout'] == 10000
+
+    # Readers are not blocked by an open write transaction
+    with writer:
+        writer['Test'].insert(dict(value=3))
+        assert [row['value'] for row in reader['Test'].all()] == [1]
+    assert [row['value'] for row in reader['Test'].all()] == [1, 3]
+    with pytest.raises(Exception, match='readonly'):
+        reader['Test'].insert(dict(value=2))
+
+    # Profiles may also be given as a list of pragmas
+    assert sqlite_pragmas([('cache_size', -1000)]) == ['PRAGMA cache_size=-1000']
+    with pytest.raises(ValueError):
+        connect_db(url, 'fast')
+
+def test_shared_databases(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'test.db')
+    db = connect_db(url, 'ingest')
+    assert connect_db(url, 'ingest') is db
+    assert connect_db(url) is not db
+    assert connect_db(url, 'ingest', pool=dict(pool_size=2)) is not db
+    assert connect_db(url, 'ingest', pool=dict(pool_size=2)).engine.pool.size() == 2
+    assert db.engine.pool.size() == pool_defaults['pool_size']
+    # In memory databases are never shared
+    assert connect_db('sqlite:///:memory:') is not connect_db('sqlite:///:memory:')
+
+    dispose_databases()
+    assert connect_db(url, 'ingest') is not db
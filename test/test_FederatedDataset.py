@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import datetime
+import pandas as pd
+import pytest
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.FederatedDataset import FederatedDataset, attach_limit
+
+year = 1984; quarter = 'q3'
+projects = ['a00', 'b00', 'c00', 'd00', 'e00']
+
+@pytest.fixture(scope='module')
+def dbfiles(tmp_path_factory):
+    """
+    A usage database for each of projects, and one with no usage
+    """
+    directory = tmp_path_factory.mktemp('federated')
+    for n, project in enumerate(projects):
+        db = ProjectDataset(project, 'sqlite:///{}'.format(directory / 'usage_{}.db'.format(project)))
+        db.addquarter(year, quarter, datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+        for user in ('wxs1984', 'bxb1984', 'ob1984'):
+            db.adduser(user, user.upper())
+        for day in range(10):
+            date = datetime.date(1984, 7, 1) + datetime.timedelta(days=day)
+            for i, user in enumerate(('wxs1984', 'bxb1984')):
+                db.adduserusage(project, user, date, 1., 2., 100.*(n + 1) + day + i, 99.)
+                db.adduserstorage(project, user, 'deepblue', 'array1', date, 'data', 1e6*(n + 1)*(i + 1) + day, 10*(i + 1))
+            db.adduserstorage(project, 'ob1984', 'deepblue', 'array1', date, 'data', 1e3, 1)
+            db.addprojectstorage(project, 'deepblue', 'array1', datetime.datetime.combine(date, datetime.time(3)),
+                                 1e9*(n + 1) + day, 1000*(n + 1) + day)
+        db.db.engine.dispose()
+
+    ProjectDataset(dburl='sqlite:///{}'.format(directory / 'usage_empty.db')).adduser('xxx1984')
+
+    return str(directory / 'usage_*.db')
+
+def test_attach_limit():
+    assert attach_limit() >= 2
+
+@pytest.mark.parametrize('attachlimit', [None, 2])
+def test_getusage(dbfiles, attachlimit):
+    db = FederatedDataset(dbfiles, attachlimit=attachlimit)
+    assert len(db.files) == len(projects) + 1
+
+    df = db.getusage(year, quarter)
+    assert list(df.columns) == ['project', 'Date', 'Name', 'totsu']
+    assert sorted(df.project.unique()) == projects
+    for project in projects:
+        expected = ProjectDataset(project, 'sqlite:///{}'.format(dbfiles.replace('*', project))).getusage(year, quarter, output='long')
+        usage = df[df.project == project]
+        assert (usage.Date.values == expected.Date.values).all()
+        assert usage.Name.tolist() == expected.Name.astype(str).tolist()
+        assert usage.totsu.tolist() == expected.totsu.tolist()
+
+    assert FederatedDataset([]).getusage(year, quarter) is None
+
+@pytest.mark.parametrize('attachlimit', [None, 2])
+def test_top_usage(dbfiles, attachlimit):
+    db = FederatedDataset(dbfiles, attachlimit=attachlimit)
+    df = db.top_usage(year, quarter, 'array1', count=2, scale=1e6)
+    assert list(df.columns) == ['project', 'Name', 'size']
+    assert len(df) == 2*len(projects)
+    assert df['size'].is_monotonic_decreasing
+    top = df.iloc[0]
+    assert (top.project, top.Name) == ('e00', 'BXB1984 (bxb1984)')
+    assert top['size'] == pytest.approx(10. + 9e-6)
+
+    expected = ProjectDataset('c00', 'sqlite:///{}'.format(dbfiles.replace('*', 'c00'))).top_usage(year, quarter, 'array1', count=2, scale=1e6)
+    assert df[df.project == 'c00'].set_index('Name')['size'].to_dict() == expected.to_dict()
+
+    assert db.top_usage(year, quarter, 'array2') is None
+
+def test_getstoragetotals(dbfiles):
+    df = FederatedDataset(dbfiles).getstoragetotals(year, quarter, storagepoint='array1')
+    assert list(df.columns) == ['project', 'system', 'storagepoint', 'Date', 'size', 'inodes']
+    assert df.project.tolist() == projects
+    assert (df.Date == pd.Timestamp('1984-07-10 03:00')).all()
+    assert df['size'].tolist() == [1e9*(n + 1) + 9 for n in range(len(projects))]
+
+    assert FederatedDataset(dbfiles).getstoragetotals(year, quarter, storagepoint='array2') is None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import math
+
+from ncigrafana.JobsDataset import *
+
+@pytest.fixture(scope='session')
+def db():
+    dbfile = "sqlite:///:memory:"
+    db = JobsDataset(dbfile)
+    db.addchargerate('normal', 2.)
+    db.addchargerate('express', 6.)
+    return db
+
+def addjob(db, jobid, ctime, queue='normal', project='xx00', status='F',
+           ncpus=1, walltime=3600., waitime=60., cpuutil=0.5):
+    db.addjob(ctime.year, queue, jobid, project, 'wxs1984',
+              status, 'job', 0, '/bin/true', '',
+              ctime, 0., 0., waitime, waitime,
+              walltime, 0, ncpus,
+              walltime, 0, walltime*ncpus*cpuutil, cpuutil, 0)
+
+def test_binlabel(db):
+    assert db.binlabel(1) == 'XXS'
+    assert db.binlabel(2) == 'XXS'
+    assert db.binlabel(3) == 'XS'
+    assert db.binlabel(48) == 'S'
+    assert db.binlabel(4096) == 'L'
+    assert db.binlabel(0) is None
+
+def test_updatejobstats(db):
+    day1 = datetime.datetime(1984, 7, 1, 9, 0, 0)
+    day2 = datetime.datetime(1984, 7, 2, 9, 0, 0)
+    for i in range(10):
+        addjob(db, str(i), day1, ncpus=1, waitime=10.*(i+1))
+    addjob(db, '10', day1, ncpus=48, walltime=7200., waitime=3600.)
+    addjob(db, '11', day1, queue='express', ncpus=48, walltime=1800.)
+    addjob(db, '12', day2, ncpus=48)
+    # Queued jobs are not included in the rollup
+    addjob(db, '13', day2, status='Q')
+
+    assert db.dirtydates == {day1.date(), day2.date()}
+    db.updatejobstats()
+    assert db.dirtydates == set()
+
+    df = db.getjobstats()
+    assert len(df) == 4
+    assert df['count'].sum() == 13
+
+    row = df.loc[(df.queue == 'normal') & (df.ncpusbin == 'S') & (df.date == '1984-07-01')].iloc[0]
+    assert row['count'] == 1
+    assert row['corehours'] == 96.
+    assert row['su'] == 192.
+
+    row = df.loc[(df.queue == 'express')].iloc[0]
+    assert row['su'] == 24. * 6.
+
+    assert len(db.getjobstats(startdate='1984-07-02')) == 1
+    assert len(db.getjobstats(queues=['express'])) == 1
+    assert len(db.getjobstats(projects=['yy00'])) == 0
+
+def test_reingest(db):
+    # Re-adding a job updates rather than double counts
+    addjob(db, '12', datetime.datetime(1984, 7, 2, 9, 0, 0), ncpus=48, walltime=7200.)
+    db.updatejobstats()
+    df = db.getjobstats(startdate='1984-07-02')
+    assert df['count'].sum() == 1
+    assert df['corehours'].sum() == 96.
+
+    # Full rebuild gives the same answer as the incremental updates
+    before = db.getjobstats()
+    db.rebuildjobstats()
+    after = db.getjobstats()
+    assert before[['count', 'corehours', 'su']].sum().tolist() == after[['count', 'corehours', 'su']].sum().tolist()
+
+def test_chargerates():
+    db = JobsDataset('sqlite:///:memory:')
+    addjob(db, '1', datetime.datetime(1984, 7, 1, 9, 0, 0), ncpus=2)
+    # Jobs on a queue without a rate are not charged at a guess
+    with pytest.raises(ValueError, match='normal'):
+        db.updatejobstats()
+    assert 'JobStatsDaily' not in db.db.tables
+
+    assert db.addchargerate('normal', 2.)
+    assert not db.addchargerate('normal', 2.)
+    db.updatejobstats()
+    assert db.getjobstats()['su'].tolist() == [4.]
+
+    assert db.addchargerate('normal', 1.5)
+    db.rebuildjobstats()
+    assert db.getjobstats()['su'].tolist() == [3.]
+
+def test_nullwalltime():
+    db = JobsDataset('sqlite:///:memory:')
+    db.addchargerate('normal', 2.)
+    addjob(db, '1', datetime.datetime(1984, 7, 1, 9, 0, 0), ncpus=2)
+    # As make_jobs_DB adds a job killed before it started
+    db.addjob(1984, 'normal', '2', 'xx00', 'wxs1984', 'F', 'job', 0, '/bin/true', '',
+              datetime.datetime(1984, 7, 1, 9, 0, 0), 0., 0., None, None,
+              3600., 0, 2, None, None, None, None, 0)
+    db.updatejobstats()
+    row = db.getjobstats().iloc[0]
+    assert row['count'] == 2
+    assert row['corehours'] == 2. and row['su'] == 4.
+    assert row['waittime'] == 60.
+    assert sum(row['waittime_hist']) == 1 and sum(row['cpuutil_hist']) == 1
+
+def test_jobstatscurrent():
+    db = JobsDataset('sqlite:///:memory:')
+    db.addchargerate('normal', 2.)
+    assert db.jobstatscurrent()
+
+    # Jobs added before the rollup existed are not covered by later updates
+    addjob(db, '1', datetime.datetime(1984, 7, 1, 9, 0, 0))
+    db.dirtydates.clear()
+    assert not db.jobstatscurrent()
+    addjob(db, '2', datetime.datetime(1984, 7, 3, 9, 0, 0))
+    db.updatejobstats()
+    assert not db.jobstatscurrent()
+    assert len(db.getjobstats()) == 1
+
+    db.rebuildjobstats()
+    assert db.jobstatscurrent()
+    assert db.getjobstats()['date'].dt.day.tolist() == [1, 3]
+
+def test_getjobquantiles(db):
+    df = db.getjobquantiles('waittime', quantiles=(0.5, 1.0), projects=['xx00'])
+    median = df.loc[('normal', 'XXS'), 0.5]
+    # Exact median of 10, 20, ..., 100 is 55, histogram estimate is close
+    assert 30. < median < 80.
+    assert df.loc[('normal', 'XXS'), 1.0] >= 100.
+
+    df = db.getjobquantiles('cpuutil', quantiles=(0.5,), groupby=('project',))
+    assert math.isclose(df.loc['xx00', 0.5], 0.5, abs_tol=0.05)
+
+    with pytest.raises(ValueError):
+        db.getjobquantiles('ncpus')
+
+def test_postgresql(pgurl):
+    import pandas as pd
+
+    results = []
+    for db in JobsDataset('sqlite:///:memory:'), JobsDataset(pgurl()):
+        db.addchargerate('normal', 2.)
+        addjob(db, '1', datetime.datetime(1984, 7, 1, 9, 0, 0), ncpus=48)
+        addjob(db, '2', datetime.datetime(1984, 7, 2, 9, 0, 0))
+        db.updatejobstats()
+        assert db.jobstatscurrent()
+        results.append(db.getjobstats(startdate='1984-07-01', projects=['xx00'], queues=['normal']))
+    pd.testing.assert_frame_equal(*results)
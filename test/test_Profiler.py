@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import io
+import pandas as pd
+import os
+import pytest
+import time
+
+from ncigrafana.UsageDataset import *
+from ncigrafana.Profiler import Profiler, IngestRun
+import ncigrafana.parse_lquota
+from ncigrafana.parse_lquota import parse_lquota
+
+# Set acceptable time zone strings so we can parse the 
+# AEST timezone in the test file
+os.environ['TZ'] = 'AEST-10AEDT-11,M10.5.0,M3.5.0'
+time.tzset()
+
+def test_profiler(tmp_path):
+    db = ProjectDataset('xx00', "sqlite:///:memory:")
+    adduser = ProjectDataset.adduser
+
+    profiler = Profiler(pstatsfile=str(tmp_path / 'out.pstats'))
+    with profiler:
+        ncigrafana.parse_lquota.parse_lquota('test/lquota.log', verbose=False, db=db)
+
+    assert profiler.stats['parse'].calls == 1
+    assert profiler.stats['upserts'].calls == 24
+    assert profiler.stats['dimensions'].calls > 0
+    assert profiler.sqlcount > 0
+    # Nested stages are only counted once in self time
+    assert sum(s.selftime for s in profiler.stats.values()) <= profiler.walltime
+    assert (tmp_path / 'out.pstats').exists()
+
+    # Everything is restored afterwards
+    assert ProjectDataset.adduser is adduser
+    assert ncigrafana.parse_lquota.parse_lquota is parse_lquota
+
+    output = io.StringIO()
+    profiler.summary(file=output)
+    assert 'upserts' in output.getvalue()
+
+def test_ingestrun():
+    db = ProjectDataset('xx00', "sqlite:///:memory:")
+
+    with IngestRun(db, 'lquota', 'test/lquota.log') as run:
+        with run.stage('parse'):
+            run.parsed, run.written = parse_lquota('test/lquota.log', verbose=False, db=db)
+
+    with pytest.raises(ValueError):
+        with IngestRun(db, 'lquota', 'test/lquota.log') as run:
+            raise ValueError('Corrupt file')
+
+    df = db.getingestruns()
+    assert len(df) == 2
+    run = df.iloc[0]
+    assert run['source'] == 'lquota'
+    assert run['parsed'] == 8 and run['written'] == 8 and run['errors'] == 0
+    assert run['statements'] > 0
+    assert run['stage_parse'] <= run['duration']
+    assert run['rows_per_second'] > 0
+    assert pd.isnull(run['error'])
+    assert 'Corrupt file' in df.iloc[1]['error']
+
+    assert len(db.getingestruns(source='nci-account')) == 0
+
+def test_ingestrun_postgresql(pgurl):
+    db = ProjectDataset('xx00', pgurl())
+
+    started = pd.Timestamp.now()
+    with IngestRun(db, 'lquota', 'test/lquota.log') as run:
+        run.parsed, run.written = parse_lquota('test/lquota.log', verbose=False, db=db)
+
+    df = db.getingestruns(source='lquota', startdate=started - pd.Timedelta('1min'))
+    assert len(df) == 1
+    assert df.iloc[0]['written'] == 8
+    assert len(db.getingestruns(source='nci-account')) == 0
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import datetime
+import os
+import pytest
+import time
+
+pytest.importorskip('pyarrow')
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.JobsDataset import JobsDataset
+from ncigrafana.Records import Records, records_directory
+from ncigrafana.parse_lquota import lquota_records, parse_lquota
+from ncigrafana.parse_account_usage_data import account_dump_records, parse_account_dump_file
+from ncigrafana.parse_user_storage_data import file_report_records, parse_file_report
+from ncigrafana.make_jobs_DB import qstat_records, load_jobs, parse_qstat_json_dump
+from ncigrafana import parse_lquota as lquota_script
+from ncigrafana import load_records
+
+from benchmarks.generate import write_qstat_json, add_chargerates
+
+# Set acceptable time zone strings so we can parse the
+# AEST timezone in the test file
+os.environ['TZ'] = 'AEST-10AEDT-11,M10.5.0,M3.5.0'
+time.tzset()
+
+def contents(db):
+    """
+    Return every table of a dataset database except IngestRuns
+    """
+    return {table: [dict(row) for row in db[table].all()]
+            for table in sorted(db.tables) if table != 'IngestRuns'}
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+@pytest.mark.parametrize('parse, records, filename', [
+    (parse_lquota, lquota_records, 'test/lquota.log'),
+    (parse_account_dump_file, account_dump_records, 'test/nci_account.log'),
+    (parse_file_report, file_report_records, 'test/2022-11-02T11:36:45.w40.scratch.json'),
+])
+def test_roundtrip(tmp_path, format, parse, records, filename):
+    expected = ProjectDataset(dburl='sqlite:///:memory:')
+    counts = parse(filename, False, db=expected)
+
+    parsed = records(filename, False)
+    assert (parsed.parsed, parsed.accepted) == counts
+    directory = parsed.write(str(tmp_path / 'records'), format)
+
+    loaded = Records.read(directory)
+    assert loaded.rows == parsed.rows
+    assert (loaded.source, loaded.filename) == (parsed.source, filename)
+
+    db = ProjectDataset(dburl='sqlite:///:memory:')
+    loaded.load(db)
+    assert contents(db.db) == contents(expected.db)
+
+def test_qstat_roundtrip(tmp_path):
+    filename = str(tmp_path / 'qstat.json')
+    write_qstat_json(filename, 50)
+
+    expected = add_chargerates(JobsDataset('sqlite:///:memory:'))
+    assert parse_qstat_json_dump(filename, None, db=expected) == (50, 50)
+
+    loaded = Records.read(qstat_records(filename).write(str(tmp_path / 'records')))
+    assert isinstance(loaded.rows['jobs'][0][10], datetime.datetime)
+    db = add_chargerates(JobsDataset('sqlite:///:memory:'))
+    load_jobs(loaded, db)
+    assert contents(db.db) == contents(expected.db)
+
+def test_empty(tmp_path):
+    records = Records('nci-account', 'empty.log')
+    records.parsed = 3
+    loaded = Records.read(records.write(str(tmp_path / 'records'), 'arrow'))
+    assert len(loaded) == 0 and loaded.parsed == 3
+
+    with pytest.raises(ValueError):
+        records.write(str(tmp_path / 'records'), 'csv')
+
+def test_load_records(tmp_path):
+    output = str(tmp_path / 'records')
+    lquota_script.main_parse_args(['-n', '--output', output, 'test/lquota.log'])
+    assert os.path.isdir(records_directory(output, 'test/lquota.log'))
+
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    assert load_records.main_parse_args(['--dburl', dburl, records_directory(output, 'test/lquota.log')]) == 0
+
+    db = ProjectDataset(dburl=dburl)
+    runs = db.getingestruns()
+    assert runs['source'].tolist() == ['lquota']
+    assert runs['written'].tolist() == [8]
+    assert len(db.db['ProjectStorage']) == 8
+
+    # Job records need a jobs database
+    write_qstat_json(str(tmp_path / 'qstat.json'), 5)
+    qstat = qstat_records(str(tmp_path / 'qstat.json')).write(str(tmp_path / 'qstat'))
+    assert load_records.main_parse_args(['--dburl', dburl, qstat]) == 1
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.UsageCube import UsageCube
+from ncigrafana.Profiler import IngestRun
+
+year = 2019; quarter = 'q3'
+startdate = datetime.date(2019, 7, 1)
+
+@pytest.fixture
+def db(tmp_path):
+    db = ProjectDataset(project='xx00', dburl='sqlite:///:memory:', cachedir=str(tmp_path / 'cache'))
+    db.addquarter(year, quarter, startdate, datetime.date(2019, 9, 30))
+    db.adduser('aaa000', 'Alice')
+    db.adduser('bbb000', 'Bob')
+    # Loaded as a parser would, recording the run
+    with IngestRun(db, 'test'):
+        for day in range(5):
+            date = startdate + datetime.timedelta(days=day)
+            db.adduserusage('xx00', 'aaa000', date, 0., 0., 10. * day, 0.)
+            db.adduserusage('xx00', 'bbb000', date, 0., 0., 100., 0.)
+            db.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', date, 'a', 1000. * day, day)
+            db.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', date, 'b', 1., 1)
+    db.updatecubes()
+    return db
+
+def uncached(db, method, *args, **kwargs):
+    cachedir, db.cachedir = db.cachedir, None
+    try:
+        return getattr(db, method)(*args, **kwargs)
+    finally:
+        db.cachedir = cachedir
+
+def test_update(tmp_path):
+    cube = UsageCube(str(tmp_path / 'cube'))
+    assert cube.lastdate is None
+    cube.update([('2019-07-02', 'bbb000', 'Bob', 2.), (datetime.date(2019, 7, 1), 'aaa000', 'Alice', 1.),
+                 ('2019-07-01', 'aaa000', 'Alice', 1.)])
+    assert cube.dates == ['2019-07-01', '2019-07-02']
+    assert cube.users == [('aaa000', 'Alice'), ('bbb000', 'Bob')]
+    assert isinstance(cube.data, np.memmap)
+    assert cube.data.tolist() == [[2., 0.], [0., 2.]]
+
+    # Dates present replace existing rows, others are kept, new users are
+    # added in the column order of getusage
+    cube.update([('2019-07-02', 'ccc000', None, 3.)], stamp=[3, 6., '2019-07-02'])
+    cube = UsageCube(str(tmp_path / 'cube'))
+    assert cube.lastdate == '2019-07-02'
+    assert cube.stamp == [3, 6., '2019-07-02']
+    assert cube.data.tolist() == [[0., 2., 0.], [3., 0., 0.]]
+    assert sorted(os.listdir(tmp_path)) == ['cube.json', 'cube.npy']
+
+    df = cube.frame()
+    assert list(df.columns) == [' (ccc000)', 'Alice (aaa000)', 'Bob (bbb000)']
+    assert np.shares_memory(df.values, cube.data)
+    df = cube.frame('user')
+    assert list(df.columns) == ['aaa000', 'bbb000', 'ccc000']
+    assert df['ccc000'].tolist() == [0., 3.]
+
+    cube.update([('2019-07-03', 'aaa000', 'Alice', 4.)], replace=True)
+    assert cube.dates == ['2019-07-03'] and cube.users == [('aaa000', 'Alice')]
+
+def test_replaced(tmp_path):
+    # An array replaced after its sidecar was written is not trusted
+    cube = UsageCube(str(tmp_path / 'cube'))
+    cube.update([('2019-07-01', 'aaa000', 'Alice', 1.)], stamp=[1, 1., '2019-07-01'])
+    other = UsageCube(str(tmp_path / 'other'))
+    other.update([('2019-07-01', 'aaa000', 'Alice', 5.)])
+    os.replace(other.npyfile, cube.npyfile)
+    cube = UsageCube(str(tmp_path / 'cube'))
+    assert cube.data is None and cube.stamp is None
+
+def test_getusage(db):
+    df = db.getusage(year, quarter)
+    assert os.path.exists(os.path.join(db.cachedir, 'usage_2019q3_usage_su.npy'))
+    expected = uncached(db, 'getusage', year, quarter)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, check_freq=False)
+
+    # Served from the cube, only the high water mark is read
+    stats = db.instrument()
+    db.getusage(year, quarter)
+    assert stats.asdict()['getusage']['statements'] == 1
+    db.uninstrument()
+
+def test_getstorage(db):
+    df = db.getstorage('xx00', year, quarter, 'gadi', 'scratch', datafield='inodes')
+    expected = uncached(db, 'getstorage', 'xx00', year, quarter, 'gadi', 'scratch', datafield='inodes')
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, check_freq=False)
+
+def test_incremental(db):
+    db.getusage(year, quarter, namefield='user')
+    db.getstorage('xx00', year, quarter, 'gadi', 'scratch')
+
+    # Rewritten and new dates are applied by updatecubes
+    db.adduserusage('xx00', 'aaa000', startdate, 0., 0., 5., 0.)
+    db.adduserusage('xx00', 'ccc000', startdate + datetime.timedelta(days=5), 0., 0., 7., 0.)
+    db.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', startdate, 'a', 50., 1)
+    db.updatecubes()
+    assert db.dirtycubes == {}
+
+    cube = db._cube(('usage',), year, quarter, 'usage_su')
+    assert cube.lastdate == '2019-07-06'
+    df = db.getusage(year, quarter, namefield='user')
+    assert df.loc['2019-07-01', 'aaa000'] == 5.
+    assert df.loc['2019-07-06', 'ccc000'] == 7.
+    assert db.getstorage('xx00', year, quarter, 'gadi', 'scratch').loc['2019-07-01', 'Alice (aaa000)'] == 51.
+
+    # Newer dates written without the cache are picked up when read
+    other = ProjectDataset(dburl='sqlite:///:memory:')
+    other.db = db.db
+    other.adduserusage('xx00', 'bbb000', startdate + datetime.timedelta(days=6), 0., 0., 1., 0.)
+    df = db.getusage(year, quarter, namefield='user')
+    assert df.loc['2019-07-07', 'bbb000'] == 1.
+    pd.testing.assert_frame_equal(df, uncached(db, 'getusage', year, quarter, namefield='user'),
+                                  check_dtype=False, check_freq=False)
+
+def test_rewritten(tmp_path):
+    # A date already in the cube rewritten in place by another process, as
+    # when nci_account reports the current day again, is picked up when read
+    # as the run is recorded
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    cachedir = str(tmp_path / 'cache')
+    writer = ProjectDataset(project='xx00', dburl=dburl)
+    writer.addquarter(2020, 'q1', datetime.date(2020, 1, 1), datetime.date(2020, 3, 31))
+    writer.adduserusage('xx00', 'aaa000', datetime.date(2020, 1, 2), 0., 0., 10., 0.)
+
+    df = ProjectDataset(project='xx00', dburl=dburl, cachedir=cachedir).getusage(2020, 'q1', namefield='user')
+    assert df.loc['2020-01-02', 'aaa000'] == 10.
+
+    with IngestRun(writer, 'nci-account', url='https://nci.example'):
+        writer.adduserusage('xx00', 'aaa000', datetime.date(2020, 1, 2), 0., 0., 50., 0.)
+    df = ProjectDataset(project='xx00', dburl=dburl, cachedir=cachedir).getusage(2020, 'q1', namefield='user')
+    assert df.loc['2020-01-02', 'aaa000'] == 50.
+
+def test_readonly(tmp_path):
+    # Cubes are built without writing to the database
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    writer = ProjectDataset(project='xx00', dburl=dburl, profile='ingest')
+    writer.addquarter(year, quarter, startdate, datetime.date(2019, 9, 30))
+    writer.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', str(startdate), 'a', 10., 1)
+
+    db = ProjectDataset(dburl=dburl, profile='readonly', cachedir=str(tmp_path / 'cache'))
+    assert db.getstorage('xx00', year, quarter, 'gadi', 'scratch').iloc[0, 0] == 10.
+    assert db.getstorage('zz00', year, quarter, 'gadi', 'scratch') is None
+    assert db.getstorage('xx00', year, quarter, 'gadi', 'gdata') is None
+    assert db.getusage(year, quarter) is None
+
+def test_postgresql(pgurl, tmp_path):
+    db = ProjectDataset(project='xx00', dburl=pgurl(), cachedir=str(tmp_path / 'cache'))
+    db.addquarter(year, quarter, startdate, datetime.date(2019, 9, 30))
+    with IngestRun(db, 'test'):
+        for day in range(5):
+            date = startdate + datetime.timedelta(days=day)
+            db.adduserusage('xx00', 'aaa000', date, 0., 0., 10. * day, 0.)
+            db.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', str(date), 'a', 1000. * day, day)
+
+    for method, args in [('getusage', (year, quarter)), ('getstorage', ('xx00', year, quarter, 'gadi', 'scratch'))]:
+        df = getattr(db, method)(*args)
+        pd.testing.assert_frame_equal(df, uncached(db, method, *args), check_dtype=False, check_freq=False,
+                                      check_index_type=False)
+        # and again from the cube
+        pd.testing.assert_frame_equal(getattr(db, method)(*args), df)
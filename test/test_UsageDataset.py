@@ -114,6 +114,7 @@ def test_systemqueue(db):
     weight = 5.
     db.addsystemqueue(system, queue, weight)
     assert( db.getqueue(system, queue)['id'] == 1 )
+    assert db.getqueue('nosystem', queue) is None
 
 def test_addstoragegrant(db):
     year = 1984;
@@ -212,6 +213,7 @@ def test_getstoragepoints(db):
     system = 'deepblue'
     storagepts = db.getstoragepoints(system)
     assert storagepts == ['data', 'short', 'tape', 'array1']
+    assert db.getstoragepoints('nosystem') is None
     
 def test_getusage(db):
     system = 'deepblue'
@@ -222,3 +224,194 @@ def test_getusage(db):
     assert(dp['Big Brother (bxb1984)'].sum() == 1228500)
 
         
+
+def test_ensure_indexes(db):
+    db.ensure_indexes()
+    # Calling again is harmless
+    db.ensure_indexes()
+    indexes = [r['name'] for r in db.db.query("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert 'ix_UserUsage_date' in indexes
+    assert 'ix_UserStorage_project_id_storagepoint_id_scandate' in indexes
+
+def test_instrument(db):
+    year = 1984; quarter = 'q3'
+    stats = db.instrument(threshold=0.)
+    users = db.getsuusers(year, quarter)
+    db.getusage(year, quarter)
+    counters = stats.asdict()
+    assert counters['getsuusers']['calls'] == 1
+    assert counters['getsuusers']['rows'] == len(users)
+    # Names are resolved in the same query, no lookup per user
+    assert counters['getsuusers']['statements'] == 1
+    # Statements are counted against the innermost method
+    assert counters['getstartend']['calls'] == 2
+    assert counters['getusage']['rows'] > 0
+    assert len(stats.slowqueries) == sum(c['statements'] for c in counters.values())
+    assert stats.asdataframe().loc['getsuusers', 'statements'] == 1
+
+    db.uninstrument()
+    assert 'getsuusers' not in vars(db)
+    assert db.querystats is None
+
+def test_getsuusers(db):
+    year = 1984; quarter = 'q3'
+    users = db.getsuusers(year, quarter)
+    assert sorted(users) == ['bxb1984', 'wxs1984']
+    assert db.getsuusers(year, quarter, limit=1) == users[:1]
+    assert db.getsuusers(year, quarter, project=db.project) == users
+    assert db.getsuusers(year, quarter, project=[db.project, 'yy00']) == users
+    assert db.getsuusers(year, quarter, project='yy00') == []
+
+def test_getshortusers(db):
+    year = 1984; quarter = 'q3'
+    assert db.getshortusers(year, quarter) == []
+    users = db.getshortusers(year, quarter, storagepoint='array1')
+    assert sorted(users) == ['bxb1984', 'wxs1984']
+    assert db.getshortusers(year, quarter, project=db.project, limit=1, storagepoint='array1') == users[:1]
+
+def test_top_usage(db):
+    system = 'deepblue'
+    year = 1984; quarter = 'q3'
+    startdate, enddate = db.getstartend(year, quarter)
+
+    # Latest scan for each user, matches the last row of the full pivot
+    latest = db.getstorage(db.project, year, quarter, system, storagepoint='array1').iloc[-1]
+    top = db.top_usage(year, quarter, 'array1')
+    assert len(top) == 2
+    assert top['Winston Smith (wxs1984)'] == latest['Winston Smith (wxs1984)']
+    assert db.top_usage(year, quarter, 'array1', scale=1000.).iloc[0] == top.iloc[0] / 1000.
+    assert len(db.top_usage(year, quarter, 'array1', count=1)) == 1
+    assert db.top_usage(year, quarter, 'array1', project='yy00').empty
+
+    # An earlier scan on a second storage point is added to the latest on array1
+    db.adduserstorage(db.project, 'bxb1984', system, 'data', startdate, 'extra', 5000000., 10)
+    top = db.top_usage(year, quarter, ['array1', 'data'], count=1)
+    assert top.index.tolist() == ['Big Brother (bxb1984)']
+    assert top.iloc[0] == latest['Big Brother (bxb1984)'] + 5000000.
+
+    inodes = db.getstorage(db.project, year, quarter, system, storagepoint='array1', datafield='inodes').iloc[-1]
+    top = db.top_usage(year, quarter, ['array1', 'data'], measure='inodes', project=[db.project])
+    assert top['Big Brother (bxb1984)'] == inodes['Big Brother (bxb1984)'] + 10
+
+    with pytest.raises(ValueError):
+        db.top_usage(year, quarter, 'array1', measure='folders')
+
+def test_query_usage(db):
+    system = 'deepblue'
+    year = 1984; quarter = 'q3'
+    startdate, enddate = db.getstartend(year, quarter)
+
+    df = db.query_usage()
+    assert list(df.columns) == ['date', 'project', 'user', 'fullname', 'usage_su']
+    # Same values as the quarterly wide form once pivoted
+    wide = df.pivot_table(index='date', columns='user', values='usage_su', fill_value=0)
+    usage = db.getusage(year, quarter, namefield='user')
+    assert (wide.loc[usage.index, usage.columns].values == usage.values).all()
+
+    df = db.query_usage(projects=[db.project, 'yy00'], users='wxs1984', start=startdate,
+                        end=startdate + datetime.timedelta(days=9), fields=['usage_su', 'usage_cpu'])
+    assert len(df) == 10
+    assert set(df.user) == {'wxs1984'}
+    assert df.usage_cpu.iloc[-1] == 900.
+    assert db.query_usage(projects='yy00').empty
+
+    # Storage is summed over folders, one row per storage point
+    df = db.query_usage(storagepoints=['array1', 'data'], users='bxb1984', fields=('size', 'inodes'))
+    assert list(df.columns) == ['date', 'project', 'user', 'storagepoint', 'fullname', 'size', 'inodes']
+    storage = db.getstorage(db.project, year, quarter, system, storagepoint='array1', namefield='user')
+    array1 = df[df.storagepoint == 'array1'].set_index('date')['size']
+    assert (array1 == storage.loc[array1.index, 'bxb1984']).all()
+    assert set(df.storagepoint) == {'array1', 'data'}
+
+    with pytest.raises(ValueError):
+        db.query_usage(storagepoints='array1', fields='usage_su')
+    with pytest.raises(ValueError):
+        db.query_usage(fields=['size', 'usage_su'])
+
+def test_usage_output(db):
+    system = 'deepblue'
+    year = 1984; quarter = 'q3'
+
+    wide = db.getusage(year, quarter)
+    sparse = db.getusage(year, quarter, output='sparse')
+    assert all(isinstance(dtype, pd.SparseDtype) for dtype in sparse.dtypes)
+    assert list(sparse.columns) == list(wide.columns)
+    assert (sparse.sparse.to_dense().values == wide.values).all()
+    # First day of usage is zero so is not stored
+    assert sparse.sparse.density < 1.
+
+    long = db.getusage(year, quarter, output='long')
+    assert list(long.columns) == ['Date', 'Name', 'totsu']
+    assert isinstance(long.Name.dtype, pd.CategoricalDtype)
+    assert len(long) == wide.size
+    assert (long.pivot(index='Date', columns='Name', values='totsu').values == wide.values).all()
+
+    wide = db.getstorage(db.project, year, quarter, system, storagepoint='array1')
+    sparse = db.getstorage(db.project, year, quarter, system, storagepoint='array1', output='sparse')
+    assert (sparse.sparse.to_dense().values == wide.loc[sparse.index].values).all()
+    long = db.getstorage(db.project, year, quarter, system, storagepoint='array1', datafield='inodes', output='long')
+    assert list(long.columns) == ['Date', 'Name', 'totsize']
+
+    with pytest.raises(ValueError):
+        db.getusage(year, quarter, output='dense')
+
+def test_getuserusage_arrays(db):
+    year = 1984; quarter = 'q3'
+    startdate, enddate = db.getstartend(year, quarter)
+    dates, sus = db.getuserusage(db.project, year, quarter, 'wxs1984')
+    assert dates.dtype == 'datetime64[D]' and sus.dtype == 'float64'
+    assert dates[0] == startdate
+    listdates, listsus = db.getuserusage(db.project, year, quarter, 'wxs1984', aslists=True)
+    assert listdates[0] == startdate
+    assert listsus == sus.tolist()
+    # No usage gives empty arrays
+    dates, sus = db.getuserusage(db.project, year, quarter, 'xxx1984')
+    assert len(dates) == 0 and dates.dtype == 'datetime64[D]'
+
+def test_nodata():
+    from sqlalchemy.exc import SQLAlchemyError
+
+    db = ProjectDataset(dburl='sqlite:///:memory:')
+    db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+    assert db.getusage(1984, 'q3') is None
+    assert db.getstorage('xx00', 1984, 'q3', 'deepblue', 'array1') is None
+
+    # Failing SQL is not mistaken for no data
+    db.db['UserUsage'].insert(dict(bogus=1))
+    db.db['UserStorage'].insert(dict(bogus=1))
+    with pytest.raises(SQLAlchemyError):
+        db.getusage(1984, 'q3')
+    with pytest.raises(SQLAlchemyError):
+        db.getstorage('xx00', 1984, 'q3', 'deepblue', 'array1')
+
+def test_readurl(tmp_path):
+    dburl = 'sqlite:///{}'.format(tmp_path / 'primary.db')
+    primary = ProjectDataset(dburl=dburl)
+    primary.adduser('wxs1984', 'Winston Smith')
+    # A copy of the database stands in for a standby
+    primary.db.query("VACUUM INTO '{}'".format(tmp_path / 'standby.db'))
+
+    db = ProjectDataset(dburl=dburl, readurl='sqlite:///{}'.format(tmp_path / 'standby.db'),
+                        readprofile='readonly')
+    assert db.db is primary.db
+    db.adduser('bxb1984', 'Big Brother')
+    assert db.getuser('wxs1984')['fullname'] == 'Winston Smith'
+    # Writes go to the primary, reads to the standby
+    assert db.getuser('bxb1984') is None
+    assert db.db['Users'].find_one(user='bxb1984') is not None
+
+    # Lookups of names not in the database do not write, which the read
+    # only profile refuses
+    assert db.getqueue('gadi', 'normal') is None
+    assert db.getstoragepoints('gadi') is None
+    assert 'Systems' not in db.db.tables
+    primary.addsystem('deepblue')
+    readonly = ProjectDataset(dburl=dburl, profile='readonly')
+    assert readonly.getqueue('gadi', 'normal') is None
+    assert readonly.getstoragepoints('gadi') is None
+
+    # Statements on the read engine are counted
+    stats = db.instrument()
+    db.getuser('wxs1984')
+    assert stats.asdict()['getuser']['statements'] == 1
+    db.uninstrument()
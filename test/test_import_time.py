@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import subprocess
+import sys
+
+# Generous upper bound on cumulative import time in microseconds. The real
+# guard is that the heavy modules below are not imported at all
+budget = 2000000
+
+heavy = ['pandas', 'numpy', 'matplotlib', 'pyarrow']
+
+def importtime(module):
+    """
+    Import module in a fresh interpreter with -X importtime and return
+    a dict of cumulative import time by module name
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+@pytest.mark.parametrize('module', ['ncigrafana.parse_user_storage_data',
+                                    'ncigrafana.parse_account_usage_data',
+                                    'ncigrafana.parse_lquota',
+                                    'ncigrafana.make_jobs_DB',
+                                    'ncigrafana.nci_account',
+                                    'ncigrafana.nci_jobs',
+                                    'ncigrafana.serve',
+                                    'ncigrafana.load_records',
+                                    'ncigrafana.migrate_db'])
+def test_import_time(module):
+    times = importtime(module)
+    for name in heavy:
+        assert name not in times, '{} imported by {}'.format(name, module)
+    assert times[module] < budget
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import pytest
+import time
+
+pytest.importorskip('psycopg2')
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.JobsDataset import JobsDataset
+from ncigrafana.DBcommon import connect_db
+from ncigrafana.make_jobs_DB import qstat_records, load_jobs
+from ncigrafana.parse_lquota import parse_lquota
+from ncigrafana.parse_account_usage_data import parse_account_dump_file
+from ncigrafana.parse_user_storage_data import parse_file_report
+from ncigrafana import migrate_db
+from ncigrafana.migrate_db import Migration, rowhash
+
+from benchmarks.generate import write_qstat_json, add_chargerates
+
+# Set acceptable time zone strings so we can parse the
+# AEST timezone in the test file
+os.environ['TZ'] = 'AEST-10AEDT-11,M10.5.0,M3.5.0'
+time.tzset()
+
+@pytest.fixture
+def usagedb(tmp_path):
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    db = ProjectDataset(dburl=dburl)
+    parse_lquota('test/lquota.log', False, db=db)
+    parse_account_dump_file('test/nci_account.log', False, db=db)
+    parse_file_report('test/2022-11-02T11:36:45.w40.scratch.json', False, db=db)
+    parse_file_report('test/2022-11-02T11:36:45.w40.gdata.json', False, db=db)
+    return dburl
+
+@pytest.fixture
+def jobsdb(tmp_path):
+    write_qstat_json(str(tmp_path / 'qstat.json'), 100)
+    dburl = 'sqlite:///{}'.format(tmp_path / 'jobs.db')
+    load_jobs(qstat_records(str(tmp_path / 'qstat.json')), add_chargerates(JobsDataset(dburl)))
+    return dburl
+
+def test_rowhash():
+    import datetime
+    assert rowhash([1, 'a', None]) != rowhash([1, 'a', 'None'])
+    assert rowhash([datetime.date(2020, 1, 1), 1.5]) == rowhash([datetime.date(2020, 1, 1), 1.5])
+
+def test_migrate(pgurl, contents, usagedb, jobsdb):
+    target = pgurl()
+    assert migrate_db.main_parse_args(['--chunksize', '7', '--profile', usagedb, target]) == 0
+    assert migrate_db.main_parse_args(['--chunksize', '7', jobsdb, target]) == 0
+
+    db = connect_db(target)
+    expected = contents(connect_db(usagedb))
+    expected.update(contents(connect_db(jobsdb)))
+    assert contents(db) == expected
+    assert len(db['UserStorage']) > 7
+    # Indexes for the read API are created
+    assert 'ix_UserStorage_project_id_storagepoint_id_scandate' in [row['indexname'] for row in db.query(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'UserStorage'")]
+
+    # Migrating again copies nothing more
+    assert migrate_db.main_parse_args([usagedb, target]) == 0
+    assert contents(db) == expected
+
+    # Missing rows are found
+    with db:
+        db.query('DELETE FROM "UserUsage" WHERE id IN (SELECT MAX(id) FROM "UserUsage")')
+    assert migrate_db.main_parse_args([usagedb, target]) == 1
+
+def test_merge(pgurl, contents, usagedb, tmp_path):
+    # Dimensions already in the target are reused, others added
+    target = pgurl()
+    db = ProjectDataset(dburl=target)
+    db.adduser('zzz999', 'Somebody Else')
+    db.addsystem('gadi')
+    parse_lquota('test/lquota.log', False, db=db)
+
+    assert migrate_db.main_parse_args([usagedb, target]) == 0
+    db = connect_db(target)
+    source = connect_db(usagedb)
+    assert len(db['Users']) == len(source['Users']) + 1
+    assert len(db['Systems']) == len(source['Systems'])
+    assert len(db['ProjectStorage']) == 2 * len(source['ProjectStorage'])
+    assert contents(db)['UserUsage'] == contents(source)['UserUsage']
+
+def test_sources(pgurl, usagedb, tmp_path):
+    # Each source validates only the rows it copied, whatever was migrated later
+    import shutil
+    target = pgurl()
+    other = 'sqlite:///{}'.format(tmp_path / 'other.db')
+    shutil.copy(str(tmp_path / 'usage.db'), str(tmp_path / 'other.db'))
+    assert migrate_db.main_parse_args(['--chunksize', '7', usagedb, target]) == 0
+    assert migrate_db.main_parse_args(['--chunksize', '7', other, target]) == 0
+
+    migration = Migration(usagedb, target, chunksize=7)
+    for name in migration.tables()[1]:
+        sourcerows, copied, targetrows, copiedsum, targetsum = migration.validate(name)
+        assert sourcerows == copied == targetrows
+        assert copiedsum == targetsum
+    assert migrate_db.main_parse_args([usagedb, target]) == 0
+
+def test_restart(pgurl, contents, usagedb, monkeypatch):
+    target = pgurl()
+    copy_from = migrate_db.copy_from
+    calls = []
+    def failing(*args):
+        calls.append(args)
+        if len(calls) == 5:
+            raise RuntimeError('Interrupted')
+        return copy_from(*args)
+    monkeypatch.setattr(migrate_db, 'copy_from', failing)
+    with pytest.raises(RuntimeError):
+        Migration(usagedb, target, chunksize=5, workers=1).run()
+
+    db = connect_db(target)
+    # Tables copied before the interruption are finished, one is not
+    progress = list(db['MigrationProgress'].all())
+    assert len([row for row in progress if row['finished'] is None]) == 1
+    assert sum(row['rows'] for row in progress if row['finished'] is not None) > 0
+
+    monkeypatch.setattr(migrate_db, 'copy_from', copy_from)
+    assert Migration(usagedb, target, chunksize=5).run()
+    assert contents(db) == contents(connect_db(usagedb))
+
+def test_arguments(usagedb):
+    assert migrate_db.main_parse_args([usagedb, 'sqlite:///other.db']) == 1
+    assert migrate_db.main_parse_args(['postgresql://localhost/x', 'postgresql://localhost/y']) == 1
+    assert migrate_db.parse_args(['--profile', usagedb, 'postgresql://localhost/x']).profile
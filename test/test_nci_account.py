@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import json
+import threading
+
+import pandas as pd
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ncigrafana import nci_account
+from ncigrafana.nci_account import AccountClient, FetchError, main_parse_args
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        project = self.path.rsplit('/', 1)[-1]
+        with server.lock:
+            server.requests.append((project, self.client_address, self.headers['Authorization']))
+            server.conditional.append((self.headers['If-None-Match'], self.headers['If-Modified-Since']))
+            failures = server.failures.get(project, 0)
+            if failures:
+                server.failures[project] = failures - 1
+        headers = {}
+        if failures:
+            code, content = 503, b'busy'
+        elif project == 'missing':
+            code, content = 404, b'not found'
+        elif (self.headers['If-None-Match'] or self.headers['If-Modified-Since']) and (
+                self.headers['If-None-Match'] == server.validators.get('ETag') or
+                self.headers['If-Modified-Since'] == server.validators.get('Last-Modified')):
+            code, content = 304, b''
+        else:
+            code, content = 200, json.dumps({'status': 200, 'project': project}).encode()
+            headers = server.validators
+        self.send_response(code)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = {}
+    server.conditional = []
+    # Validators sent with each report, when set revalidated requests get 304
+    server.validators = {}
+    server.url = 'http://{}:{}/v0/nciaccount/'.format(*server.server_address[:2])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(autouse=True)
+def cachedir(monkeypatch, tmp_path):
+    # Do not use or fill the real cache
+    monkeypatch.setattr(nci_account, 'CACHEDIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+def token():
+    return 'token'
+
+def test_fetch_all(server):
+    client = AccountClient(server.url, workers=2, backoff=0., token=token)
+    projects = ['p{:02d}'.format(i) for i in range(20)]
+    results = client.fetch_all(projects)
+    assert [project for project, _ in results] == projects
+    assert all(json.loads(report)['project'] == project for project, report in results)
+    assert {auth for _, _, auth in server.requests} == {'MUNGE token'}
+    # Connections are kept alive and reused by each worker
+    assert len({address for _, address, _ in server.requests}) <= 2
+
+def test_retries(server):
+    server.failures = {'busy': 2, 'down': 10}
+    client = AccountClient(server.url, retries=2, backoff=0., token=token)
+    assert json.loads(client.fetch('busy'))['project'] == 'busy'
+    assert [p for p, _, _ in server.requests].count('busy') == 3
+
+    with pytest.raises(FetchError, match='HTTP 503'):
+        client.fetch('down')
+    assert [p for p, _, _ in server.requests].count('down') == 3
+
+    # Not found is not retried
+    with pytest.raises(FetchError, match='HTTP 404'):
+        client.fetch('missing')
+    assert [p for p, _, _ in server.requests].count('missing') == 1
+
+def test_unreachable():
+    client = AccountClient('http://localhost:1/', retries=1, backoff=0., timeout=1., token=token)
+    with pytest.raises(FetchError, match='ConnectionRefusedError'):
+        client.fetch('x00')
+
+def test_cache(server, cachedir):
+    client = AccountClient(server.url, backoff=0., token=token, cachedir=str(cachedir))
+    report = client.fetch('a00')
+    # A fresh report is reused without a request
+    assert client.fetch('a00') == report
+    assert len(server.requests) == 1
+
+    # A stale report without validators is fetched again
+    client.max_age = 0.
+    assert client.fetch('a00') == report
+    assert server.conditional == [(None, None)] * 2
+
+    # and revalidated once the server sends them
+    server.validators = {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jul 2019 00:00:00 GMT'}
+    client.fetch('a00')
+    assert client.fetch('a00') == report
+    assert server.conditional[-1] == ('"v1"', 'Mon, 01 Jul 2019 00:00:00 GMT')
+    assert len(server.requests) == 4
+
+    # Failures are not cached
+    server.failures = {'b00': 1}
+    with pytest.raises(FetchError):
+        AccountClient(server.url, retries=0, token=token, cachedir=str(cachedir)).fetch('b00')
+    assert sorted(p.name for p in cachedir.glob('*/*')) == ['a00.json']
+
+    # Reports from another server are cached separately
+    other = AccountClient(server.url + 'other/', token=token, cachedir=str(cachedir))
+    assert other.readcache('a00') is None
+    assert other.cachefile('a00') != client.cachefile('a00')
+
+    # as are entries without the time they were fetched
+    with open(client.cachefile('a00'), 'w') as f:
+        json.dump({'body': report}, f)
+    assert client.readcache('a00') is None
+    assert client.fetch('a00') == report
+    assert len(server.requests) == 6
+
+def test_cache_last_modified(server, cachedir):
+    server.validators = {'Last-Modified': 'Mon, 01 Jul 2019 00:00:00 GMT'}
+    client = AccountClient(server.url, token=token, cachedir=str(cachedir), max_age=0.)
+    report = client.fetch('a00')
+    assert client.fetch('a00') == report
+    assert server.conditional[-1] == (None, 'Mon, 01 Jul 2019 00:00:00 GMT')
+
+def test_main(server, monkeypatch, capsys):
+    monkeypatch.setattr(nci_account, 'munge_token', token)
+    server.failures = {'down': 10}
+    rc = main_parse_args(['--projects', 'a00', 'down', 'b00', '--server', server.url, '--retries', '0'])
+    assert rc == 1
+    out, err = capsys.readouterr()
+    assert [json.loads(line)['project'] for line in out.splitlines()] == ['a00', 'b00']
+    assert 'down' in err
+
+    # Reports are cached for --max-age seconds
+    server.failures = {'down': 10}
+    rc = main_parse_args(['--projects', 'a00', 'b00', '--server', server.url])
+    assert rc == 0
+    assert [p for p, _, _ in server.requests].count('a00') == 1
+    rc = main_parse_args(['--projects', 'a00', '--server', server.url, '--max-age', '0'])
+    assert [p for p, _, _ in server.requests].count('a00') == 2
+    rc = main_parse_args(['--projects', 'down', '--server', server.url, '--no-cache', '--retries', '0'])
+    assert rc == 1
+
+# dataset warns about creating tables in a transaction while the stand-in
+# server thread is running
+@pytest.mark.filterwarnings('ignore:Changing the database schema')
+def test_ingest(server, monkeypatch, tmp_path):
+    from ncigrafana.UsageDataset import ProjectDataset
+    from ncigrafana.parse_account_usage_data import parse_account_dump_file
+
+    # Serve the reports in the test log with the project changed
+    with open('test/nci_account.log') as f:
+        report = json.loads(f.readlines()[2])
+    def do_GET(self):
+        project = self.path.rsplit('/', 1)[-1]
+        content = json.dumps(dict(report, project=project)).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    monkeypatch.setattr(Handler, 'do_GET', do_GET)
+    monkeypatch.setattr(nci_account, 'munge_token', token)
+
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    log = str(tmp_path / 'nci_account.log')
+    rc = main_parse_args(['--projects', 'a00', 'b00', '--server', server.url,
+                          '--ingest', '--dburl', dburl, '--log', log])
+    assert rc == 0
+
+    db = ProjectDataset(dburl=dburl)
+    assert sorted(db.getprojects()) == ['a00', 'b00']
+    assert len(list(db.getusers())) == len(report['usage']['users'])
+    runs = db.getingestruns()
+    assert runs['written'].tolist() == [2]
+    assert runs['filename'].tolist() == [log]
+    assert runs['url'].tolist() == [server.url]
+
+    # Without a log only the server is recorded
+    assert main_parse_args(['--projects', 'a00', '--server', server.url, '--no-cache',
+                            '--ingest', '--dburl', dburl]) == 0
+    run = db.getingestruns().iloc[-1]
+    assert pd.isnull(run['filename']) and run['url'] == server.url
+
+    # The log can be parsed again to give the same records
+    other = ProjectDataset(dburl='sqlite:///:memory:')
+    assert parse_account_dump_file(log, False, db=other) == (2, 2)
+    year, quarter = db.getquarter()
+    assert other.getquarter() == (year, quarter)
+    assert (other.getusage(year, quarter).values == db.getusage(year, quarter).values).all()
@@ -5,6 +5,7 @@ from __future__ import print_function
 import datetime
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from numpy import arange
+import numpy
 import os
 import pandas as pd
 import pytest
@@ -75,8 +76,13 @@ def test_getschemeusage(db):
     system = db.getsystems()[0]
     scheme = db.getschemes()[0]
     year, quarter = db.getquarter()
-    assert( db.getschemeusage(project, system, scheme, year, quarter) == 
+    assert( db.getschemeusage(project, system, scheme, year, quarter, aslists=True) == 
             ([datetime.date(2019, 6, 27), datetime.date(2019, 6, 28)], [3404.119149, 3404.119149]) )
+    dates, usage = db.getschemeusage(project, system, scheme, year, quarter)
+    assert dates.dtype == numpy.dtype('datetime64[D]')
+    assert usage.dtype == numpy.float64
+    assert_array_equal(dates, numpy.array(['2019-06-27', '2019-06-28'], dtype='datetime64[D]'))
+    assert_array_equal(usage, [3404.119149, 3404.119149])
 
 def test_getusers(db):
 
@@ -54,3 +54,31 @@ def test_getstorage(db):
     dp = db.getprojectstorage(project, system, 'gdata')
     assert dp == (83793781152808.0, 1805324.0)
 
+
+def test_counts(tmp_path, monkeypatch):
+    # A malformed line is counted as parsed but not accepted
+    with open('test/lquota.log') as f:
+        lines = f.readlines()
+    header = next(i for i, line in enumerate(lines) if line.lstrip().startswith('fs'))
+    lines.insert(header + 2, 'xx00 scratch lots\n')
+    filename = tmp_path / 'lquota.log'
+    filename.write_text(''.join(lines))
+
+    assert parse_lquota(str(filename), verbose, db=ProjectDataset('xx00', 'sqlite:///:memory:')) == (9, 8)
+
+    # The file is kept rather than archived, and the run records why
+    from ncigrafana.parse_lquota import main_parse_args
+    # The archive directory is made in the working directory
+    monkeypatch.chdir(tmp_path)
+    dburl = 'sqlite:///{}'.format(tmp_path / 'usage.db')
+    main_parse_args(['-db', dburl, str(filename)])
+    assert filename.exists()
+    assert not (tmp_path / 'archive' / 'lquota.log.gz').exists()
+    run = ProjectDataset(dburl=dburl).getingestruns().iloc[-1]
+    assert (run['parsed'], run['written'], run['errors']) == (9, 8, 1)
+    assert 'not archived' in run['error']
+
+    filename.write_text(''.join(lines[:header + 2] + lines[header + 3:]))
+    main_parse_args(['-db', dburl, str(filename)])
+    assert not filename.exists()
+    assert (tmp_path / 'archive' / 'lquota.log.gz').exists()
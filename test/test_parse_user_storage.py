@@ -176,3 +176,23 @@ def test_getstorage(db):
     # import pytest
     # pytest.set_trace()
     # print(dp)
+
+def test_counts(tmp_path):
+    # An entry missing fields is counted as parsed but not accepted
+    from ncigrafana.parse_user_storage_data import file_report_records
+    import json
+
+    with open('test/2022-11-02T11:36:45.w40.scratch.json') as f:
+        entries = json.load(f)
+    del entries[1]['blocks']
+    filename = tmp_path / '2022-11-02T11:36:45.w40.scratch.json'
+    filename.write_text(json.dumps(entries))
+
+    records = file_report_records(str(filename), verbose)
+    assert (records.parsed, records.accepted) == (len(entries), len(entries) - 1)
+    assert len(records.rows['userstorage']) == len(entries) - 1
+
+    # The file is kept rather than archived
+    from ncigrafana.parse_user_storage_data import main_parse_args
+    main_parse_args(['-o', str(tmp_path / 'records'), str(filename)])
+    assert filename.exists()
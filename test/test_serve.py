@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import json
+import threading
+import time
+import urllib.request
+import urllib.error
+
+from ncigrafana.UsageDataset import ProjectDataset
+from ncigrafana.JobsDataset import JobsDataset
+from ncigrafana.serve import ResultCache, Datasource, make_server, parse_time, main_parse_args
+
+from test_JobsDataset import addjob
+
+startdate = datetime.date(2019, 7, 1)
+daterange = {'from': '2019-07-01T00:00:00.000Z', 'to': '2019-07-31T23:59:59.000Z'}
+
+def fill(usagedb, jobsdb):
+    usagedb.adduser('aaa000', 'Alice')
+    for day in range(3):
+        date = startdate + datetime.timedelta(days=day)
+        usagedb.adduserusage('xx00', 'aaa000', date, 0., 0., 10. * day, 0.)
+        usagedb.adduserstorage('xx00', 'aaa000', 'gadi', 'scratch', str(date), 'a', 1000., 1)
+    usagedb.addingestrun('nci-account', 'dump.log', datetime.datetime(2019, 7, 2, 10), 1., 10, 9)
+
+    jobsdb.addchargerate('normal', 2.)
+    jobsdb.addchargerate('express', 6.)
+    addjob(jobsdb, '1', datetime.datetime(2019, 7, 1, 9), ncpus=48)
+    addjob(jobsdb, '2', datetime.datetime(2019, 7, 1, 10), queue='express', ncpus=48)
+    addjob(jobsdb, '3', datetime.datetime(2019, 7, 2, 10), ncpus=48)
+    jobsdb.updatejobstats()
+
+    return Datasource(usagedb, jobsdb, ttl=60.)
+
+@pytest.fixture(scope='module')
+def datasource(tmp_path_factory):
+    path = tmp_path_factory.mktemp('serve')
+    return fill(ProjectDataset(dburl='sqlite:///{}'.format(path / 'usage.db')),
+                JobsDataset('sqlite:///{}'.format(path / 'jobs.db')))
+
+@pytest.fixture(scope='module')
+def url(datasource):
+    server = make_server(datasource, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://{}:{}'.format(*server.server_address[:2])
+    server.shutdown()
+    server.server_close()
+
+def post(url, path, body):
+    request = urllib.request.Request(url + path, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def test_parse_time():
+    assert parse_time('2019-07-01T00:00:00.000Z') == startdate
+
+def test_resultcache():
+    cache = ResultCache(ttl=60., maxsize=2)
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return len(calls)
+
+    # Concurrent requests for the same key share one computation
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a', compute))) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert results == [1, 1, 1, 1]
+    assert cache.get('a', compute) == 1
+    assert cache.stats() == dict(size=1, hits=1, misses=1, coalesced=3)
+
+    cache.get('b', lambda: 'b')
+    cache.get('c', lambda: 'c')
+    assert list(cache.results) == ['b', 'c']
+
+    expired = ResultCache(ttl=0.)
+    assert expired.get('a', lambda: 1) == 1
+    assert expired.get('a', lambda: 2) == 2
+
+    with pytest.raises(ZeroDivisionError):
+        cache.get('d', lambda: 1/0)
+    assert 'd' not in cache.results
+
+def test_health(url):
+    with urllib.request.urlopen(url + '/') as response:
+        assert json.loads(response.read())['status'] == 'ok'
+
+def test_search(url):
+    targets = post(url, '/search', {'target': ''})
+    assert 'usage/usage_su/xx00' in targets
+    assert 'storage/inodes/xx00/scratch' in targets
+    assert 'jobs/su/xx00' in targets
+    assert post(url, '/search', {'target': 'jobs/count'}) == ['jobs/count', 'jobs/count/xx00']
+
+def test_query(url, datasource):
+    result = post(url, '/query', {'range': daterange,
+                                  'targets': [{'target': 'usage/usage_su/xx00', 'refId': 'A'},
+                                              {'target': 'storage/size/xx00/scratch', 'refId': 'B'},
+                                              {'target': 'jobs/count', 'refId': 'C'},
+                                              {'target': 'jobs/su', 'refId': 'D', 'hide': True}]})
+    usage, storage, express, normal = result
+    assert usage['target'] == 'Alice (aaa000)'
+    assert usage['datapoints'] == [[0., 1561939200000], [10., 1562025600000], [20., 1562112000000]]
+    assert [v for v, t in storage['datapoints']] == [1000.] * 3
+    assert normal['target'] == 'normal' and [v for v, t in normal['datapoints']] == [1., 1.]
+    assert express['target'] == 'express'
+
+    # Repeated queries are answered from the cache
+    hits = datasource.cache.hits
+    post(url, '/query', {'range': daterange, 'targets': [{'target': 'jobs/count', 'refId': 'A'}]})
+    assert datasource.cache.hits == hits + 1
+
+def test_annotations(url):
+    annotation = {'name': 'ingest', 'query': 'nci-account'}
+    result = post(url, '/annotations', {'range': daterange, 'annotation': annotation})
+    assert len(result) == 1
+    assert result[0]['title'] == 'nci-account ingest'
+    assert result[0]['annotation'] == annotation
+    assert post(url, '/annotations', {'range': daterange, 'annotation': {'query': 'qstat'}}) == []
+
+def test_errors(url):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url, '/query', {'range': daterange, 'targets': [{'target': 'usage/size'}]})
+    assert e.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url, '/query', {'range': daterange, 'targets': [{'target': 'jobs/waittime'}]})
+    assert e.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url, '/tag-keys', {})
+    assert e.value.code == 404
+
+def test_arguments(capsys):
+    assert main_parse_args(['--profile']) == 1
+    assert 'SQL statements' in capsys.readouterr().out
+
+def test_internal_error(url, datasource, monkeypatch):
+    def search(body):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(datasource, 'search', search)
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url, '/search', {})
+    assert e.value.code == 500
+    assert json.loads(e.value.read()) == {'error': 'RuntimeError: database is locked'}
+
+def test_postgresql(pgurl, datasource):
+    # Every target and the annotations give the same on PostgreSQL
+    pgsource = fill(ProjectDataset(dburl=pgurl()), JobsDataset(pgurl()))
+    targets = datasource.search({})
+    assert pgsource.search({}) == targets
+    body = {'range': daterange, 'targets': [{'target': target} for target in targets]}
+    assert pgsource.query(body) == datasource.query(body)
+    body = {'range': daterange, 'annotation': {'name': 'ingest', 'query': 'nci-account'}}
+    assert len(pgsource.annotations(body)) == 1
+    assert pgsource.annotations(body) == datasource.annotations(body)